@@ -142,6 +142,53 @@ class GenotypeData(object):
             self.missing += 2
         self.genotypes.append(gt)
 
+    @classmethod
+    def from_genotypes(cls, genotypes):
+        """Build from an array of genotypes (0, 1, 2 or negative for missing)
+
+        :param genotypes: numpy array of genotypes, which is kept as is
+        :return: GenotypeData with all counts populated
+        """
+        data = cls()
+        counts = numpy.bincount(numpy.clip(genotypes, -1, 2) + 1, minlength=4)
+        data.genotypes = genotypes
+        data.ref_counts = int(2 * counts[1] + counts[2])
+        data.alt_counts = int(counts[2] + 2 * counts[3])
+        data.het_counts = int(counts[2])
+        data.missing = int(2 * counts[0])
+        return data
+
+    @classmethod
+    def from_dosages(cls, genotypes):
+        """Build from dosages (n) or genotype probabilities (n x 3) with \
+            negative values representing missing data
+
+        :param genotypes: numpy array of dosages or probabilities, which is
+                          kept as is
+        :return: GenotypeData with (fractional) counts populated
+        """
+        data = cls()
+        data.genotypes = genotypes
+        valid = ~data.missing_mask()
+        if genotypes.ndim == 2:
+            het = genotypes[valid, 1].astype(numpy.float64)
+            dosages = het + 2 * genotypes[valid, 2]
+        else:
+            dosages = genotypes[valid].astype(numpy.float64)
+            het = dosages - 2 * numpy.maximum(dosages - 1, 0)
+        data.alt_counts = float(numpy.sum(dosages))
+        data.ref_counts = 2 * float(dosages.shape[0]) - data.alt_counts
+        data.het_counts = float(numpy.sum(het))
+        data.missing = int(2 * (valid.shape[0] - dosages.shape[0]))
+        return data
+
+    def missing_mask(self):
+        """Return True for each sample whose genotype is missing"""
+        genotypes = self.gt()
+        if genotypes.ndim == 2:
+            return genotypes[:, 0] < 0
+        return genotypes < 0
+
     def maf(self):
         if self.alt_counts > self.ref_counts:
             return self.ref_counts / (self.alt_counts + self.ref_counts)
@@ -0,0 +1,547 @@
+import os
+import re
+import gzip
+import math
+import struct
+import logging
+import numpy
+from .data_parser import DataParser
+from .pheno_covar import PhenoCovar
+from .boundary import BoundaryCheck
+from . import marker_table
+from . import vcf_parser
+from . import bgzf
+from . import ExitIf
+from . import BuildReportLine
+from .exceptions import InvalidChromosome
+from .exceptions import MalformedInputFile
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reader for BCF (binary VCF, version 2.x) files.
+
+Records are read straight from the (BGZF compressed) binary layout and the
+FORMAT values are decoded with numpy.frombuffer, so there is no string
+handling for sample data at all. Region queries use a CSI index (.csi)
+when one is present.
+"""
+
+#: Size (in bytes) and numpy type of each of the BCF typed value types
+type_sizes = {0: 0, 1: 1, 2: 2, 3: 4, 5: 4, 7: 1}
+type_dtypes = {1: numpy.dtype("<i1"), 2: numpy.dtype("<i2"), 3: numpy.dtype("<i4"),
+               5: numpy.dtype("<f4")}
+
+#: Integer values marking missing data and the end of a vector
+int_missing = {1: -128, 2: -32768, 3: -2147483648}
+int_vector_end = {1: -127, 2: -32767, 3: -2147483647}
+
+#: Bit patterns for missing float values and the end of a vector
+float_missing = 0x7F800001
+float_vector_end = 0x7F800002
+
+_shared_header = struct.Struct("<iiifII")
+_record_header = struct.Struct("<II")
+
+
+def typed_descriptor(data, offset):
+    """Decode the type byte (and optional size) of a typed value
+
+    :param data: bytes containing the value
+    :param offset: position of the type byte
+    :return: (type, count, offset of the values)
+    """
+    descriptor = data[offset]
+    offset += 1
+    value_type = descriptor & 0x0f
+    count = descriptor >> 4
+    if count == 15:
+        count, offset = typed_int(data, offset)
+    return value_type, count, offset
+
+
+def typed_int(data, offset):
+    """Decode a single typed integer, returning (value, next offset)"""
+    value_type, count, offset = typed_descriptor(data, offset)
+    if value_type not in int_missing or count != 1:
+        raise MalformedInputFile("Expected a typed integer in BCF record")
+    value = int(numpy.frombuffer(data, dtype=type_dtypes[value_type], count=1, offset=offset)[0])
+    return value, offset + type_sizes[value_type]
+
+
+def typed_values(data, offset):
+    """Decode a typed vector (strings are returned as str)
+
+    :return: (values, next offset)
+    """
+    value_type, count, offset = typed_descriptor(data, offset)
+    size = type_sizes[value_type] * count
+    if value_type == 7:
+        return data[offset:offset + size].rstrip(b"\0").decode(), offset + size
+    if value_type == 0:
+        return None, offset
+    values = numpy.frombuffer(data, dtype=type_dtypes[value_type], count=count, offset=offset)
+    return values, offset + size
+
+
+def decode_gt(values, value_type):
+    """Convert BCF encoded GT values into alternate allele counts
+
+    :param values: (samples x ploidy) array of encoded alleles
+    :param value_type: BCF integer type of the values
+    :return: int8 genotypes with missing_storage for missing calls
+
+    Haploid calls (padded with vector_end) are counted as homozygous, as
+    they are for VCF text. Alleles other than 0 and 1 are treated as missing.
+    """
+    ends = values == int_vector_end[value_type]
+    alleles = (values.astype(numpy.int32) >> 1) - 1
+    first = alleles[:, 0]
+    second = first
+    if values.shape[1] > 1:
+        second = numpy.where(ends[:, 1], first, alleles[:, 1])
+    valid = (first >= 0) & (first <= 1) & (second >= 0) & (second <= 1) & ~ends[:, 0]
+    if values.shape[1] > 2:
+        valid &= numpy.all(ends[:, 2:], axis=1)
+    genotypes = (first + second).astype(numpy.int8)
+    genotypes[~valid] = DataParser.missing_storage
+    return genotypes
+
+
+def decode_floats(values):
+    """Replace missing (and vector end) floats with missing_storage
+
+    :param values: (samples x n) float32 array
+    :return: float32 array where any row containing a missing value is
+             entirely missing_storage
+    """
+    bits = values.view(numpy.uint32)
+    missing = numpy.any((bits == float_missing) | (bits == float_vector_end) |
+                        numpy.isnan(values), axis=1)
+    values = values.copy()
+    values[missing] = DataParser.missing_storage
+    return values
+
+
+def reg2bin(beg, end, min_shift, depth):
+    """Smallest CSI bin containing the 0 based, half open region beg-end"""
+    end -= 1
+    shift = min_shift
+    offset = ((1 << (depth * 3)) - 1) // 7
+    for level in range(depth, 0, -1):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+        shift += 3
+        offset -= 1 << (level * 3)
+    return 0
+
+
+def reg2bins(beg, end, min_shift, depth):
+    """All CSI bins overlapping the 0 based, half open region beg-end"""
+    bins = []
+    end -= 1
+    shift = min_shift + depth * 3
+    offset = 0
+    for level in range(depth + 1):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+        shift -= 3
+        offset += 1 << (level * 3)
+    return bins
+
+
+class CsiIndex(object):
+    """Coordinate sorted index (CSI) for a BGZF compressed file"""
+
+    def __init__(self, filename):
+        with gzip.open(filename, "rb") as file:
+            data = file.read()
+        if data[0:4] != b"CSI\x01":
+            raise MalformedInputFile("%s isn't a CSI index" % (filename))
+        self.min_shift, self.depth, aux_length = struct.unpack_from("<iii", data, 4)
+        offset = 16 + aux_length
+        reference_count = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+
+        #: For each reference: bin => list of (start, end) virtual offsets
+        self.bins = []
+        for reference in range(reference_count):
+            bins = {}
+            bin_count = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            for i in range(bin_count):
+                bin, loffset, chunk_count = struct.unpack_from("<IQi", data, offset)
+                offset += 16
+                chunks = numpy.frombuffer(data, dtype="<u8", count=chunk_count * 2,
+                                          offset=offset).reshape(-1, 2)
+                offset += 16 * chunk_count
+                bins[bin] = [(int(x[0]), int(x[1])) for x in chunks]
+            self.bins.append(bins)
+
+    def chunks(self, reference, beg, end):
+        """Merged, sorted chunks which may contain records overlapping the \
+            0 based, half open region beg-end on reference"""
+        if reference >= len(self.bins):
+            return []
+        bins = self.bins[reference]
+        chunks = []
+        for bin in reg2bins(beg, end, self.min_shift, self.depth):
+            chunks.extend(bins.get(bin, []))
+        merged = []
+        for start, stop in sorted(chunks):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+            else:
+                merged.append((start, stop))
+        return merged
+
+
+class Header(object):
+    """Dictionaries and samples described by a BCF header"""
+
+    _id = re.compile(r"[<,]ID=([^,>]+)")
+    _idx = re.compile(r"[<,]IDX=(\d+)")
+
+    def __init__(self, text):
+        #: Shared dictionary of FILTER/INFO/FORMAT IDs (PASS is always 0)
+        self.strings = {0: "PASS"}
+        #: Contig names, indexed by the CHROM values found in records
+        self.contigs = {}
+        #: Sample IDs
+        self.samples = []
+
+        seen = set(["PASS"])
+        for line in text.split("\n"):
+            if line.startswith("##FILTER=<") or line.startswith("##INFO=<") or \
+                    line.startswith("##FORMAT=<"):
+                self.add(self.strings, line, seen)
+            elif line.startswith("##contig=<"):
+                self.add(self.contigs, line, set())
+            elif line.startswith("#CHROM"):
+                self.samples = line.strip().split("\t")[9:]
+
+        #: ID => dictionary index
+        self.string_index = dict((v, k) for k, v in self.strings.items())
+
+    def add(self, dictionary, line, seen):
+        name = self._id.search(line)
+        if name is None or name.group(1) in seen:
+            return
+        seen.add(name.group(1))
+        idx = self._idx.search(line)
+        if idx is not None:
+            dictionary[int(idx.group(1))] = name.group(1)
+        else:
+            dictionary[len(dictionary)] = name.group(1)
+
+
+class Parser(DataParser):
+    """Parse BCF data
+
+    Class Members:
+        filename
+        data_field  GT, DS or GP
+        regions     Merged (chrom, start, end) regions to be traversed
+        indexed     True if regions are served through the CSI index
+    """
+
+    #: min Quality filter
+    min_qual = 17
+
+    #: Acceptable FILTER values (see vcf_parser.Parser.pass_filters)
+    pass_filters = set([".", "PASS"])
+
+    def __init__(self, filename, data_field='GT', regions=None):
+        """
+        :param filename: BCF file (BGZF compressed or uncompressed)
+        :param data_field: FORMAT key used for genotypes (GT, DS or GP)
+        :param regions: optional list of (chrom, start, end) to be
+                        traversed. Positions are 1 based and inclusive.
+        """
+        self.bcf_filename = filename
+        self.data_field = data_field
+        ExitIf("Unsupported BCF data field, %s" % (data_field),
+               data_field not in vcf_parser.data_field_extraction)
+
+        #: VCF extraction for the data field, used to wrap the decoded values
+        self.extract_genotypes = vcf_parser.data_field_extraction[data_field](data_field)
+
+        self.ind_mask = None
+        self.ind_count = -1
+        self.sample_index = None
+
+        #: Subjects dropped due to missing individual threshold
+        self.alt_not_missing = None
+
+        #: Merged regions to be traversed (None for the entire file)
+        self.regions = None
+        if regions is not None:
+            self.regions = vcf_parser.merge_regions(regions)
+
+        self.compressed = bgzf.is_bgzf(filename)
+
+        self.bcf_file = None
+        self.read_header()
+
+        self.index = None
+        if self.compressed and os.path.isfile("%s.csi" % (filename)):
+            self.index = CsiIndex("%s.csi" % (filename))
+        self.records = None
+        self.reset()
+
+    def __del__(self):
+        if self.bcf_file is not None:
+            self.bcf_file.close()
+
+    def initialize(self, map3=None, pheno_covar=None):
+        self.init_subjects(pheno_covar)
+        self.load_genotypes()
+
+    def getnew(self):
+        return Parser(self.bcf_filename, self.data_field, self.regions)
+
+    def ReportConfiguration(self):
+        log = logging.getLogger('bcf_parser::ReportConfiguration')
+        log.info(BuildReportLine("BCF FILE", self.bcf_filename))
+        log.info(BuildReportLine("DATA FIELD", self.data_field))
+
+    def open(self):
+        if self.compressed:
+            return bgzf.VirtualReader(self.bcf_filename)
+        return open(self.bcf_filename, "rb")
+
+    def read_header(self):
+        file = self.open()
+        magic = file.read(5)
+        ExitIf("%s isn't a BCF file" % (self.bcf_filename), magic[0:3] != b"BCF")
+        text_length = struct.unpack("<I", file.read(4))[0]
+        self.header = Header(file.read(text_length).rstrip(b"\0").decode())
+        #: Offset of the first record
+        self.data_offset = 9 + text_length
+        if self.compressed:
+            self.data_offset = file.tell()
+        file.close()
+
+        #: Chromosome codes for each contig (None for unrecognized contigs)
+        self.contig_codes = {}
+        for idx, name in self.header.contigs.items():
+            try:
+                self.contig_codes[idx] = marker_table.chrom_code(name)
+            except InvalidChromosome:
+                self.contig_codes[idx] = None
+        #: Contig name => index
+        self.contig_index = dict((v, k) for k, v in self.header.contigs.items())
+
+    def init_subjects(self, pheno_covar):
+        mask_components = []
+        for id in self.header.samples:
+            if DataParser.valid_indid(id):
+                mask_components.append(0)
+                pheno_covar.add_subject(id, phenotype=pheno_covar.missing_encoding)
+            else:
+                mask_components.append(1)
+
+        self.ind_mask = numpy.array(mask_components) == 1
+        self.ind_count = self.ind_mask.shape[0]
+        self.sample_index = numpy.flatnonzero(~self.ind_mask)
+        pheno_covar.freeze_subjects()
+
+    def load_family_details(self, pheno_covar):
+        self.init_subjects(pheno_covar)
+
+    def query_regions(self):
+        """Regions to be traversed (see vcf_parser.Parser.query_regions)"""
+        if self.regions is not None:
+            return self.regions
+        if BoundaryCheck.chrom != -1:
+            chrom = BoundaryCheck.chrom_name
+            if chrom is None or chrom not in self.contig_index:
+                codes = [k for k, v in self.contig_codes.items() if v == BoundaryCheck.chrom]
+                if len(codes) == 0:
+                    return []
+                chrom = self.header.contigs[codes[0]]
+            bounds = getattr(DataParser.boundary, "bounds", [])
+            if len(bounds) > 0:
+                return [(chrom, bounds[0], bounds[1])]
+            return [(chrom, 1, vcf_parser.max_position)]
+        return None
+
+    def reset(self):
+        if self.bcf_file is not None:
+            self.bcf_file.close()
+        self.bcf_file = self.open()
+        regions = self.query_regions()
+        if self.index is not None and regions is not None:
+            self.records = self.region_records(regions)
+        else:
+            self.bcf_file.seek(self.data_offset)
+            self.records = self.all_records(self.regions)
+
+    def read_record(self):
+        """Read the next record, returning (shared, individual) bytes or None"""
+        header = self.bcf_file.read(8)
+        if len(header) < 8:
+            return None
+        shared_length, indiv_length = _record_header.unpack(header)
+        shared = self.bcf_file.read(shared_length)
+        indiv = self.bcf_file.read(indiv_length)
+        if len(indiv) != indiv_length:
+            raise MalformedInputFile("Truncated record found in %s" % (self.bcf_filename))
+        return shared, indiv
+
+    def all_records(self, regions):
+        """Generate every record in the file (restricted to regions if set)"""
+        bounds = None
+        if regions is not None:
+            bounds = {}
+            for chrom, start, end in regions:
+                if chrom in self.contig_index:
+                    bounds.setdefault(self.contig_index[chrom], []).append((start, end))
+        while True:
+            record = self.read_record()
+            if record is None:
+                return
+            if bounds is not None:
+                chrom, pos = struct.unpack_from("<ii", record[0], 0)
+                pos += 1
+                if not any(start <= pos <= end for start, end in bounds.get(chrom, [])):
+                    continue
+            yield record
+
+    def region_records(self, regions):
+        """Generate the records within each region via the CSI index"""
+        for chrom, start, end in regions:
+            if chrom not in self.contig_index:
+                logging.info("No variants found for %s:%d-%d" % (chrom, start, end))
+                continue
+            reference = self.contig_index[chrom]
+            for chunk_start, chunk_end in self.index.chunks(reference, start - 1, end):
+                self.bcf_file.seek(chunk_start)
+                while self.bcf_file.tell() < chunk_end:
+                    record = self.read_record()
+                    if record is None:
+                        break
+                    record_chrom, pos = struct.unpack_from("<ii", record[0], 0)
+                    pos += 1
+                    if record_chrom != reference or pos > end:
+                        break
+                    if pos >= start:
+                        yield record
+
+    def parse_shared(self, shared):
+        """Decode the fixed portion of a record
+
+        :return: (chrom, pos, qual, rsid, alleles, filter)
+
+        The allele count is held in the upper 16 bits of n_allele_info and
+        the INFO count in the lower 16. INFO fields aren't used, but they
+        are walked to be sure the record is intact.
+        """
+        chrom, pos, rlen, qual, n_allele_info, n_fmt_sample = _shared_header.unpack_from(shared, 0)
+        rsid, offset = typed_values(shared, _shared_header.size)
+        alleles = []
+        for i in range(n_allele_info >> 16):
+            allele, offset = typed_values(shared, offset)
+            alleles.append(allele)
+        filters, offset = typed_values(shared, offset)
+        for i in range(n_allele_info & 0xffff):
+            key, offset = typed_int(shared, offset)
+            value, offset = typed_values(shared, offset)
+        if offset > len(shared):
+            raise MalformedInputFile("Truncated record found in %s" % (self.bcf_filename))
+        if filters is None or len(filters) == 0:
+            filter = "."
+        else:
+            filter = ";".join([self.header.strings.get(int(x), ".") for x in filters])
+        return chrom, pos + 1, qual, rsid, alleles, filter
+
+    def extract_values(self, indiv, format_count, sample_count):
+        """Pull the data field's values for the unmasked samples
+
+        :return: GenotypeData or None if the field isn't present
+        """
+        key = self.header.string_index.get(self.data_field)
+        offset = 0
+        for i in range(format_count):
+            field, offset = typed_int(indiv, offset)
+            value_type, count, offset = typed_descriptor(indiv, offset)
+            size = type_sizes[value_type] * count * sample_count
+            if field == key:
+                values = numpy.frombuffer(indiv, dtype=type_dtypes[value_type],
+                                          count=count * sample_count,
+                                          offset=offset).reshape(sample_count, count)
+                values = values[self.sample_index]
+                if self.data_field == 'GT':
+                    return self.extract_genotypes.genotype_data(decode_gt(values, value_type))
+                return self.extract_genotypes.genotype_data(
+                    decode_floats(values.astype(numpy.float32)))
+            offset += size
+        return None
+
+    def load_genotypes(self):
+        self.reset()
+        locus_count = 0
+        missing = numpy.zeros(self.sample_index.shape[0], dtype=numpy.int32)
+
+        for shared, indiv in self.records:
+            chrom, pos, qual, rsid, alleles, filter = self.parse_shared(shared)
+            chr = self.contig_codes.get(chrom)
+            if chr is not None and DataParser.boundary.TestBoundary(chr, pos, rsid):
+                n_fmt_sample = _shared_header.unpack_from(shared, 0)[5]
+                data = self.extract_values(indiv, n_fmt_sample >> 24, n_fmt_sample & 0xffffff)
+                if data is not None:
+                    locus_count += 1
+                    missing += data.missing_mask()
+
+        max_missing = DataParser.ind_miss_tol * locus_count
+        dropped_individuals = max_missing < missing
+        if numpy.sum(dropped_individuals) > 0:
+            self.alt_not_missing = ~dropped_individuals
+
+        self.locus_count = locus_count
+        self.reset()
+
+    def populate_iteration(self, iteration):
+        shared, indiv = next(self.records)
+        chrom, pos, qual, rsid, alleles, filter = self.parse_shared(shared)
+
+        iteration.chr = self.contig_codes.get(chrom)
+        iteration.pos = pos
+        iteration.rsid = rsid
+        iteration.ref = alleles[0]
+        iteration.alt = "."
+        if len(alleles) > 1:
+            iteration.alt = alleles[1]
+        # Genotypes count the ALT allele, so it must remain the second allele
+        iteration.alleles = [iteration.ref, iteration.alt]
+
+        if iteration.chr is None or \
+                not DataParser.boundary.TestBoundary(iteration.chr, iteration.pos, iteration.rsid):
+            return False
+        if not (math.isnan(qual) or qual > Parser.min_qual) or filter not in Parser.pass_filters:
+            return False
+
+        n_fmt_sample = _shared_header.unpack_from(shared, 0)[5]
+        geno = self.extract_values(indiv, n_fmt_sample >> 24, n_fmt_sample & 0xffffff)
+        if geno is None:
+            return False
+        return vcf_parser.set_genotypes(iteration, geno)
+
+    def __iter__(self):
+        """Reset the file and begin iteration"""
+        locus = super(Parser, self).__iter__()
+        locus._extract_genotypes = self.extract_genotypes.locus_extraction
+        return locus
@@ -7,8 +7,12 @@ from .parsed_locus import ParsedLocus
 from . import Exit
 from . import BuildReportLine
 import sys
-from . import sys_call
+import os
+import tempfile
+import math
 import logging
+from .boundary import BoundaryCheck
+from . import marker_table
 from .pheno_covar import PhenoCovar
 import pdb
 
@@ -30,8 +34,212 @@ __license__ = "GPL3.0"
 #     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
 
 
+def build_decode_table(conversions):
+    """Build the byte => genotype lookup table used to decode .bed data
+
+    :param conversions: mapping of 2 bit codes to genotype values
+    :return: int8 array (256x4) with the 4 genotypes packed into each byte
+
+    Row i contains the genotypes for the byte, i, in the order they appear
+    in the file (lowest order bits first).
+    """
+    table = numpy.empty((256, 4), dtype=numpy.int8)
+    for byte in range(256):
+        for i in range(0, 4):
+            table[byte, i] = conversions[(byte >> (i * 2)) & 3]
+    return table
+
+
+def decode_genotypes(packed, ind_count, table, out=None):
+    """Decode one or more variants worth of packed .bed bytes
+
+    :param packed: bytes or uint8 array, either (bytes_per_variant) or
+                   (variant_count, bytes_per_variant)
+    :param ind_count: Number of genotypes actually present for each variant
+    :param table: lookup table returned by build_decode_table
+    :param out: optional int8 buffer with at least as many rows as packed
+                and 4 * bytes_per_variant columns
+    :return: int8 array (ind_count) or (variant_count, ind_count)
+
+    When out is provided, the return value is a view into that buffer, so it
+    will be overwritten by the next call using the same buffer.
+    """
+    if not isinstance(packed, numpy.ndarray):
+        packed = numpy.frombuffer(packed, dtype=numpy.uint8)
+    shape = packed.shape
+    if out is None:
+        out = numpy.empty(shape + (4,), dtype=numpy.int8)
+    else:
+        out = out.reshape(-1)[0:packed.size * 4].reshape(shape + (4,))
+    numpy.take(table, packed, axis=0, out=out)
+
+    return out.reshape(shape[:-1] + (shape[-1] * 4,))[..., 0:ind_count]
+
+
+#: Magic number found in the first two bytes of every .bed file
+magic_number = 0x1b6c
+
+#: Number of bits set for each possible byte value
+popcount_table = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+
+
+def popcount(packed):
+    """Count the bits set within each row of packed bytes
+
+    :param packed: uint8 array (bytes) or (loci, bytes)
+    :return: total bits set across the last axis
+    """
+    if hasattr(numpy, "bitwise_count"):
+        bits = numpy.bitwise_count(packed)
+    else:
+        bits = numpy.take(popcount_table, packed)
+    return numpy.sum(bits, axis=-1, dtype=numpy.int64)
+
+
+def pack_codes(codes):
+    """Pack 2 bit codes into bytes using the .bed bit ordering
+
+    :param codes: array (samples) or (loci, samples) of values 0-3
+    :return: uint8 array (bytes) or (loci, bytes) with 4 codes per byte
+
+    Trailing slots in the final byte are left as 0.
+    """
+    codes = numpy.asarray(codes, dtype=numpy.uint8)
+    sample_count = codes.shape[-1]
+    byte_count = int((sample_count + 3) / 4)
+    padded = numpy.zeros(codes.shape[:-1] + (byte_count * 4,), dtype=numpy.uint8)
+    padded[..., 0:sample_count] = codes
+    padded = padded.reshape(codes.shape[:-1] + (byte_count, 4))
+    return (padded[..., 0] | (padded[..., 1] << 2) |
+            (padded[..., 2] << 4) | (padded[..., 3] << 6)).astype(numpy.uint8)
+
+
+#: Decodes bytes into the raw 2 bit codes rather than genotypes
+code_table = build_decode_table({0:0, 1:1, 2:2, 3:3})
+
+
+def transpose_packed(source, row_count, column_count, dest, memory_budget=1 << 28):
+    """Transpose a packed 2 bit matrix (such as individual major .bed data) \
+        in blocks of columns
+
+    :param source: uint8 array (row_count, bytes per row), may be a memmap
+    :param row_count: number of rows (codes) in source
+    :param column_count: number of codes per row in source
+    :param dest: writable uint8 array (column_count, bytes per column)
+    :param memory_budget: approximate number of bytes to be used at once
+    :return: None
+
+    Each block is a contiguous range of bytes from every row of source, which
+    is unpacked, transposed and packed back up as complete rows of dest.
+    """
+    # Each source byte expands to 4 codes per row, which are copied a couple
+    # more times while being transposed and packed
+    bytes_per_block = max(1, int(memory_budget / (max(1, row_count) * 4 * 3)))
+    total_bytes = int((column_count + 3) / 4)
+    for start in range(0, total_bytes, bytes_per_block):
+        stop = min(start + bytes_per_block, total_bytes)
+        first = start * 4
+        last = min(stop * 4, column_count)
+        codes = decode_genotypes(numpy.ascontiguousarray(source[:, start:stop]),
+                                 last - first, code_table)
+        dest[first:last] = pack_codes(codes.T)
+
+
+def count_genotypes(packed, keep_mask):
+    """Tally genotypes without decoding the packed .bed bytes
+
+    :param packed: uint8 array (bytes) or (loci, bytes) straight from the file
+    :param keep_mask: pack_codes(keep) where keep is 1 for each sample to be
+                      counted (this also ignores the padding at the end of
+                      each locus)
+    :return: int64 array (4) or (loci, 4) containing the number of
+             genotypes 0, 1, 2 and missing, in that order. These are the
+             values Parser.geno_conversions assigns to codes 11, 10, 00 and
+             01 respectively (genotype 0 is homozygous for the second allele
+             listed in the .bim file)
+
+    The low and high bits of each 2 bit code are pulled apart so that hets
+    (10), missing (01) and code 11 can each be counted with a single
+    popcount. Code 00 is whatever remains.
+    """
+    if not isinstance(packed, numpy.ndarray):
+        packed = numpy.frombuffer(packed, dtype=numpy.uint8)
+    lo = packed & keep_mask
+    hi = (packed >> 1) & keep_mask
+    code_10 = popcount(hi & ~lo)
+    code_01 = popcount(lo & ~hi)
+    code_11 = popcount(lo & hi)
+    code_00 = popcount(keep_mask) - code_10 - code_01 - code_11
+
+    return numpy.stack([code_11, code_10, code_00, code_01], axis=-1)
+
+
+def locus_range(chroms, positions, rsids):
+    """Identify the loci that can possibly pass the boundary check
+
+    :param chroms: integer chromosome codes for each locus
+    :param positions: position of each locus
+    :param rsids: sequence of RSIDs supporting index()
+    :return: (start, stop) indices into the marker arrays
+
+    This is only possible when the markers are sorted by chromosome and
+    position, otherwise the full range is returned. Loci within the range
+    are still tested against the boundary as usual.
+    """
+    start, stop = 0, chroms.shape[0]
+    if BoundaryCheck.chrom == -1 or stop == 0:
+        return start, stop
+
+    keys = (chroms.astype(numpy.int64) << 32) + positions
+    if not numpy.all(keys[1:] >= keys[:-1]):
+        return start, stop
+
+    boundary = DataParser.boundary
+    lower, upper = 0, numpy.iinfo(numpy.int32).max
+    bounds = getattr(boundary, "bounds", [])
+    if len(bounds) > 0:
+        lower = int(math.ceil(bounds[0]))
+        upper = int(math.floor(bounds[1]))
+    chrom = numpy.int64(BoundaryCheck.chrom) << 32
+    start = int(numpy.searchsorted(keys, chrom + lower, side="left"))
+    stop = int(numpy.searchsorted(keys, chrom + upper, side="right"))
+
+    # RSID ranges can narrow things down further
+    start_rs = getattr(boundary, "start_bounds", [])
+    if len(start_rs) > 0 and len(boundary.target_rs) == 0:
+        try:
+            first = min([rsids.index(x) for x in start_rs])
+            last = max([rsids.index(x) for x in boundary.end_bounds])
+            start = max(start, first)
+            stop = min(stop, last + 1)
+        except ValueError:
+            pass
+    return start, max(start, stop)
+
+
 class Parser(transposed_pedigree_parser.Parser):
+    #: Approximate number of bytes used for decoding blocks of loci at once
+    decode_buffer_size = 1 << 24
+
+    #: When true, the .bed file is memory mapped instead of read through
+    #: a file object, allowing random access and sharing of the OS page cache
+    use_memmap = False
+
+    #: When true, loci failing the MAF or missingness thresholds are
+    #: rejected using counts taken directly from the packed bytes, before
+    #: they are decoded. These counts don't consider phenotype missingness.
+    prefilter = False
 
+    #: When true, marker details from the .bim file are cached in a binary
+    #: sidecar, making subsequent loads much faster
+    cache_bim = False
+
+    #: Memory (in bytes) available when transposing individual major data
+    transpose_budget = 1 << 28
+
+    #: Directory used for the temporary locus major copy of individual
+    #: major data (None will use the system's default temp directory)
+    transpose_dir = None
 
     def __init__(self, fam, bim, bed):
         """Parse PLINK's binary pedigree files.
@@ -71,11 +279,20 @@ class Parser(transposed_pedigree_parser.Parser):
         #: Actual pedigree file being parsed (file object)
         self.genotype_file = None
 
-        #: Valid loci to be used for analysis
-        self.markers = None
+        #: Chromosome for each locus
+        self.chroms = None
+
+        #: BP position for each locus
+        self.positions = None
+
+        #: RSID for each locus
+        self.rsids = marker_table.StringTable()
 
         #: Alleles for each locus
-        self.alleles = []
+        self.alleles = marker_table.AlleleTable()
+
+        #: (chroms, positions, markers) from the last time markers was built
+        self.marker_cache = None
 
         #: Number of valid individuals
         self.ind_count = 0
@@ -94,6 +311,30 @@ class Parser(transposed_pedigree_parser.Parser):
                 1:DataParser.missing_storage
         }
 
+        #: Lookup table used to decode entire bytes at once
+        self.decode_table = build_decode_table(self.geno_conversions)
+
+        #: Reusable buffer for decoding the current locus
+        self.decode_buffer = None
+
+        #: Indices of the individuals that are not masked out
+        self.ind_index = None
+
+        #: Memory mapped view of the packed genotypes (loci x bytes_per_read)
+        self.packed_genotypes = None
+
+        #: Packed mask used for counting genotypes of unmasked individuals
+        self.keep_mask = None
+
+        #: Temporary locus major copy of individual major .bed files
+        self.transposed_file = None
+
+        #: Index of the first locus that can fall within the boundary
+        self.first_locus = 0
+
+        #: Index beyond the last locus that can fall within the boundary
+        self.last_locus = 0
+
         self.parser_name = bed
 
         self.alt_not_missing = None
@@ -101,6 +342,9 @@ class Parser(transposed_pedigree_parser.Parser):
     def __del__(self):
         if self.genotype_file is not None:
             self.genotype_file.close()
+        self.packed_genotypes = None
+        if self.transposed_file is not None and os.path.exists(self.transposed_file):
+            os.remove(self.transposed_file)
             
     def getnew(self):
         return Parser(self.fam_file, self.bim_file, self.bed_file)
@@ -175,30 +419,108 @@ class Parser(transposed_pedigree_parser.Parser):
 
         :param map3: When true, ignore the genetic distance column
         :return: None
+
+        Marker details are stored in columns: chroms and positions are numpy
+        arrays while rsids and alleles are compact string tables. When
+        cache_bim is true, these are written to (or restored from) a binary
+        sidecar next to the .bim file.
         """
         cols = [0, 1, 3, 4, 5]
+        column_count = 6
         if map3:
             cols = [0, 1, 2, 3, 4]
+            column_count = 5
         logging.info("Loading file: %s" % self.bim_file)
-        val = sys_call('wc -l %s' % (self.bim_file)).split()[0]
-        marker_count = int(val)
-        self.markers = numpy.zeros((marker_count, 2), dtype=int)
-        self.rsids = []
-        self.alleles = []
-
-        with open(self.bim_file) as file:
-            index = 0
-            for line in file:
-                if map3:
-                    chr, rsid, pos, al1, al2 = line.strip().split()
-                else:
-                    chr, rsid, gd, pos, al1, al2 = line.strip().split()
-                self.markers[index, 0] = int(chr)
-                self.markers[index, 1] = int(pos)
-                self.alleles.append([al2, al1])
-                self.rsids.append(rsid)
-                index += 1
-        self.locus_count = self.markers.shape[0]
+
+        if Parser.cache_bim and self.load_bim_cache(map3):
+            self.locus_count = self.chroms.shape[0]
+            return
+
+        chroms = [numpy.zeros(0, dtype=numpy.int16)]
+        positions = [numpy.zeros(0, dtype=numpy.int32)]
+        rsids = []
+        self.alleles = marker_table.AlleleTable()
+
+        for chr, rsid, pos, al1, al2 in marker_table.read_columns(self.bim_file,
+                                                                  column_count,
+                                                                  cols):
+            chroms.append(marker_table.chrom_codes(chr))
+            positions.append(pos.astype(numpy.int32))
+            rsids.append(marker_table.StringTable.from_list(list(rsid)))
+            self.alleles.append(self.alleles.encode(numpy.stack([al2, al1], axis=1)))
+
+        self.chroms = numpy.concatenate(chroms)
+        self.positions = numpy.concatenate(positions)
+        self.rsids = marker_table.StringTable.concatenate(rsids)
+        self.locus_count = self.chroms.shape[0]
+
+        if Parser.cache_bim:
+            self.write_bim_cache(map3)
+
+    @property
+    def bim_cache_file(self):
+        """Filename for the binary sidecar associated with the .bim file"""
+        return "%s.libgwas.npz" % (self.bim_file)
+
+    def bim_signature(self, map3):
+        """Details used to recognize a stale sidecar"""
+        stats = os.stat(self.bim_file)
+        return numpy.array([stats.st_size, stats.st_mtime_ns, int(map3)], dtype=numpy.int64)
+
+    def write_bim_cache(self, map3):
+        """Write the marker columns to the binary sidecar
+
+        :param map3: Indicates the format of the .bim file
+        :return: None
+        """
+        try:
+            with open(self.bim_cache_file, "wb") as file:
+                numpy.savez(file,
+                            signature=self.bim_signature(map3),
+                            chroms=self.chroms,
+                            positions=self.positions,
+                            rsid_blob=numpy.frombuffer(self.rsids.blob, dtype=numpy.uint8),
+                            rsid_offsets=self.rsids.offsets,
+                            allele_codes=self.alleles.codes,
+                            allele_values=numpy.array(self.alleles.values, dtype=str))
+        except IOError as e:
+            logging.warning("Unable to write marker cache, %s: %s" % (self.bim_cache_file, e))
+
+    def load_bim_cache(self, map3):
+        """Restore the marker columns from the binary sidecar
+
+        :param map3: Indicates the format of the .bim file
+        :return: True if the sidecar exists and is up to date
+        """
+        if not os.path.exists(self.bim_cache_file):
+            return False
+        with numpy.load(self.bim_cache_file) as cache:
+            if not numpy.array_equal(cache["signature"], self.bim_signature(map3)):
+                return False
+            self.chroms = cache["chroms"]
+            self.positions = cache["positions"]
+            self.rsids = marker_table.StringTable(cache["rsid_blob"].tobytes(),
+                                                  cache["rsid_offsets"])
+            self.alleles = marker_table.AlleleTable(cache["allele_codes"],
+                                                    list(cache["allele_values"]))
+        logging.info("Marker details restored from %s" % (self.bim_cache_file))
+        return True
+
+    @property
+    def markers(self):
+        """(locus count x 2) array containing chromosome and position
+
+        The array is built the first time it is requested and reused until
+        the marker columns are replaced.
+        """
+        if self.chroms is None:
+            return None
+        cache = self.marker_cache
+        if cache is None or cache[0] is not self.chroms or cache[1] is not self.positions:
+            cache = (self.chroms, self.positions,
+                     numpy.column_stack([self.chroms, self.positions]))
+            self.marker_cache = cache
+        return cache[2]
 
     def init_genotype_file(self):
         """ses the bed file and preps it for starting at the start of the \
@@ -222,19 +544,56 @@ class Parser(transposed_pedigree_parser.Parser):
 
         :param bytes: array of bytes pulled from the .bed file
 
-        :return: standard python list containing the genotype data
+        :return: int8 numpy array containing the genotype data
 
         Only ind_count genotypes will be returned (even if there are
         a handful of extra pairs present).
 
         """
-        genotypes = []
-        for b in bytes:
-            for i in range(0, 4):
-                v = ((b>>(i*2)) & 3)
-                genotypes.append(self.geno_conversions[v])
-        return genotypes[0:self.ind_count]
+        return decode_genotypes(bytes, self.ind_count, self.decode_table)
+
+    def read_header(self):
+        """Read the magic number and data format from the top of the .bed file
+
+        :return: (magic, data_format)
+        """
+        self.genotype_file.seek(0)
+        return struct.unpack("<HB", self.genotype_file.read(3))
+
+    def read_loci(self, start, stop):
+        """Pull the packed genotypes for a range of loci from the .bed file
+
+        :param start: index of the first locus
+        :param stop: index beyond the last locus
+        :return: uint8 array (stop-start, bytes_per_read)
+
+        When memory mapped, this is a zero copy view into the file.
+        """
+        if self.packed_genotypes is not None:
+            return self.packed_genotypes[start:stop]
+
+        self.genotype_file.seek(3 + start * self.bytes_per_read)
+        buffer = self.genotype_file.read((stop - start) * self.bytes_per_read)
+        return numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(-1, self.bytes_per_read)
+
+    def read_locus(self, index):
+        """Pull the packed genotypes for a single locus
 
+        :param index: index of the locus within the .bim file
+        :return: uint8 array (bytes_per_read)
+        """
+        return self.read_loci(index, index + 1)[0]
+
+    def locus_range(self):
+        """Identify the loci that can possibly pass the boundary check
+
+        :return: (start, stop) indices into the marker arrays
+
+        Because every locus occupies the same number of bytes, this allows
+        iteration to seek directly to the first relevant locus and to stop
+        once the last has been reached.
+        """
+        return locus_range(self.chroms, self.positions, self.rsids)
 
     def filter_missing(self):
         """Filter out individuals and SNPs that have too many missing to be \
@@ -249,46 +608,52 @@ class Parser(transposed_pedigree_parser.Parser):
             * locus_count
             * data_parser.boundary (adds loci with too much missingness)
         """
-        missing             = None
         locus_count         = 0
         logging.info("Sorting out missing data from genotype data")
-        #pdb.set_trace()
         # Filter out individuals according to missingness
-        self.genotype_file.seek(0)
         DataParser.boundary.beyond_upper_bound = False
-        
-        magic, data_format = struct.unpack("<HB", self.genotype_file.read(3))
 
-        if data_format != 1:
-            Exit(("This application is currently unable to read data formatted as " +
-                 "individual major. You must regenerate your data in SNP major"+
-                 " format. "))
+        magic, data_format = self.read_header()
 
         self.bytes_per_read = int(self.ind_count / 4)
         if self.ind_count % 4 > 0:
             self.bytes_per_read += 1
-        self.fmt_string = "<" + "B"*self.bytes_per_read
-        last_chr = -1
-        #pdb.set_trace()
-        for index in range(self.locus_count):
-            buffer = struct.unpack(self.fmt_string,
-                                   self.genotype_file.read(self.bytes_per_read))
 
-            chr, pos = self.markers[index]
-
-            rsid = self.rsids[index]
-
-            if DataParser.boundary.TestBoundary(chr, pos, rsid):
-                if last_chr != chr:
-                    sys.stdout.flush()
-                    last_chr = chr
-                genotypes = numpy.array(self.extract_genotypes(buffer),
-                                        dtype=numpy.int8)
-                locus_count += 1
-
-                if missing is None:
-                    missing = numpy.zeros(genotypes.shape[0], dtype='int8')
-                missing +=  0+(genotypes==DataParser.missing_storage)
+        if data_format == 0:
+            self.transpose_individual_major()
+        elif data_format != 1:
+            Exit("Unrecognized .bed format, %d, found in %s" % (data_format, self.bed_file))
+
+        self.decode_buffer = numpy.empty(self.bytes_per_read * 4, dtype=numpy.int8)
+        if Parser.use_memmap:
+            self.packed_genotypes = numpy.memmap(self.genotype_file.name, dtype=numpy.uint8,
+                                                 mode="r", offset=3,
+                                                 shape=(self.chroms.shape[0], self.bytes_per_read))
+        self.ind_index = numpy.flatnonzero(self.ind_mask == 0)
+        self.keep_mask = pack_codes(self.ind_mask == 0)
+
+        # Decode as many loci as the buffer size permits in a single pass
+        block_size = max(1, int(Parser.decode_buffer_size / (self.bytes_per_read * 4)))
+        block_size = min(block_size, max(1, self.locus_count))
+        block_buffer = numpy.empty((block_size, self.bytes_per_read * 4), dtype=numpy.int8)
+        missing = numpy.zeros(self.ind_count, dtype=numpy.int32)
+        self.first_locus, self.last_locus = self.locus_range()
+        for start in range(self.first_locus, self.last_locus, block_size):
+            stop = min(start + block_size, self.last_locus)
+            packed = self.read_loci(start, stop)
+
+            valid = numpy.zeros(stop - start, dtype=bool)
+            for index in range(start, stop):
+                valid[index - start] = DataParser.boundary.TestBoundary(int(self.chroms[index]),
+                                                                        int(self.positions[index]),
+                                                                        self.rsids[index])
+
+            valid_count = int(numpy.sum(valid))
+            if valid_count > 0:
+                genotypes = decode_genotypes(packed[valid], self.ind_count,
+                                             self.decode_table, out=block_buffer)
+                missing += numpy.sum(genotypes == DataParser.missing_storage, axis=0)
+                locus_count += valid_count
 
         max_missing = DataParser.ind_miss_tol * locus_count
         dropped_individuals = 0+(max_missing<missing)
@@ -306,12 +671,41 @@ class Parser(transposed_pedigree_parser.Parser):
         # individuals to consider for filtering on MAF
         dropped_snps = []
         DataParser.boundary.beyond_upper_bound = False
-        self.genotype_file.seek(0)
-        self.genotype_file.read(3)
+        self.genotype_file.seek(3 + self.first_locus * self.bytes_per_read)
         self.total_locus_count = self.locus_count
         self.locus_count = locus_count
 
 
+    def transpose_individual_major(self):
+        """Convert individual major data into a temporary locus major .bed \
+            file, which replaces the genotype_file for all further reads.
+
+        :return: None
+
+        Transposition is performed in blocks of loci limited by
+        transpose_budget, so the data never needs to fit into memory.
+        """
+        locus_count = self.chroms.shape[0]
+        logging.info("Transposing individual major data from %s" % (self.bed_file))
+        source = numpy.memmap(self.bed_file, dtype=numpy.uint8, mode="r", offset=3,
+                              shape=(self.ind_count, int((locus_count + 3) / 4)))
+        handle, self.transposed_file = tempfile.mkstemp(suffix=".bed",
+                                                         dir=Parser.transpose_dir)
+        with os.fdopen(handle, "wb") as file:
+            file.write(struct.pack("<HB", magic_number, 1))
+            file.truncate(3 + locus_count * self.bytes_per_read)
+        if locus_count > 0:
+            dest = numpy.memmap(self.transposed_file, dtype=numpy.uint8, mode="r+",
+                                offset=3, shape=(locus_count, self.bytes_per_read))
+            transpose_packed(source, self.ind_count, locus_count, dest,
+                             Parser.transpose_budget)
+            dest.flush()
+            del dest
+        del source
+
+        self.genotype_file.close()
+        self.genotype_file = open(self.transposed_file, "rb")
+
     def load_genotypes(self):
         """Prepares the file for genotype parsing.
 
@@ -333,24 +727,56 @@ class Parser(transposed_pedigree_parser.Parser):
 
         cur_idx = iteration.cur_idx
 
-        if cur_idx < self.total_locus_count:
-            buffer = struct.unpack(self.fmt_string,
-                                   self.genotype_file.read(self.bytes_per_read))
-            iteration.genotype_data = numpy.ma.MaskedArray(self.extract_genotypes(buffer),
-                                             self.ind_mask).compressed()
+        if cur_idx < self.last_locus:
+            if self.packed_genotypes is not None:
+                buffer = self.packed_genotypes[cur_idx]
+            else:
+                buffer = self.genotype_file.read(self.bytes_per_read)
 
-            iteration.chr, iteration.pos = self.markers[cur_idx]
+            iteration.chr = int(self.chroms[cur_idx])
+            iteration.pos = int(self.positions[cur_idx])
             iteration.rsid = self.rsids[cur_idx]
             iteration.alleles = self.alleles[cur_idx]
-            iteration.missing_genotypes = iteration.genotype_data == DataParser.missing_storage
-            return DataParser.boundary.TestBoundary(iteration.chr,
-                                                    iteration.pos,
-                                                    iteration.rsid)
+            if DataParser.boundary.TestBoundary(iteration.chr,
+                                                iteration.pos,
+                                                iteration.rsid):
+                if Parser.prefilter:
+                    if not self.prefilter_locus(iteration, buffer):
+                        return False
+                genotypes = decode_genotypes(buffer, self.ind_count,
+                                             self.decode_table, out=self.decode_buffer)
+                iteration.genotype_data = genotypes[self.ind_index]
+                iteration.missing_genotypes = iteration.genotype_data == DataParser.missing_storage
+                return True
+            return False
 
         else:
             raise StopIteration
         return False
 
+    def prefilter_locus(self, iteration, buffer):
+        """Count genotypes from the packed bytes and test them against the \
+            MAF and missingness thresholds.
+
+        :param iteration: ParsedLocus to be updated with the counts
+        :param buffer: packed bytes for the current locus
+        :return: True if the locus passes the filters
+        """
+        # Counts are ordered by genotype value (0, 1, 2), not by .bed code
+        geno_0, het, geno_2, missing = count_genotypes(buffer, self.keep_mask)
+        iteration.hetero_count = het
+        iteration.maj_allele_count = 2 * geno_0 + het
+        iteration.min_allele_count = 2 * geno_2 + het
+        iteration.missing_allele_count = 2 * missing
+
+        called = geno_0 + het + geno_2
+        if called == 0 or missing / float(called + missing) > DataParser.snp_miss_tol:
+            return False
+        maf = iteration.min_allele_count / (2.0 * called)
+        if maf > 0.5:
+            maf = 1.0 - maf
+        return DataParser.min_maf <= maf <= DataParser.max_maf
+
     def filter_genotypes(self, genotypes):
         plocus = AlleleCounts(genotypes)
         plocus.het_count = numpy.sum(genotypes==1)
@@ -369,10 +795,9 @@ class Parser(transposed_pedigree_parser.Parser):
         """
 
         DataParser.boundary.beyond_upper_bound = False
-        self.genotype_file.seek(0)
-        self.genotype_file.read(3)
+        self.genotype_file.seek(3 + self.first_locus * self.bytes_per_read)
 
-        return ParsedLocus(self)
+        return ParsedLocus(self, self.first_locus - 1)
 
 
     def get_effa_freq(self, genotypes):
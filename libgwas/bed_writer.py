@@ -0,0 +1,192 @@
+import struct
+import logging
+import numpy
+from . import bed_parser
+from .data_parser import DataParser
+from .exceptions import TooMuchMissing
+from .exceptions import InvalidFrequency
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+#: .bed code for each genotype (count of the first allele in the .bim file)
+#: 2 => 00, 1 => 10 and 0 => 11. Missing is 01
+genotype_codes = numpy.array([3, 2, 0], dtype=numpy.uint8)
+missing_code = 1
+
+
+class Writer(object):
+    """Write the loci from any parser to a locus major PLINK fileset
+
+    Everything that the parser's iteration produces is written, so the
+    current boundary, individual exclusions and individual missingness
+    (alt_not_missing) are all respected. Loci failing the MAF and SNP
+    missingness thresholds are skipped.
+
+    Genotypes are expected to count the second of the locus' alleles, as
+    they do for the default genotype extraction. Sources producing dosages
+    (1 value per sample) or genotype probabilities (3 values per sample)
+    are converted to hard calls, according to hard_call_threshold.
+    """
+
+    #: Dosages further than this from the nearest genotype (or probabilities
+    #: whose largest value is below 1 - hard_call_threshold) are written
+    #: as missing
+    hard_call_threshold = 0.1
+
+    #: Approximate number of bytes of genotype data buffered before writing
+    buffer_size = 1 << 24
+
+    def __init__(self, prefix):
+        """
+        :param prefix: filename prefix, .bed, .bim and .fam will be added
+        """
+        self.bed_file = "%s.bed" % (prefix)
+        self.bim_file = "%s.bim" % (prefix)
+        self.fam_file = "%s.fam" % (prefix)
+
+        #: Number of loci written
+        self.locus_count = 0
+
+    @staticmethod
+    def hard_calls(genotype_data):
+        """Convert a locus' genotype data into genotypes (0, 1, 2) with \
+            missing_storage representing missing calls
+
+        :param genotype_data: genotypes, dosages or (n x 3) probabilities
+        :return: int8 array of genotypes
+        """
+        genotype_data = numpy.asarray(genotype_data)
+        threshold = Writer.hard_call_threshold
+        if genotype_data.ndim == 2:
+            calls = numpy.argmax(genotype_data, axis=1).astype(numpy.int8)
+            confident = numpy.max(genotype_data, axis=1) >= (1.0 - threshold)
+            calls[~confident] = DataParser.missing_storage
+            return calls
+
+        if genotype_data.dtype.kind == 'f':
+            rounded = numpy.rint(genotype_data)
+            confident = (numpy.abs(genotype_data - rounded) <= threshold) & \
+                        (rounded >= 0) & (rounded <= 2)
+            calls = numpy.full(genotype_data.shape, DataParser.missing_storage,
+                               dtype=numpy.int8)
+            calls[confident] = rounded[confident]
+            return calls
+
+        calls = genotype_data.astype(numpy.int8)
+        calls[(calls < 0) | (calls > 2)] = DataParser.missing_storage
+        return calls
+
+    @staticmethod
+    def sample_rows(parser, pheno_covar, sample_count):
+        """Build the .fam contents for the samples found in the parser's \
+            genotype data
+
+        :param parser: source of the genotypes
+        :param pheno_covar: PhenoCovar populated by the parser
+        :param sample_count: number of samples present in the genotype data
+        :return: list of 6 column rows
+        """
+        families = getattr(parser, "families", [])
+        if len(families) == sample_count:
+            return [(list(words) + ["0"] * 6)[0:6] for words in families]
+
+        phenotypes = []
+        if len(pheno_covar.phenotype_data) > 0:
+            phenotypes = pheno_covar.phenotype_data[0]
+        rows = [None] * sample_count
+        for sample_id, index in pheno_covar.pedigree_data.items():
+            if index < sample_count:
+                ids = sample_id.split(":")
+                if len(ids) < 2:
+                    ids = [ids[0], ids[0]]
+                pheno = "-9"
+                if index < len(phenotypes):
+                    pheno = str(phenotypes[index])
+                rows[index] = [ids[0], ids[1], "0", "0", "0", pheno]
+        return rows
+
+    def write(self, parser, pheno_covar):
+        """Write every valid locus from parser
+
+        :param parser: DataParser whose genotypes have been loaded
+        :param pheno_covar: PhenoCovar populated by the parser
+        :return: number of loci written
+        """
+        logging.info("Writing %s" % (self.bed_file))
+        keep = parser.alt_not_missing
+        bed = None
+        bim = None
+        block = None
+        bim_lines = []
+        block_index = 0
+        self.locus_count = 0
+
+        try:
+            bed = open(self.bed_file, "wb")
+            bim = open(self.bim_file, "w")
+            bed.write(struct.pack("<HB", bed_parser.magic_number, 1))
+
+            for locus in parser:
+                sample_count = locus.genotype_data.shape[0]
+                if keep is None:
+                    keep = numpy.ones(sample_count, dtype=bool)
+                try:
+                    locus.get_genotype_data(numpy.ones(sample_count, dtype=bool))
+                except (TooMuchMissing, InvalidFrequency):
+                    continue
+
+                if block is None:
+                    samples = self.sample_rows(parser, pheno_covar, sample_count)
+                    samples = [x for x, k in zip(samples, keep) if k]
+                    bytes_per_locus = int((len(samples) + 3) / 4)
+                    block = numpy.zeros((max(1, int(Writer.buffer_size / max(1, bytes_per_locus))),
+                                         bytes_per_locus), dtype=numpy.uint8)
+
+                calls = self.hard_calls(locus.genotype_data)[keep]
+                codes = numpy.full(calls.shape, missing_code, dtype=numpy.uint8)
+                valid = calls != DataParser.missing_storage
+                codes[valid] = genotype_codes[calls[valid]]
+                block[block_index] = bed_parser.pack_codes(codes)
+                bim_lines.append("%s\t%s\t0\t%s\t%s\t%s\n" % (locus.chr, locus.rsid,
+                                                              locus.pos,
+                                                              locus.alleles[1],
+                                                              locus.alleles[0]))
+                block_index += 1
+                self.locus_count += 1
+
+                if block_index == block.shape[0]:
+                    bed.write(block.tobytes())
+                    bim.write("".join(bim_lines))
+                    block_index = 0
+                    bim_lines = []
+
+            if block_index > 0:
+                bed.write(block[0:block_index].tobytes())
+                bim.write("".join(bim_lines))
+        finally:
+            if bed is not None:
+                bed.close()
+            if bim is not None:
+                bim.close()
+
+        if block is None:
+            samples = []
+        with open(self.fam_file, "w") as fam:
+            for row in samples:
+                fam.write(" ".join([str(x) for x in row]) + "\n")
+        return self.locus_count
@@ -0,0 +1,370 @@
+import struct
+import threading
+import zlib
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from .exceptions import MalformedInputFile
+from .exceptions import TooManyAlleles
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Native decoding of BGEN v1.2 (layout 2) files.
+
+Only the common case is handled: uncompressed or zlib compressed blocks
+holding diploid, biallelic probabilities. The variant blocks are located
+by a single pass over the variant headers, so no metadata file is needed,
+and the probability bits are unpacked with numpy. Files using layout 1 or
+zstd compression should be read with bgen_reader instead (see supported).
+"""
+
+#: Compression codes found in bits 0-1 of the header flags
+no_compression = 0
+zlib_compression = 1
+zstd_compression = 2
+
+#: Layout 2 is identified by bits 2-5 of the header flags
+layout_2 = 2
+
+#: Flag indicating that the sample identifier block is present
+sample_ids_flag = 1 << 31
+
+_missing_ploidy = 0x80
+
+
+def read_header(file):
+    """Read the header block of a BGEN file
+
+    :param file: binary file positioned at the start of the file
+    :return: (first variant offset, variant count, sample count, flags)
+    """
+    header = file.read(20)
+    if len(header) < 20:
+        raise MalformedInputFile("Truncated BGEN header found in %s" % (file.name))
+    offset, header_length, variant_count, sample_count = struct.unpack("<IIII", header[0:16])
+    if header[16:20] not in (b"bgen", b"\0\0\0\0"):
+        raise MalformedInputFile("%s is not a BGEN file" % (file.name))
+    file.seek(header_length)
+    flags = struct.unpack("<I", file.read(4))[0]
+
+    # The offset doesn't include the four bytes used to store it
+    return offset + 4, variant_count, sample_count, flags
+
+
+def supported(filename):
+    """Return True if filename can be read by the native decoder"""
+    with open(filename, "rb") as file:
+        try:
+            offset, variant_count, sample_count, flags = read_header(file)
+        except (MalformedInputFile, struct.error):
+            return False
+    return (flags >> 2) & 0xf == layout_2 and \
+        flags & 3 in (no_compression, zlib_compression)
+
+
+def unpack_bits(data, offset, count, bits):
+    """Unpack count unsigned integers packed bits wide (least significant \
+        bit first) starting at offset
+
+    :param data: buffer containing the packed values
+    :param offset: byte offset of the first value
+    :param count: number of values
+    :param bits: width of each value (1-32)
+    :return: numpy array of the values
+    """
+    if bits == 8:
+        return numpy.frombuffer(data, dtype=numpy.uint8, count=count, offset=offset)
+    if bits == 16:
+        return numpy.frombuffer(data, dtype="<u2", count=count, offset=offset)
+    if bits == 32:
+        return numpy.frombuffer(data, dtype="<u4", count=count, offset=offset)
+
+    byte_count = (count * bits + 7) >> 3
+    packed = numpy.frombuffer(data, dtype=numpy.uint8, count=byte_count, offset=offset)
+    unpacked = numpy.unpackbits(packed, bitorder="little")[0:count * bits]
+    return unpacked.reshape(count, bits).dot(1 << numpy.arange(bits, dtype=numpy.uint64))
+
+
+def diploid_biallelic(data):
+    """Return True if the uncompressed genotype data for a variant can be \
+        decoded by decode_probabilities"""
+    sample_count, allele_count, min_ploidy, max_ploidy = struct.unpack_from("<IHBB", data, 0)
+    return allele_count == 2 and min_ploidy == 2 and max_ploidy == 2
+
+
+def decode_probabilities(data, sample_index=None, dosages=False):
+    """Decode the uncompressed genotype data for a single variant
+
+    :param data: uncompressed layout 2 probability data
+    :param sample_index: indices of the samples to be returned (None for all)
+    :param dosages: return additive dosages rather than probabilities
+    :return: (values, missing) where values is (samples x 3) float32
+             probabilities (AA, AB, BB) or (samples) float32 dosages of the
+             second allele and missing is a boolean array. Missing samples
+             have values of nan.
+    """
+    sample_count, allele_count, min_ploidy, max_ploidy = struct.unpack_from("<IHBB", data, 0)
+    if allele_count != 2:
+        raise TooManyAlleles(prefix="Native BGEN decoding requires biallelic variants: ")
+    if min_ploidy != 2 or max_ploidy != 2:
+        raise MalformedInputFile("Native BGEN decoding requires diploid samples")
+    ploidy = numpy.frombuffer(data, dtype=numpy.uint8, count=sample_count, offset=8)
+    phased, bits = struct.unpack_from("<BB", data, 8 + sample_count)
+
+    # Each sample has two values: P(AA) and P(AB) for unphased data or
+    # P(hap = A) for each of the two haplotypes for phased data
+    values = unpack_bits(data, 10 + sample_count, sample_count * 2, bits)
+    values = values.reshape(sample_count, 2)
+    if sample_index is not None:
+        values = values[sample_index]
+        ploidy = ploidy[sample_index]
+    values = values.astype(numpy.float32) * numpy.float32(1.0 / ((1 << bits) - 1))
+    missing = (ploidy & _missing_ploidy) != 0
+
+    if phased:
+        first = values[:, 0]
+        second = values[:, 1]
+        if dosages:
+            result = 2.0 - first - second
+        else:
+            result = numpy.empty((values.shape[0], 3), dtype=numpy.float32)
+            result[:, 0] = first * second
+            result[:, 2] = (1.0 - first) * (1.0 - second)
+            result[:, 1] = 1.0 - result[:, 0] - result[:, 2]
+    elif dosages:
+        result = 2.0 - 2.0 * values[:, 0] - values[:, 1]
+    else:
+        result = numpy.empty((values.shape[0], 3), dtype=numpy.float32)
+        result[:, 0:2] = values
+        result[:, 2] = 1.0 - values[:, 0] - values[:, 1]
+
+    result[missing] = numpy.nan
+    return result, missing
+
+
+def read_string(data, offset, length_size=2):
+    """Read a length prefixed string
+
+    :return: (string, offset following the string)
+    """
+    length_format = "<H"
+    if length_size == 4:
+        length_format = "<I"
+    length = struct.unpack_from(length_format, data, offset)[0]
+    offset += length_size
+    if offset + length > len(data):
+        raise struct.error("String extends beyond the buffer")
+    return data[offset:offset + length].decode(), offset + length
+
+
+def parse_variant_header(data):
+    """Parse the identifying data at the start of a layout 2 variant block
+
+    :param data: bytes starting at the beginning of the variant block
+    :return: (id, rsid, chromosome, position, alleles, offset of the
+             genotype block within data)
+
+    struct.error is raised if data doesn't contain the entire header
+    """
+    variant_id, offset = read_string(data, 0)
+    rsid, offset = read_string(data, offset)
+    chromosome, offset = read_string(data, offset)
+    position, allele_count = struct.unpack_from("<IH", data, offset)
+    offset += 6
+    alleles = []
+    for index in range(allele_count):
+        allele, offset = read_string(data, offset, 4)
+        alleles.append(allele)
+    # Make sure the genotype block's length is present as well
+    struct.unpack_from("<I", data, offset)
+    return variant_id, rsid, chromosome, position, alleles, offset
+
+
+class BgenFile(object):
+    """Variant index and genotype access for a single layout 2 BGEN file.
+
+    The members used by bgen_parser mirror those of bgen_reader.open_bgen,
+    so that either can be used to back the parser.
+    """
+
+    def __init__(self, filename, sample_filename=None):
+        self.filename = filename
+        self.file = open(filename, "rb")
+
+        #: Serializes access to the file so blocks can be read from several threads
+        self.lock = threading.Lock()
+        first_variant, self.nvariants, self.nsamples, flags = read_header(self.file)
+
+        #: Compression used by the genotype blocks
+        self.compression = flags & 3
+        if (flags >> 2) & 0xf != layout_2 or self.compression == zstd_compression:
+            raise MalformedInputFile("%s isn't a zlib compressed layout 2 BGEN file" %
+                                     (filename))
+
+        self.samples = None
+        if flags & sample_ids_flag:
+            self.samples = self.read_samples()
+        if sample_filename is not None:
+            self.samples = self.load_sample_file(sample_filename)
+        if self.samples is None:
+            self.samples = numpy.array(["sample_%d" % (x) for x in range(self.nsamples)])
+        self.shape = (self.nsamples, self.nvariants, 3)
+
+        self.build_index(first_variant)
+
+        #: Variants that can't be decoded natively, which are reported as
+        #: missing by read_block. Those with ploidy other than 2 are only
+        #: discovered once their data has been read
+        self.skipped = self.nalleles != 2
+
+    def read_samples(self):
+        """Read the sample identifier block which follows the header"""
+        block_length, sample_count = struct.unpack("<II", self.file.read(8))
+        data = self.file.read(block_length - 8)
+        samples = []
+        offset = 0
+        for index in range(sample_count):
+            sample, offset = read_string(data, offset)
+            samples.append(sample)
+        return numpy.array(samples)
+
+    def load_sample_file(self, sample_filename):
+        """Sample IDs from the first column of a .sample file"""
+        with open(sample_filename) as file:
+            # Skip the header and the column type lines
+            lines = file.read().splitlines()[2:]
+        return numpy.array([x.split()[0] for x in lines if x.strip() != ""])
+
+    def build_index(self, first_variant):
+        """Walk the variant headers recording the location of each variant's \
+            genotype data along with its identifying details
+
+        :param first_variant: file offset of the first variant block
+        :return: None
+        """
+        #: File offset of each variant's genotype block (starting with its length)
+        self.data_offsets = numpy.zeros(self.nvariants, dtype=numpy.int64)
+
+        #: Size of each genotype block, not including the 4 byte length
+        self.data_lengths = numpy.zeros(self.nvariants, dtype=numpy.int64)
+
+        ids = []
+        rsids = []
+        chromosomes = []
+        allele_ids = []
+        self.positions = numpy.zeros(self.nvariants, dtype=numpy.uint32)
+        self.nalleles = numpy.zeros(self.nvariants, dtype=numpy.uint16)
+
+        offset = first_variant
+        for index in range(self.nvariants):
+            self.file.seek(offset)
+            # The headers are small, so we'll read enough for most variants
+            # and only go back for more if the alleles are unusually long
+            data = self.file.read(1024)
+            try:
+                header = parse_variant_header(data)
+            except (struct.error, UnicodeDecodeError):
+                self.file.seek(offset)
+                data = self.file.read(1 << 20)
+                try:
+                    header = parse_variant_header(data)
+                except (struct.error, UnicodeDecodeError):
+                    raise MalformedInputFile("Invalid variant header (%d) found in %s" %
+                                             (index, self.filename))
+            variant_id, rsid, chromosome, self.positions[index], alleles, position = header
+
+            ids.append(variant_id)
+            rsids.append(rsid)
+            chromosomes.append(chromosome)
+            allele_ids.append(",".join(alleles))
+            self.nalleles[index] = len(alleles)
+            self.data_offsets[index] = offset + position
+            self.data_lengths[index] = struct.unpack_from("<I", data, position)[0]
+            offset = self.data_offsets[index] + 4 + self.data_lengths[index]
+
+        self.ids = numpy.array(ids)
+        self.rsids = numpy.array(rsids)
+        self.chromosomes = numpy.array(chromosomes)
+        self.allele_ids = numpy.array(allele_ids)
+
+    def genotype_data(self, buffer, offset, index):
+        """Uncompressed genotype data for a variant
+
+        :param buffer: bytes read from the file
+        :param offset: location of the genotype block within the buffer
+        :param index: variant index (for error reporting)
+        :return: uncompressed probability data
+        """
+        length = int(self.data_lengths[index])
+        if self.compression == no_compression:
+            return buffer[offset + 4:offset + 4 + length]
+        uncompressed_length = struct.unpack_from("<I", buffer, offset + 4)[0]
+        data = zlib.decompress(buffer[offset + 8:offset + 4 + length])
+        if len(data) != uncompressed_length:
+            raise MalformedInputFile("Invalid genotype block (%d) found in %s" %
+                                     (index, self.filename))
+        return data
+
+    def read_block(self, start, stop, sample_index=None, dosages=False, num_threads=None):
+        """Decode consecutive variants using a single read from the file
+
+        :param start: index of the first variant
+        :param stop: index following the last variant
+        :param sample_index: indices of the samples to be returned (None for all)
+        :param dosages: return dosages rather than probabilities
+        :param num_threads: number of threads used to decompress the variants
+        :return: (values, missing) where values is (variants x samples x 3)
+                 probabilities (or variants x samples dosages) and missing is
+                 (variants x samples)
+
+        Variants that aren't diploid and biallelic are flagged in skipped and
+        returned as entirely missing, rather than failing the whole block.
+        """
+        first = int(self.data_offsets[start])
+        last = int(self.data_offsets[stop - 1] + 4 + self.data_lengths[stop - 1])
+        with self.lock:
+            self.file.seek(first)
+            buffer = self.file.read(last - first)
+        if len(buffer) != last - first:
+            raise MalformedInputFile("Truncated BGEN file, %s" % (self.filename))
+
+        sample_count = self.nsamples
+        if sample_index is not None:
+            sample_count = len(sample_index)
+        shape = (sample_count,) if dosages else (sample_count, 3)
+
+        def decode(index):
+            if not self.skipped[index]:
+                data = self.genotype_data(buffer, int(self.data_offsets[index]) - first, index)
+                if diploid_biallelic(data):
+                    return decode_probabilities(data, sample_index, dosages)
+                self.skipped[index] = True
+            return (numpy.full(shape, numpy.nan, dtype=numpy.float32),
+                    numpy.ones(sample_count, dtype=bool))
+
+        if num_threads is not None and num_threads > 1 and stop - start > 1:
+            # zlib releases the GIL, so decompression runs concurrently
+            with ThreadPoolExecutor(num_threads) as pool:
+                decoded = list(pool.map(decode, range(start, stop)))
+        else:
+            decoded = [decode(index) for index in range(start, stop)]
+        values = numpy.stack([x[0] for x in decoded])
+        missing = numpy.stack([x[1] for x in decoded])
+        return values, missing
+
+    def close(self):
+        self.file.close()
@@ -9,13 +9,22 @@ from .impute_parser import gen_dosage_extraction
 # from exceptions import StopIteration
 import numpy
 import os
+import collections
+import hashlib
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from . import ExitIf
 from . import BuildReportLine
 #from . import timer
 import sys
 import bgen_reader
 from . import impute_parser
-from .locus import Locus
+from . import bgen_decoder
+from . import marker_table
+from .bed_parser import locus_range
+from .exceptions import InvalidChromosome
+from .exceptions import MalformedInputFile
 import libgwas
 import logging
 
@@ -40,6 +49,91 @@ __license__ = "GPL3.0"
 
 encoding = impute_parser.Encoding.Additive
 
+#: Chromosome code for variants whose chromosome couldn't be recognized. These
+#: never pass the boundary check
+invalid_chrom = -2
+
+
+def chromosome_codes(names, default=-1):
+    """Convert the chromosome names found in a bgen file into integer codes
+
+    :param names: numpy array of chromosome names
+    :param default: code used for blank names (-1 indicates none)
+    :return: int16 array of chromosome codes
+
+    Each distinct name is only converted once.
+    """
+    unique, inverse = numpy.unique(names, return_inverse=True)
+    codes = numpy.full(unique.shape[0], invalid_chrom, dtype=numpy.int16)
+    for index, name in enumerate(unique):
+        name = str(name).strip()
+        if name == "":
+            if default != -1:
+                codes[index] = default
+        else:
+            try:
+                codes[index] = marker_table.chrom_code(name)
+            except InvalidChromosome:
+                pass
+    return codes[inverse.reshape(-1)]
+
+
+def info_scores(probs):
+    """Calculate IMPUTE's INFO measure for a block of variants
+
+    :param probs: genotype probabilities (variants x samples x 3). Missing
+                  samples are expected to be nan
+    :return: float64 array (variants)
+
+    Variants whose expected allele frequency is 0 or 1 are given an INFO of
+    1.0, as IMPUTE does. Those without any observed samples are given 0.0.
+    """
+    expected = probs[:, :, 1] + 2 * probs[:, :, 2]
+    observed = ~numpy.isnan(expected)
+    sample_count = numpy.sum(observed, axis=1)
+    variance = probs[:, :, 1] + 4 * probs[:, :, 2] - expected * expected
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        theta = numpy.nansum(expected, axis=1, dtype=numpy.float64) / (2 * sample_count)
+        info = 1.0 - numpy.nansum(variance, axis=1, dtype=numpy.float64) / \
+            (2 * sample_count * theta * (1.0 - theta))
+    info[(theta <= 0.0) | (theta >= 1.0)] = 1.0
+    info[sample_count == 0] = 0.0
+    return info
+
+
+def load_info_scores(filename):
+    """Read the INFO (or R2) column from an info file with one line per \
+        variant in the same order as the bgen file
+
+    :param filename: whitespace delimited file with a header naming the
+                     columns. IMPUTE's info, Minimac's Rsq and r2 are
+                     recognized
+    :return: float64 array with NaN for missing (NA, - or .) scores
+    """
+    with open(filename) as file:
+        header = [x.lower() for x in file.readline().split()]
+        columns = [x for x in header if x in ("info", "rsq", "r2")]
+        if len(columns) == 0:
+            raise MalformedInputFile("No info, rsq or r2 column found in %s" % (filename))
+        scores = numpy.loadtxt(file, dtype=str, usecols=header.index(columns[0]), ndmin=1)
+    scores[numpy.isin(scores, ["NA", "-", "."])] = "nan"
+    return scores.astype(numpy.float64)
+
+
+def variant_rsids(ids):
+    """Pull the RS ID out of compound variant IDs such as 1:1234:rs5678_A_G
+
+    :param ids: numpy array of variant IDs
+    :return: list of RSIDs (IDs without an rs component are left as is)
+    """
+    rsids = ids.tolist()
+    for index in numpy.flatnonzero(numpy.char.find(ids, ":") >= 0):
+        for component in rsids[index].split(":"):
+            if component[0:2] == "rs":
+                rsids[index] = component
+    return rsids
+
+
 class Parser(DataParser):
     """Parse bgen formatted data
 
@@ -58,24 +152,61 @@ class Parser(DataParser):
     # chromosome was specified by the application
     default_chromosome = -1
 
-    def __init__(self, bgen_filename, sample_filename=None, meta_filename=None):
+    #: Number of consecutive variants fetched from the bgen file by each
+    #: read. Larger blocks amortize bgen_reader's per call overhead
+    block_size = 64
+
+    #: Number of decoded blocks held at once, so that each variant is only
+    #: decompressed a single time even when it is requested more than once
+    buffered_blocks = 2
+
+    #: Number of threads bgen_reader uses to decode each block (None lets
+    #: bgen_reader decide)
+    thread_count = None
+
+    #: Number of threads used to count each sample's missing genotypes
+    missing_threads = min(4, os.cpu_count() or 1)
+
+    #: When true, the per sample missing counts are saved alongside the bgen
+    #: file and reused by later runs considering the same variants
+    cache_missingness = False
+
+    #: Number of variants between progress reports while iterating
+    report_interval = 10000
+
+    #: Use the native layout 2 decoder (bgen_decoder) rather than bgen_reader
+    #: whenever the file permits. This avoids bgen_reader's metadata file
+    native_decoder = False
+
+    def __init__(self, bgen_filename, sample_filename=None, meta_filename=None,
+                 info_filename=None):
         """Support is present only for a single .bgen file (and possibly corresponding sample file)
 
         If sample file is not present, bgen file should have sample IDs baked into
         (which is part of the format).
 
         Currently, support for the metadata doesn't exist, but files are present
-        as placeholders. """
+        as placeholders.
+
+        If info_filename is provided, INFO scores are taken from it (see
+        load_info_scores). Otherwise, they are calculated from the
+        probabilities as each block of variants is decoded."""
         self.bgen_filename = bgen_filename
         self.sample_filename = sample_filename
         self.meta_filename = meta_filename
+        self.info_filename = info_filename
+
+        #: INFO scores loaded from info_filename (None if calculated)
+        self.info = None
         self.ind_mask = None
         self.geno_mask = None       # this will be 3x in order to permit masking of rows within the 3xN vector of gt probs
         self.ind_count = -1
         self.bgen_idx = -1
         self.bgen_start_idx = 0     # We'll mark this for the first locus to be analyzed
+        self.bgen_stop_idx = 0      # and the variant following the last
 
         self.bgen = None            # This is the buffer where we'll store the output from the current file
+        self.native = False         # True when self.bgen is a bgen_decoder.BgenFile
         #self.markers_raw = None     # raw marker details in DataFrame format
         # We don't want to bother checking for this until we know which subjects
         # to exclude
@@ -83,12 +214,36 @@ class Parser(DataParser):
         self.sample_ids = None
         self.alt_not_missing = None
 
+        #: Marker details for each variant, see load_markers
+        self.chroms = None
+        self.positions = None
+        self.rsids = None
+        self.alleles = None
+
+        #: Recently decoded blocks: (start, stop, probabilities, missing)
+        #: with the masked samples already removed
+        self.blocks = collections.deque(maxlen=Parser.buffered_blocks)
+
+        #: bgen_reader objects used by the missingness threads (one per thread)
+        self.thread_readers = threading.local()
+
+        #: Every reader opened by thread_reader, so they can be closed
+        self.opened_readers = []
+
         ExitIf("bgen file not found, %s" % (self.bgen_filename),
                 not os.path.exists(self.bgen_filename))
         if self.sample_filename is not None:
             ExitIf("Sample file, %s, not found. " % (self.sample_filename),
                    not os.path.exists(self.sample_filename))
+        if self.info_filename is not None:
+            ExitIf("Info file, %s, not found. " % (self.info_filename),
+                   not os.path.exists(self.info_filename))
         self.open_bgen()
+        if self.info_filename is not None:
+            self.info = load_info_scores(self.info_filename)
+            ExitIf("Info file, %s, has %d entries, but the bgen file has %d variants" %
+                   (self.info_filename, self.info.shape[0], self.bgen.nvariants),
+                   self.info.shape[0] != self.bgen.nvariants)
 
 
     def ReportConfiguration(self):
@@ -98,6 +253,9 @@ class Parser(DataParser):
             log.info(BuildReportLine("SAMPLE FILE", self.sample_filename))
         if self.meta_filename is not None:
             log.info(BuildReportLine("META FILE", self.meta_filename))
+        if self.info_filename is not None:
+            log.info(BuildReportLine("INFO FILE", self.info_filename))
+        log.info(BuildReportLine("INFO-THRESH", Parser.info_threshold))
 
 
     def load_family_details(self, pheno_covar):
@@ -166,6 +324,7 @@ class Parser(DataParser):
 
         self.ind_mask = numpy.array(mask_components, dtype=numpy.int8)
         self.geno_mask = self.ind_mask.reshape(self.ind_mask.shape[0], 1).repeat(3, axis=1)
+        self.blocks.clear()
 
         self.ind_count = self.ind_mask.shape[0]
         pheno_covar.freeze_subjects()
@@ -177,40 +336,81 @@ class Parser(DataParser):
             #                                metafile_filepath=None,
             #                                  samples_filepath=self.sample_filename,
             #                                  verbose=True)
-            self.bgen = bgen_reader.open_bgen(self.bgen_filename,
-                                              samples_filepath=self.sample_filename,
-                                              verbose=True)
+            self.native = Parser.native_decoder and bgen_decoder.supported(self.bgen_filename)
+            if self.native:
+                self.bgen = bgen_decoder.BgenFile(self.bgen_filename, self.sample_filename)
+            else:
+                self.bgen = bgen_reader.open_bgen(self.bgen_filename,
+                                                  samples_filepath=self.sample_filename,
+                                                  verbose=True)
             #self.markers_raw = self.bgen['variants'].compute()
+            self.load_markers()
             libgwas.timer.report_period("Marker data loaded: %d variants found " % (self.bgen.nvariants))
         self.bgen_idx = self.bgen_start_idx
 
-    def getLocusFromBgen(self, index):
-        l = Locus()
-        l.chr = self.bgen.chromosomes[index].lstrip("0")
-        if l.chr.strip() == "" and Parser.default_chromosome != -1:
-            l.chr = Parser.default_chromosome
-
-        l.pos = self.bgen.positions[index]
-        l.alleles = self.bgen.allele_ids[index].split(",")
-        l.rsid = self.bgen.ids[index]
-
-        for component in l.rsid.split(":"):
-            if component[0:3] == 'rs':
-                l.rsid = component
-        l.cur_idx = index
-        l.nalleles = self.bgen.nalleles
+    def load_markers(self):
+        """Convert the variant details into arrays once, rather than \
+            reworking the strings for each locus during iteration
 
-        return l
+        :return: None
+        """
+        self.chroms = chromosome_codes(self.bgen.chromosomes, Parser.default_chromosome)
+        self.positions = numpy.asarray(self.bgen.positions, dtype=numpy.int64)
+        self.rsids = marker_table.StringTable.from_list(variant_rsids(self.bgen.ids))
+
+        # Only the first two alleles are of interest: (first, ',', remainder)
+        alleles = numpy.char.partition(numpy.asarray(self.bgen.allele_ids, dtype=str), ",")
+        self.alleles = alleles[:, [0, 2]]
+        self.bgen_stop_idx = self.bgen.nvariants
+
+    def read_block(self, start):
+        """Decode a block of consecutive variants starting at start
+
+        :param start: index of the first variant in the block
+        :return: (start, stop, probabilities, missing, info) where
+                 probabilities is (variants x samples x 3) and missing is
+                 (variants x samples), both limited to the unmasked samples
+        """
+        stop = min(start + max(1, Parser.block_size), self.bgen.nvariants)
+        keep = numpy.flatnonzero(self.ind_mask == 0)
+        if self.native:
+            # The masked samples are dropped while the bits are unpacked
+            probs, missing = self.bgen.read_block(start, stop, keep,
+                                                  num_threads=Parser.thread_count)
+        else:
+            probs, missing = self.bgen.read(slice(start, stop), return_missings=True,
+                                            num_threads=Parser.thread_count)
+            # The conversion to float32 happens as part of the copy
+            probs = numpy.ascontiguousarray(probs[keep, :, 0:3].transpose(1, 0, 2),
+                                            dtype=numpy.float32)
+            missing = numpy.ascontiguousarray(missing[keep].T)
+        block = (start, stop, probs, missing, self.block_info(start, stop, probs))
+        self.blocks.append(block)
+        return block
+
+    def block_info(self, start, stop, probs):
+        """INFO scores for a block of variants
+
+        :param probs: probabilities for the block (variants x samples x 3)
+        :return: float64 array (variants)
+        """
+        if self.info is not None:
+            return self.info[start:stop]
+        return info_scores(probs)
 
-    def parse_variant(self, index):
-        log = logging.getLogger('bgen_parser::open_bgen')
-        # bgen.shape is (nsamples, nvariants, max_combinations)
-        if index < self.bgen.shape[1]:
-            locus = self.getLocusFromBgen(index)
+    def read_variant(self, index):
+        """Return the probabilities, missingness and INFO score of a single \
+            variant for the unmasked samples, decoding its block if it isn't \
+            buffered
 
-            return locus
-        libgwas.timer.report_period("ParseVariant: %d out of loci to consider" % (index))
-        raise StopIteration
+        :param index: index of the variant within the bgen file
+        :return: (probabilities (samples x 3), missing (samples), info)
+        """
+        for start, stop, probs, missing, info in self.blocks:
+            if start <= index < stop:
+                return probs[index - start], missing[index - start], info[index - start]
+        start, stop, probs, missing, info = self.read_block(index)
+        return probs[0], missing[0], info[0]
 
     # We'll assume that all files that have been associated with this
     # "dataset" are to be considered.
@@ -218,25 +418,26 @@ class Parser(DataParser):
         """Prepares the files for genotype parsing.
         :return: None
         """
+        # When the variants are sorted, we can jump straight to the region
+        # of interest rather than walking through everything that precedes it
+        self.bgen_start_idx, self.bgen_stop_idx = locus_range(self.chroms, self.positions,
+                                                              self.rsids)
         self.open_bgen()
-        missing = None
         locus_count = 0
+        self.alt_not_missing = None
         libgwas.timer.report_period("Loading Genotypes ")
 
         # identify individual's missingness if the threshold is set
         if DataParser.ind_miss_tol < 1.0:
-            for locus in self:
-                if DataParser.boundary.BoundaryCompare(BoundaryCheck.get_valid_chrom(iteration.chr), iteration.pos, iteration.rsid) < 0:
-                    self.bgen_start_idx += 1
-                if missing is None:
-                    missing = numpy.zeros(locus.genotype_data.shape[0])
-
-                missing += ((locus.genotype_data == DataParser.missing_representation))
-                locus_count += 1
+            missing, locus_count = self.sample_missingness()
 
             max_missing = DataParser.ind_miss_tol * locus_count
             dropped_individuals = 0+(max_missing < missing)
-            self.ind_mask = self.ind_mask | dropped_individuals
+            if sum(dropped_individuals) > 0:
+                # The subjects have already been handed over to pheno_covar,
+                # so these are excluded at extraction, as with bed files
+                self.alt_not_missing = dropped_individuals != 1
+                self.alt_not_missing = self.alt_not_missing[self.ind_mask != 1]
 
         valid_individuals = numpy.sum(self.ind_mask==0)
         self.min_likely_hets = float(valid_individuals) * DataParser.min_maf
@@ -244,14 +445,147 @@ class Parser(DataParser):
         self.max_missing_geno = DataParser.snp_miss_tol * float(valid_individuals)
         libgwas.timer.report_period("Genotypes Loaded. Starting Index: %d. Locus Count: %d" % (self.bgen_start_idx, locus_count))
 
-    def get_next_line(self):
-        """If we reach the end of the file, we simply open the next, until we \
-        run out of archives to process"""
-        info = 1.0
-        locus = self.parse_variant(self.bgen_idx)
-        self.bgen_idx += 1
-        return locus, info
-        #return line, info, exp_freq
+    def valid_variants(self, start, stop):
+        """Identify the variants within [start, stop) that pass the boundary \
+            check
+
+        :return: boolean array (stop - start)
+        """
+        boundary = DataParser.boundary
+        return numpy.array([boundary.TestBoundary(int(self.chroms[x]), int(self.positions[x]),
+                                                  self.rsids[x]) for x in range(start, stop)],
+                           dtype=bool)
+
+    def thread_reader(self):
+        """bgen_reader object for the calling thread's exclusive use"""
+        reader = getattr(self.thread_readers, "bgen", None)
+        if reader is None:
+            reader = bgen_reader.open_bgen(self.bgen_filename,
+                                           samples_filepath=self.sample_filename,
+                                           verbose=False)
+            self.thread_readers.bgen = reader
+            self.opened_readers.append(reader)
+        return reader
+
+    def close_thread_readers(self):
+        """Close the readers opened by thread_reader, releasing their \
+            memory maps"""
+        for reader in self.opened_readers:
+            reader.close()
+        self.opened_readers = []
+        self.thread_readers = threading.local()
+
+    def count_missing(self, start, stop, valid):
+        """Count each sample's missing genotypes across a range of variants
+
+        :param start: index of the first variant
+        :param stop: index following the last variant
+        :param valid: boolean array indicating which variants to count
+        :return: (missing counts for every sample in the file (int64),
+                 number of variants counted)
+
+        Variants failing the INFO threshold aren't counted.
+        """
+        if self.native:
+            probs, missing = self.bgen.read_block(start, stop)
+            valid = valid & ~self.bgen.skipped[start:stop]
+        else:
+            probs, missing = self.thread_reader().read(slice(start, stop), return_missings=True,
+                                                       num_threads=1)
+            probs = probs[:, :, 0:3].transpose(1, 0, 2)
+            missing = missing.T
+        if self.info is None:
+            keep = self.ind_mask == 0
+            valid = valid & (info_scores(probs[:, keep]) > Parser.info_threshold)
+        return numpy.sum(missing[valid], axis=0, dtype=numpy.int64), int(numpy.sum(valid))
+
+    @property
+    def missing_cache_file(self):
+        """Filename for the per sample missing counts sidecar"""
+        return "%s.missing.npz" % (self.bgen_filename)
+
+    def missing_signature(self, valid):
+        """Details used to recognize stale missing counts: the bgen file's \
+            size and modification time, the INFO threshold and the samples \
+            and variants considered"""
+        stats = os.stat(self.bgen_filename)
+        digest = hashlib.sha1(numpy.packbits(valid).tobytes() +
+                              numpy.packbits(self.ind_mask).tobytes() +
+                              struct.pack("<d", Parser.info_threshold)).digest()
+        return numpy.concatenate([numpy.array([stats.st_size, stats.st_mtime_ns, valid.shape[0]],
+                                              dtype=numpy.int64),
+                                  numpy.frombuffer(digest, dtype=numpy.uint8)])
+
+    def load_missing_cache(self, signature):
+        """Restore the missing counts, if the sidecar matches signature
+
+        :return: (missing, locus_count) or None
+        """
+        if not os.path.exists(self.missing_cache_file):
+            return None
+        with numpy.load(self.missing_cache_file) as cache:
+            if not numpy.array_equal(cache["signature"], signature):
+                return None
+            logging.info("Sample missingness restored from %s" % (self.missing_cache_file))
+            return cache["missing"], int(cache["locus_count"])
+
+    def write_missing_cache(self, signature, missing, locus_count):
+        try:
+            with open(self.missing_cache_file, "wb") as file:
+                numpy.savez(file, signature=signature, missing=missing,
+                            locus_count=locus_count)
+        except IOError as e:
+            logging.warning("Unable to write missingness cache, %s: %s" %
+                            (self.missing_cache_file, e))
+
+    def sample_missingness(self):
+        """Count the missing genotypes for each sample across the variants \
+            that will be considered for analysis
+
+        :return: (missing counts for every sample, number of variants counted)
+
+        The variants are read in blocks of block_size, which are distributed
+        across missing_threads threads. When cache_missingness is true, the
+        counts are saved and reused as long as the bgen file and the variants
+        counted haven't changed.
+        """
+        start, stop = self.bgen_start_idx, self.bgen_stop_idx
+        valid = self.valid_variants(start, stop)
+        DataParser.boundary.beyond_upper_bound = False
+        if self.info is not None:
+            valid &= self.info[start:stop] > Parser.info_threshold
+
+        signature = None
+        if Parser.cache_missingness:
+            signature = self.missing_signature(valid)
+            cached = self.load_missing_cache(signature)
+            if cached is not None:
+                return cached
+
+        block_size = max(1, Parser.block_size)
+        ranges = [(x, min(x + block_size, stop)) for x in range(start, stop, block_size)
+                  if numpy.any(valid[x - start:min(x + block_size, stop) - start])]
+        missing = numpy.zeros(self.bgen.nsamples, dtype=numpy.int64)
+        locus_count = 0
+
+        def count(bounds):
+            return self.count_missing(bounds[0], bounds[1],
+                                      valid[bounds[0] - start:bounds[1] - start])
+        try:
+            if Parser.missing_threads > 1 and len(ranges) > 1:
+                with ThreadPoolExecutor(Parser.missing_threads) as pool:
+                    counted = list(pool.map(count, ranges))
+            else:
+                counted = [count(x) for x in ranges]
+        finally:
+            self.close_thread_readers()
+        for counts, loci in counted:
+            missing += counts
+            locus_count += loci
+
+        if signature is not None:
+            self.write_missing_cache(signature, missing, locus_count)
+        return missing, locus_count
 
     def populate_iteration(self, iteration):
         """Parse genotypes from the file and iteration with relevant marker \
@@ -265,44 +599,47 @@ class Parser(DataParser):
         """
         global encoding
 
-        snpdata, info = self.get_next_line()
-
-        if info > Parser.info_threshold:
-            iteration.chr = snpdata.chr
-            iteration.pos = snpdata.pos
-            iteration.alleles = snpdata.alleles
-            nalleles = snpdata.nalleles
-            iteration.rsid = snpdata.rsid
-
-            if DataParser.boundary.TestBoundary(BoundaryCheck.get_valid_chrom(iteration.chr), iteration.pos, iteration.rsid):
-                # geno_content = self.bgen['genotype'][self.bgen_idx - 1].compute()
-                geno_probs, missing, ploidy = self.bgen.read(self.bgen_idx -1, return_missings=True, return_ploidies=True)
-               
-                #iteration.genotype_data = numpy.ma.MaskedArray(geno_content['probs'], self.geno_mask).compressed().reshape(-1, 3)
-                iteration.genotype_data = numpy.ma.MaskedArray(geno_probs[:,0,:], self.geno_mask).compressed().reshape(-1, 3)
+        index = self.bgen_idx
+        if index >= self.bgen_stop_idx:
+            libgwas.timer.report_period("ParseVariant: %d out of loci to consider" % (index))
+            raise StopIteration
+        self.bgen_idx += 1
+        if (index - self.bgen_start_idx) % Parser.report_interval == 0:
+            libgwas.timer.report_period("-  %d %d:%d" % (index, self.chroms[index],
+                                                         self.positions[index]))
+
+        # With a companion info file, poorly imputed variants can be skipped
+        # without ever being decoded
+        if self.info is None or self.info[index] > Parser.info_threshold:
+            iteration.chr = int(self.chroms[index])
+            iteration.pos = int(self.positions[index])
+            iteration.alleles = self.alleles[index].tolist()
+            iteration.rsid = self.rsids[index]
+
+            if DataParser.boundary.TestBoundary(iteration.chr, iteration.pos, iteration.rsid):
+                iteration.genotype_data, missing, info = self.read_variant(index)
+                if self.native and self.bgen.skipped[index]:
+                    logging.info("Skipping %s: only diploid, biallelic variants are supported"
+                                 % (iteration.rsid))
+                    return False
+                if not info > Parser.info_threshold:
+                    return False
                 likely_hets = numpy.sum(iteration.genotype_data[:, 1] > Parser.het_threshold)
-                libgwas.timer.report_period("-  %d %s:%s - Done"% (self.bgen_idx, iteration.chr, str(iteration.pos)))
 
                 # Skip over things that are likely to be fixed loci
                 isvalid = likely_hets > self.min_likely_hets
                 if isvalid:
-                    # iteration.missing_genotypes = geno_content['missing']
-                    #iteration.missing_genotypes = missing[:,0]
-                    iteration.missing_genotypes = numpy.ma.MaskedArray(missing[:,0], self.geno_mask[:,0]).compressed()
-                    libgwas.timer.report_period("- missingness identified")
-                    
+                    iteration.missing_genotypes = missing
                 return isvalid
             elif DataParser.boundary.beyond_upper_bound:
-                libgwas.timer.report_period("ParseVariant: %d out of loci to consider" % (snpdata.cur_idx))
+                libgwas.timer.report_period("ParseVariant: %d out of loci to consider" % (index))
         return False
 
 
     def filter_genotypes(self, missing):
         #genotypes = numpy.ma.MaskedArray(self.bgen['genotype'][self.bgen_idx - 1].compute()['probs'],
         #                                 self.geno_mask).compressed().reshape(-1, 3)
-        geno_probs = self.bgen.read(self.bgen_idx -1)[:,0,:]
-        genotypes = numpy.ma.MaskedArray(geno_probs,
-                                         self.geno_mask).compressed().reshape(-1, 3)
+        genotypes = self.read_variant(self.bgen_idx - 1)[0]
 
         estimate = None
         maf = None
@@ -350,6 +687,7 @@ class Parser(DataParser):
     def __iter__(self):
         """Reset the file and begin iteration"""
 
+        self.bgen_idx = self.bgen_start_idx
         loc = ParsedLocus(self)
         loc._extract_genotypes = gen_dosage_extraction
         return loc
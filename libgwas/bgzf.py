@@ -0,0 +1,238 @@
+import io
+import os
+import gzip
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from .exceptions import MalformedInputFile
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Multithreaded reading of BGZF (blocked gzip) files.
+
+BGZF files, produced by bgzip and used by tabix, are a series of small,
+independent gzip members, each of which records its compressed size in the
+header. The block boundaries can therefore be found without inflating
+anything, and the blocks themselves can be inflated concurrently (zlib
+releases the GIL while it works). Regular gzip files are read with the
+gzip module.
+"""
+
+#: Number of threads used to inflate blocks. 1 inflates on the calling thread
+thread_count = min(4, os.cpu_count() or 1)
+
+#: Number of blocks queued ahead of the reader for each thread
+blocks_per_thread = 8
+
+_magic = b"\x1f\x8b\x08\x04"
+
+
+def is_bgzf(filename):
+    """Return True if filename starts with a BGZF block header"""
+    with open(filename, "rb") as file:
+        header = file.read(18)
+    return len(header) == 18 and header[0:4] == _magic and header[12:14] == b"BC"
+
+
+def read_block(file):
+    """Read the next block from a BGZF file
+
+    :param file: binary file positioned at the start of a block
+    :return: raw deflate data for the block, followed by the 8 byte gzip
+             trailer (CRC32 and ISIZE), or None at the end of the file
+    """
+    header = file.read(12)
+    if len(header) == 0:
+        return None
+    if len(header) < 12 or header[0:4] != _magic:
+        raise MalformedInputFile("Invalid BGZF block found in %s" % (file.name))
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = file.read(xlen)
+
+    block_size = None
+    offset = 0
+    while offset + 4 <= len(extra):
+        subfield_length = struct.unpack("<H", extra[offset + 2:offset + 4])[0]
+        if extra[offset:offset + 2] == b"BC" and subfield_length == 2:
+            block_size = struct.unpack("<H", extra[offset + 4:offset + 6])[0] + 1
+        offset += 4 + subfield_length
+    if block_size is None:
+        raise MalformedInputFile("BGZF block size missing from %s" % (file.name))
+
+    remainder = file.read(block_size - 12 - xlen)
+    if len(remainder) != block_size - 12 - xlen:
+        raise MalformedInputFile("Truncated BGZF block found in %s" % (file.name))
+    return remainder
+
+
+def inflate(block, filename=None):
+    """Inflate a block returned by read_block, verifying the gzip trailer
+
+    :param block: deflate data followed by CRC32 and ISIZE
+    :param filename: name of the file used when reporting errors
+    :return: inflated data
+    """
+    if len(block) < 8:
+        raise MalformedInputFile("Truncated BGZF block found in %s" % (filename))
+    crc, size = struct.unpack("<II", block[-8:])
+    try:
+        data = zlib.decompress(block[0:-8], -15)
+    except zlib.error as e:
+        raise MalformedInputFile("Corrupt BGZF block found in %s: %s" % (filename, e))
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise MalformedInputFile("BGZF block in %s fails its CRC check" % (filename))
+    return data
+
+
+class BgzfReader(io.RawIOBase):
+    """Raw, read only stream of the inflated contents of a BGZF file.
+
+    Blocks are inflated on a thread pool and returned strictly in order.
+    """
+
+    def __init__(self, filename, threads=None):
+        if threads is None:
+            threads = thread_count
+        self.name = filename
+        self._file = open(filename, "rb")
+        self._pool = None
+        if threads > 1:
+            self._pool = ThreadPoolExecutor(threads)
+        self._window = max(1, threads) * blocks_per_thread
+        self._pending = collections.deque()
+        self._buffer = b""
+        self._offset = 0
+        self._end_of_blocks = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        """Queue up blocks until the window is full or the file is exhausted"""
+        while not self._end_of_blocks and len(self._pending) < self._window:
+            data = read_block(self._file)
+            if data is None:
+                self._end_of_blocks = True
+            elif self._pool is None:
+                self._pending.append(data)
+            else:
+                self._pending.append(self._pool.submit(inflate, data, self.name))
+
+    def _next_buffer(self):
+        """Move on to the next non-empty block. Returns False at the end"""
+        while True:
+            self._fill()
+            if len(self._pending) == 0:
+                return False
+            block = self._pending.popleft()
+            if self._pool is None:
+                self._buffer = inflate(block, self.name)
+            else:
+                self._buffer = block.result()
+            self._offset = 0
+            if len(self._buffer) > 0:
+                return True
+
+    def readinto(self, buffer):
+        if self._offset >= len(self._buffer) and not self._next_buffer():
+            return 0
+        count = min(len(buffer), len(self._buffer) - self._offset)
+        buffer[0:count] = self._buffer[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            if self._pool is not None:
+                for block in self._pending:
+                    block.cancel()
+                self._pool.shutdown(wait=True)
+            self._pending.clear()
+            self._file.close()
+        super(BgzfReader, self).close()
+
+
+def open_gzip(filename, mode='rt', threads=None):
+    """Open a gzipped file for reading, inflating BGZF files in parallel
+
+    :param filename: gzip or BGZF file
+    :param mode: 'rt' for text or 'rb' for bytes
+    :param threads: number of threads (defaults to thread_count)
+    :return: file object
+    """
+    if not is_bgzf(filename):
+        return gzip.open(filename, mode)
+    reader = io.BufferedReader(BgzfReader(filename, threads), buffer_size=1 << 16)
+    if 'b' in mode:
+        return reader
+    return io.TextIOWrapper(reader)
+
+
+class VirtualReader(object):
+    """Single threaded BGZF reader which supports seeking to (and reporting)
+    virtual offsets, as used by tabix and CSI indices.
+
+    A virtual offset is the compressed offset of a block shifted left 16
+    bits combined with the offset within the inflated block.
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        self._file = open(filename, "rb")
+        self._block_offset = 0
+        self._buffer = b""
+        self._offset = 0
+
+    def _load_block(self):
+        """Inflate the block at the current file position. Returns False at \
+            the end of the file"""
+        self._block_offset = self._file.tell()
+        data = read_block(self._file)
+        self._offset = 0
+        if data is None:
+            self._buffer = b""
+            return False
+        self._buffer = inflate(data, self.name)
+        return True
+
+    def seek(self, virtual_offset):
+        self._file.seek(virtual_offset >> 16)
+        self._load_block()
+        self._offset = virtual_offset & 0xffff
+
+    def tell(self):
+        if self._offset >= len(self._buffer):
+            return self._file.tell() << 16
+        return (self._block_offset << 16) | self._offset
+
+    def read(self, size):
+        pieces = []
+        while size > 0:
+            if self._offset >= len(self._buffer):
+                if not self._load_block():
+                    break
+                continue
+            piece = self._buffer[self._offset:self._offset + size]
+            self._offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return b"".join(pieces)
+
+    def close(self):
+        self._file.close()
@@ -3,14 +3,19 @@ from . import BuildReportLine
 from .data_parser import DataParser
 from .parsed_locus import ParsedLocus
 from .pheno_covar import PhenoCovar
+from .boundary import BoundaryCheck
 from .exceptions import TooManyAlleles
 from .exceptions import TooFewAlleles
 from . import allele_counts
-import gzip
+from . import bgzf
 import numpy
 from .exceptions import InvalidSelection
+from .exceptions import MalformedInputFile
+import collections
 import logging
+import multiprocessing
 import os
+import queue
 
 __copyright__ = "Todd Edwards, Chun Li & Eric Torstenson"
 __license__ = "GPL3.0"
@@ -63,17 +68,52 @@ def SetEncoding(sval):
 # Convert genotypes to analyzable form if there is any need
 
 
+#: Under the additive encoding, extract float32 dosages and the allele counts
+#: from a single compressed copy of the probabilities (see
+#: additive_dosage_extraction)
+additive_fast_path = True
+
+
+def additive_dosage_extraction(alleles, rawgeno, non_missing):
+    """Additive encoding for (n x 3) genotype probabilities
+
+    The probabilities are compressed once, in their own precision, and the
+    column sums used for the allele counts are accumulated from that copy.
+    The dosages, P(het) + 2 * P(hom), are float32. Given the same float32
+    probabilities (as returned by parse_gen_probabilities), both this and
+    the general path in gen_dosage_extraction accumulate the sums in
+    float64, so the counts agree, but this avoids making float64 copies
+    of each column.
+    """
+    probs = rawgeno[non_missing]
+    valid_pop = probs.shape[0]
+    a1_total, het_total, a2_total = numpy.sum(probs, axis=0, dtype='float64')
+
+    genotypes = numpy.multiply(probs[:, 2], 2, dtype='float32')
+    numpy.add(genotypes, probs[:, 1], out=genotypes, casting='same_kind')
+
+    hetc = int(het_total * valid_pop)
+    a1c = int(2 * a1_total * valid_pop) + hetc
+    a2c = int(2 * a2_total * valid_pop) + hetc
+    alc = allele_counts.AlleleCounts(genotypes, alleles, non_missing)
+    alc.set_allele_counts(a1c, a2c, hetc, float(het_total + 2 * a2_total) / 2 / float(valid_pop))
+    return alc
+
+
 def gen_dosage_extraction(alleles, rawgeno, non_missing):
     global encoding
+    if encoding == Encoding.Additive and additive_fast_path:
+        return additive_dosage_extraction(alleles, rawgeno, non_missing)
+
     a1 = (rawgeno[:, 0][non_missing]).astype('float64')
     het = rawgeno[:, 1][non_missing].astype('float64')
     a2 = rawgeno[:, 2][non_missing].astype('float64')
 
 
     valid_pop = a1.shape[0]
-    hetc = int(sum(het) * valid_pop)
-    a1c = int(2 * sum(a1) * valid_pop) + hetc
-    a2c = int(2 * sum(a2) * valid_pop) + hetc
+    hetc = int(numpy.sum(het) * valid_pop)
+    a1c = int(2 * numpy.sum(a1) * valid_pop) + hetc
+    a2c = int(2 * numpy.sum(a2) * valid_pop) + hetc
     alc = None
     additive = het + (a2 * 2)
     # Additive
@@ -103,8 +143,202 @@ def gen_dosage_extraction(alleles, rawgeno, non_missing):
         print("unexpected encoding: ", encoding)
         sys.exit(1)
     alc = allele_counts.AlleleCounts(genotypes, alleles, non_missing)
-    alc.set_allele_counts(a1c, a2c, hetc, sum(additive/2)/float(a1.shape[0]))
+    alc.set_allele_counts(a1c, a2c, hetc, numpy.sum(additive/2)/float(a1.shape[0]))
     return alc
+
+
+def parse_gen_probabilities(text, sample_count, sample_index=None):
+    """Convert the genotype probabilities from a .gen line into numbers
+
+    :param text: the portion of the line following the fifth column
+    :param sample_count: number of samples expected on the line
+    :param sample_index: indices of the samples to be returned (None for all)
+    :return: float32 array (samples x 3)
+
+    The entire string is converted in a single pass, without splitting it
+    into individual words first.
+    """
+    values = numpy.fromstring(text, dtype='float32', sep=' ')
+    if values.shape[0] != sample_count * 3:
+        raise MalformedInputFile("Expected %d genotype probabilities, but found %d" %
+                                 (sample_count * 3, values.shape[0]))
+    values = values.reshape(-1, 3)
+    if sample_index is not None:
+        values = values[sample_index]
+    return values
+
+
+def dosage_probabilities(dosages):
+    """Convert dosages into (n x 3) genotype probabilities
+
+    :param dosages: array of expected allele counts (negative for missing)
+    :return: float array of probabilities, with missing_storage across the
+             rows of missing samples
+
+    Without probabilities, the heterozygote probability is taken to be as
+    large as the dosage allows (as PLINK 2 does for dosage only data), so
+    that the dominant and recessive encodings become min(d, 1) and
+    max(d - 1, 0).
+    """
+    dosages = numpy.asarray(dosages, dtype='float64')
+    aa = numpy.maximum(dosages - 1, 0)
+    Aa = dosages - 2 * aa
+    probabilities = numpy.column_stack([1 - Aa - aa, Aa, aa])
+    probabilities[dosages < 0] = DataParser.missing_storage
+    return probabilities
+
+
+def dosage_extraction(alleles, dosages, non_missing):
+    """Genotype extraction for dosage data (see gen_dosage_extraction)"""
+    return gen_dosage_extraction(alleles, dosage_probabilities(dosages), non_missing)
+
+
+def parse_archive(gen_filename, info_filename, compressed, sample_count, sample_index,
+                  info_threshold, chunk_size, destination):
+    """Process pool worker which parses a single .gen archive
+
+    :param gen_filename: .gen file (possibly gzipped)
+    :param info_filename: corresponding .info file
+    :param compressed: True if the .gen file is gzipped
+    :param sample_count: number of samples found on each line
+    :param sample_index: indices of the samples to be kept
+    :param info_threshold: loci with info at or below this are skipped
+    :param chunk_size: number of loci sent in each message
+    :param destination: queue receiving (markers, info, exp_freq,
+                        probabilities) chunks followed by None. Any
+                        exception raised is sent in place of None
+    """
+    try:
+        if compressed:
+            gen_file = bgzf.open_gzip(gen_filename, 'rt', threads=1)
+        else:
+            gen_file = open(gen_filename)
+        with gen_file, open(info_filename) as info_file:
+            info_file.readline()   # Dump the header
+            chunk = ([], [], [], [])
+            for line in gen_file:
+                words = line.split(None, 5)
+                if len(words) == 0:
+                    break
+                if words[0] in ['S', 's']:
+                    continue
+                info_line = info_file.readline().strip().split()
+                info = float(info_line[4])
+                if info > info_threshold:
+                    genodata = ""
+                    if len(words) > 5:
+                        genodata = words[5]
+                    chunk[0].append(words[0:5])
+                    chunk[1].append(info)
+                    chunk[2].append(float(info_line[3]))
+                    chunk[3].append(parse_gen_probabilities(genodata, sample_count,
+                                                            sample_index))
+                    if len(chunk[0]) == chunk_size:
+                        destination.put(chunk)
+                        chunk = ([], [], [], [])
+            if len(chunk[0]) > 0:
+                destination.put(chunk)
+        destination.put(None)
+    except Exception as e:
+        destination.put(e)
+
+
+class ArchivePipeline(object):
+    """Parse several archives at once on separate processes, returning the \
+    loci in archive order.
+
+    Each worker has its own bounded queue, so a worker that gets too far
+    ahead of the archive currently being consumed simply waits.
+    """
+
+    #: Seconds to wait for a chunk before checking that the worker is alive
+    poll_interval = 1.0
+
+    def __init__(self, jobs, workers, queue_depth):
+        """Start the first workers
+
+        :param jobs: list of (archive index, arguments for parse_archive
+                     without the queue)
+        :param workers: maximum number of archives being parsed at once
+        :param queue_depth: number of chunks each worker may queue up
+        """
+        self.context = multiprocessing.get_context()
+        self.jobs = collections.deque(jobs)
+        self.workers = workers
+        self.queue_depth = queue_depth
+
+        #: (archive index, process, queue, .gen filename) in archive order
+        self.running = collections.deque()
+
+        #: Loci remaining from the current chunk
+        self.pending = collections.deque()
+        while len(self.running) < self.workers and len(self.jobs) > 0:
+            self.start_next()
+
+    def start_next(self):
+        archive_index, args = self.jobs.popleft()
+        destination = self.context.Queue(self.queue_depth)
+        process = self.context.Process(target=parse_archive,
+                                       args=tuple(args) + (destination,))
+        process.daemon = True
+        process.start()
+        self.running.append((archive_index, process, destination, args[0]))
+
+    def receive(self, process, source, filename):
+        """Wait for the next message from a worker
+
+        :return: the chunk, None or exception sent by the worker
+
+        A worker that dies without sending anything (killed for running out
+        of memory, for instance) would otherwise leave us waiting forever.
+        """
+        while True:
+            try:
+                return source.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+            # Anything sent just before the worker exited may still be in transit
+            try:
+                return source.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self.close()
+                raise MalformedInputFile("The worker parsing %s exited (code %s) before "
+                                         "it was finished" % (filename, process.exitcode))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Return the next locus: (archive index, marker columns, info, \
+            exp_freq, probabilities)"""
+        while len(self.pending) == 0:
+            if len(self.running) == 0:
+                raise StopIteration
+            index, process, source, filename = self.running[0]
+            chunk = self.receive(process, source, filename)
+            if chunk is None or isinstance(chunk, Exception):
+                self.running.popleft()
+                process.join()
+                if isinstance(chunk, Exception):
+                    self.close()
+                    raise chunk
+                if len(self.jobs) > 0:
+                    self.start_next()
+            else:
+                self.pending.extend([(index,) + x for x in zip(*chunk)])
+        return self.pending.popleft()
+
+    def close(self):
+        """Stop any workers that are still running"""
+        for index, process, source, filename in self.running:
+            process.terminate()
+            process.join()
+        self.running.clear()
+        self.jobs.clear()
+        self.pending.clear()
+
+
 """
 ISSUES:
 * Beyond consideration for MVTest, is it typical to transform these frequencies into genotypes?
@@ -130,6 +364,16 @@ class Parser(DataParser):
     #: The threshold associated with the .info info column
     info_threshold = 0.4
 
+    #: Number of archives decompressed and parsed at once by separate
+    #: processes. 1 parses them one after another on the calling process
+    archive_workers = 1
+
+    #: Number of loci sent from a worker to the parser at a time
+    archive_chunk_size = 256
+
+    #: Number of chunks each worker may have waiting for the parser
+    archive_queue_depth = 8
+
     def getnew(self):
         return Parser(self.fam_details, self.archives, self.chroms, self.info_files)
 
@@ -181,12 +425,18 @@ class Parser(DataParser):
 
         self.geno_mask = None
 
+        #: Indices of the samples that aren't masked out
+        self.ind_index = None
+
         self.alt_not_missing = None
         
         self.info_file = None
         
         self.freq_file = None
 
+        #: Workers parsing the archives when archive_workers is more than 1
+        self.pipeline = None
+
     def __del__(self):
         if self.info_file is not None:
             self.info_file.close()
@@ -194,6 +444,9 @@ class Parser(DataParser):
         if self.freq_file is not None:
             self.freq_file.close()
 
+        if self.pipeline is not None:
+            self.pipeline.close()
+
     def ReportConfiguration(self):
         """
         :param file: Destination for report details
@@ -243,20 +496,53 @@ class Parser(DataParser):
             self.ind_mask = numpy.array(mask_components, dtype=numpy.int8)
             self.ind_count = sum(self.ind_mask == 0)
             self.geno_mask = self.ind_mask.reshape(-1, 1).repeat(3, axis=1)
+            self.ind_index = numpy.flatnonzero(self.ind_mask == 0)
             pheno_covar.freeze_subjects()
 
+    def info_filename(self, index):
+        """The .info file associated with an archive"""
+        if len(self.info_files) > 0:
+            return self.info_files[index]
+        return self.archives[index].replace(Parser.gen_ext, Parser.info_ext)
+
+    def archive_in_bounds(self, index):
+        """Return False if none of the archive's loci can pass the boundary \
+            check, because it holds a different chromosome"""
+        if BoundaryCheck.chrom == -1:
+            return True
+        return BoundaryCheck.get_valid_chrom(self.chroms[index]) == BoundaryCheck.chrom
+
+    def start_pipeline(self):
+        """Begin parsing the archives on separate processes
+
+        :return: None
+        """
+        if self.pipeline is not None:
+            self.pipeline.close()
+        jobs = [(index, (archive, self.info_filename(index), DataParser.compressed_pedigree,
+                         self.ind_mask.shape[0], self.ind_index, Parser.info_threshold,
+                         Parser.archive_chunk_size))
+                for index, archive in enumerate(self.archives) if self.archive_in_bounds(index)]
+        self.pipeline = ArchivePipeline(jobs, Parser.archive_workers, Parser.archive_queue_depth)
+        self.file_index = len(self.archives)
+
     def load_genotypes(self):
         """Prepares the files for genotype parsing.
 
         :return: None
-        """
 
+        When archive_workers is more than 1, all of the archives are handed
+        off to worker processes instead.
+        """
+        if Parser.archive_workers > 1:
+            if self.file_index < len(self.archives):
+                self.start_pipeline()
+                return
+            raise StopIteration
 
         if self.file_index < len(self.archives):
             self.current_file = self.archives[self.file_index]
-            info_filename = self.current_file.replace(Parser.gen_ext, Parser.info_ext)
-            if len(self.info_files) > 0:
-                info_filename = self.info_files[self.file_index]
+            info_filename = self.info_filename(self.file_index)
             if self.info_file is not None:
                 self.info_file.close()
             self.info_file = open(info_filename)
@@ -265,7 +551,7 @@ class Parser(DataParser):
             if self.freq_file is not None:
                 self.freq_file.close()
             if DataParser.compressed_pedigree:
-                self.freq_file = gzip.open("%s" % (self.current_file), 'rt')
+                self.freq_file = bgzf.open_gzip("%s" % (self.current_file), 'rt')
             else:
                 self.freq_file = open(self.current_file)
             self.check_freq_header = True
@@ -276,14 +562,17 @@ class Parser(DataParser):
 
     def get_next_line(self):
         """If we reach the end of the file, we simply open the next, until we \
-        run out of archives to process"""
+        run out of archives to process
+
+        Only the five marker columns are split from the line. The sixth
+        entry holds the remainder of the line (the probabilities)."""
 
-        line = self.freq_file.readline().strip().split()
+        line = self.freq_file.readline().split(None, 5)
         if self.check_freq_header and (len(line) > 0 and (line[0] in ['S','s'])):
-            line = self.freq_file.readline().strip().split()
+            line = self.freq_file.readline().split(None, 5)
         if len(line) < 1:
             self.load_genotypes()
-            line = self.freq_file.readline().strip().split()
+            line = self.freq_file.readline().split(None, 5)
         info_line = self.info_file.readline().strip().split()
         info = float(info_line[4])
         exp_freq = float(info_line[3])
@@ -304,7 +593,12 @@ class Parser(DataParser):
         the valid genomic region for analysis.
         """
         global encoding
-        line, info, exp_freq = self.get_next_line()
+        genotypes = None
+        if self.pipeline is not None:
+            archive_index, line, info, exp_freq, genotypes = next(self.pipeline)
+            self.current_chrom = self.chroms[archive_index]
+        else:
+            line, info, exp_freq = self.get_next_line()
 
         if info > Parser.info_threshold:
             junk, iteration.rsid, iteration.pos, iteration.major_allele, iteration.minor_allele = line[0:5]
@@ -315,8 +609,13 @@ class Parser(DataParser):
                 idx = 5
                 # total_maf = 0.0
                 # additive = []
-                genodata = line[idx:]
-                iteration.genotype_data = numpy.ma.MaskedArray(genodata, self.geno_mask).compressed().reshape(-1, 3).astype('float64')
+                if genotypes is None:
+                    genodata = ""
+                    if len(line) > idx:
+                        genodata = line[idx]
+                    genotypes = parse_gen_probabilities(genodata, self.ind_mask.shape[0],
+                                                        self.ind_index)
+                iteration.genotype_data = genotypes
                 iteration.missing_genotypes = iteration.genotype_data[:, 0] == DataParser.missing_storage
                 return True
                 """
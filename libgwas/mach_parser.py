@@ -5,7 +5,7 @@ from . import ExitIf
 import sys
 from .exceptions import TooManyAlleles
 from .exceptions import TooFewAlleles
-import gzip
+from . import bgzf
 import numpy
 from .exceptions import InvalidSelection
 import os
@@ -213,7 +213,7 @@ class Parser(DataParser):
 
     def openfile(self, filename):
         if DataParser.compressed_pedigree:
-            return gzip.open(filename, 'rt')
+            return bgzf.open_gzip(filename, 'rt')
         return open(filename, 'r')
 
     def parse_genotypes(self, lb, ub):
@@ -0,0 +1,218 @@
+import numpy
+from .boundary import BoundaryCheck
+from .exceptions import InvalidChromosome
+from .exceptions import MalformedInputFile
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact, columnar storage for marker details.
+
+Very large marker lists (tens of millions of variants) are too expensive to
+hold as python lists of strings, so these are stored as numpy arrays. Strings
+which are (mostly) unique, such as RSIDs, are kept in a single byte blob with
+offsets, while highly redundant strings, such as alleles, are stored as codes
+into a small table of values.
+"""
+
+#: Number of bytes read from the file at a time when loading columns
+chunk_size = 1 << 24
+
+
+def chrom_code(name):
+    """Convert a chromosome name into the integer code used internally
+
+    :param name: Chromosome name (str or bytes)
+    :return: integer representation of the chromosome
+    """
+    if isinstance(name, bytes):
+        name = name.decode()
+    try:
+        return int(name)
+    except ValueError:
+        if name in BoundaryCheck.chrom_conversion:
+            return BoundaryCheck.chrom_conversion[name]
+    raise InvalidChromosome(name)
+
+
+def chrom_codes(names):
+    """Convert an array of chromosome names into integer codes
+
+    :param names: numpy array of chromosome names
+    :return: int16 array of chromosome codes
+
+    Each distinct name is only converted once.
+    """
+    unique, inverse = numpy.unique(names, return_inverse=True)
+    codes = numpy.array([chrom_code(x) for x in unique], dtype=numpy.int16)
+    return codes[inverse.reshape(-1)]
+
+
+class StringTable(object):
+    """Read only sequence of strings stored as a single byte blob and the
+    offsets of each string within it"""
+
+    def __init__(self, blob=b"", offsets=None):
+        #: Concatenated strings
+        self.blob = blob
+
+        #: offsets[i]:offsets[i+1] is the slice of blob for string i
+        self.offsets = offsets
+        if offsets is None:
+            self.offsets = numpy.zeros(1, dtype=numpy.int64)
+
+    @classmethod
+    def from_list(cls, strings):
+        """Build a table from a list of str or bytes"""
+        strings = [x.encode() if isinstance(x, str) else x for x in strings]
+        lengths = numpy.fromiter(map(len, strings), dtype=numpy.int64, count=len(strings))
+        offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        return cls(b"".join(strings), offsets)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Merge several tables into one, preserving order"""
+        blobs = []
+        offsets = [numpy.zeros(1, dtype=numpy.int64)]
+        total = 0
+        for table in tables:
+            blobs.append(table.blob)
+            offsets.append(table.offsets[1:] + total)
+            total += len(table.blob)
+        return cls(b"".join(blobs), numpy.concatenate(offsets))
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].decode()
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def index(self, value):
+        """Return the index of the first occurrence of value"""
+        value = value.encode()
+        position = self.blob.find(value)
+        while position >= 0:
+            index = numpy.searchsorted(self.offsets, position)
+            if self.offsets[index] == position and \
+                    self.offsets[index + 1] - position == len(value):
+                return int(index)
+            position = self.blob.find(value, position + 1)
+        raise ValueError("%s is not in table" % (value.decode()))
+
+
+class AlleleTable(object):
+    """Read only sequence of allele pairs stored as codes into a list of the
+    distinct alleles observed"""
+
+    def __init__(self, codes=None, values=None):
+        #: (locus count x 2) array of indices into values
+        self.codes = codes
+        if codes is None:
+            self.codes = numpy.zeros((0, 2), dtype=numpy.int32)
+
+        #: distinct allele strings
+        self.values = values
+        if values is None:
+            self.values = []
+
+        self._lookup = dict((v, i) for i, v in enumerate(self.values))
+
+    def encode(self, alleles):
+        """Convert an array of allele strings (bytes) into codes, adding new \
+            values to the table as needed
+
+        :param alleles: numpy array of allele strings
+        :return: int32 array of codes with the same shape as alleles
+        """
+        unique, inverse = numpy.unique(alleles, return_inverse=True)
+        mapping = numpy.zeros(unique.shape[0], dtype=numpy.int32)
+        for idx, allele in enumerate(unique):
+            if isinstance(allele, bytes):
+                allele = allele.decode()
+            if allele not in self._lookup:
+                self._lookup[allele] = len(self.values)
+                self.values.append(allele)
+            mapping[idx] = self._lookup[allele]
+        return mapping[inverse.reshape(-1)].reshape(alleles.shape)
+
+    def append(self, codes):
+        """Add an (n x 2) array of codes (from encode) to the table"""
+        self.codes = numpy.concatenate([self.codes, codes])
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        first, second = self.codes[index]
+        return [self.values[first], self.values[second]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def read_columns(filename, column_count, columns, comment=None):
+    """Read whitespace delimited text in large chunks, returning only the \
+        requested columns
+
+    :param filename: file to be read
+    :param column_count: number of columns expected on every line
+    :param columns: indices of the columns to be returned
+    :param comment: lines starting with this (bytes) are skipped
+    :return: generator producing a list of numpy bytes arrays per chunk,
+             one for each of the columns requested
+
+    Raises MalformedInputFile if a chunk contains lines with the wrong
+    number of columns.
+    """
+    with open(filename, "rb") as file:
+        remainder = b""
+        while True:
+            data = file.read(chunk_size)
+            if len(data) == 0:
+                data = remainder
+                remainder = b""
+                if len(data) == 0:
+                    break
+            else:
+                data = remainder + data
+                last_line = data.rfind(b"\n") + 1
+                data, remainder = data[0:last_line], data[last_line:]
+            if comment is not None and (data.startswith(comment) or
+                                        (b"\n" + comment) in data):
+                data = b"\n".join([x for x in data.split(b"\n")
+                                   if not x.startswith(comment)])
+            words = data.split()
+            if len(words) % column_count != 0:
+                raise MalformedInputFile("Unexpected number of columns found "
+                                         "in %s. Expected %d columns." %
+                                         (filename, column_count))
+            if len(words) > 0:
+                yield [numpy.array(words[col::column_count]) for col in columns]
@@ -1,3 +1,4 @@
+import numpy
 from .locus import Locus
 from . import allele_counts
 from .exceptions import InvalidFrequency
@@ -27,9 +28,9 @@ __license__ = "GPL3.0"
 def default_geno_extraction(alleles, rawgeno, non_missing):
     genotypes = rawgeno[non_missing]
 
-    het = sum(genotypes == 1)
-    a1c = (2 * sum(genotypes==0)) + het
-    a2c = (2 * sum(genotypes==2)) + het
+    het = numpy.count_nonzero(genotypes == 1)
+    a1c = (2 * numpy.count_nonzero(genotypes == 0)) + het
+    a2c = (2 * numpy.count_nonzero(genotypes == 2)) + het
 
     alc = allele_counts.AlleleCounts(genotypes, alleles, non_missing)
     alc.set_allele_counts(a1c, a2c, het)
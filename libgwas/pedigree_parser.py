@@ -1,4 +1,4 @@
-import gzip
+from . import bgzf
 
 import numpy
 
@@ -191,7 +191,7 @@ class Parser(DataParser):
 
         valid_allele_count = 0
         if DataParser.compressed_pedigree:
-            input_file = gzip.open("%s.gz" % self.datasource, 'rt')
+            input_file = bgzf.open_gzip("%s.gz" % self.datasource, 'rt')
         else:
             input_file = open(self.datasource)
 
@@ -0,0 +1,624 @@
+import struct
+import logging
+import numpy
+from . import bed_parser
+from . import marker_table
+from .bed_parser import decode_genotypes
+from .data_parser import DataParser
+from .parsed_locus import ParsedLocus
+from .pheno_covar import PhenoCovar
+from .exceptions import MalformedInputFile
+from . import Exit
+from . import BuildReportLine
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reader for PLINK 2 binary filesets (.pgen, .pvar and .psam)
+
+Only the main (hard call) genotype track of each variant is used. Records
+may use any of the following storage modes:
+
+    * 0x01 PLINK 1 variant major .bed data
+    * 0x02 fixed width, 2 bit hard calls
+    * 0x10 variable width, where each record is one of
+        * 2 bit hard calls
+        * 1 bit (two most common genotypes) plus a difflist of the others
+        * difflist relative to the previous non-LD compressed variant
+          (optionally with REF/ALT inverted)
+        * difflist relative to all hom REF or all missing
+
+Phase, dosage and multiallelic tracks which follow the main track are
+skipped, so multiallelic variants are analyzed as REF vs. all ALTs.
+"""
+
+#: Storage modes (third byte of the .pgen file)
+bed_mode = 0x01
+fixed_mode = 0x02
+variable_mode = 0x10
+
+#: Number of variants described by each block of the variable width index
+variants_per_block = 1 << 16
+
+#: Swaps REF/ALT for inverted LD compressed records
+inverted_codes = numpy.array([2, 1, 0, 3], dtype=numpy.int8)
+
+
+def sample_id_bytes(sample_count):
+    """Number of bytes used to store sample indices within difflists"""
+    return max(1, (sample_count.bit_length() + 7) // 8)
+
+
+def read_varint(data, offset):
+    """Decode a single LEB128 style integer
+
+    :return: (value, next offset)
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise MalformedInputFile("Truncated integer in .pgen record")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 128:
+            return value, offset
+        shift += 7
+
+
+def decode_varints(data, offset, count):
+    """Decode a series of LEB128 style integers at once
+
+    :param data: bytes containing the integers
+    :param offset: position of the first integer
+    :param count: number of integers to be decoded
+    :return: (int64 array of values, next offset)
+    """
+    if count == 0:
+        return numpy.zeros(0, dtype=numpy.int64), offset
+    raw = numpy.frombuffer(data, dtype=numpy.uint8, offset=offset,
+                           count=min(len(data) - offset, count * 5))
+    ends = numpy.flatnonzero(raw < 128)[0:count]
+    if ends.shape[0] < count:
+        raise MalformedInputFile("Truncated integer in .pgen record")
+    raw = raw[0:ends[-1] + 1]
+    starts = numpy.zeros(count, dtype=numpy.int64)
+    starts[1:] = ends[:-1] + 1
+    shifts = 7 * (numpy.arange(raw.shape[0]) - numpy.repeat(starts, ends - starts + 1))
+    values = numpy.add.reduceat((raw & 0x7f).astype(numpy.int64) << shifts, starts)
+    return values, offset + raw.shape[0]
+
+
+def decode_difflist(data, offset, sample_count):
+    """Decode a list of (sample, genotype code) pairs
+
+    :param data: bytes containing the list
+    :param offset: position of the list within data
+    :param sample_count: number of samples in the file
+    :return: (sample indices, genotype codes, offset following the list)
+
+    Samples are stored in groups of 64, each starting with a fixed width
+    sample index followed by varint deltas to the remaining samples. The
+    genotype codes for every sample in the list precede the deltas.
+    """
+    length, offset = read_varint(data, offset)
+    if length == 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int8), offset
+
+    id_bytes = sample_id_bytes(sample_count)
+    group_count = (length + 63) // 64
+    starts = numpy.frombuffer(data, dtype=numpy.uint8, count=group_count * id_bytes,
+                              offset=offset).reshape(group_count, id_bytes)
+    starts = starts.astype(numpy.int64).dot(256 ** numpy.arange(id_bytes, dtype=numpy.int64))
+    # The group sizes (in bytes), which permit skipping groups, aren't needed
+    offset += group_count * id_bytes + group_count - 1
+
+    code_bytes = (length + 3) // 4
+    codes = decode_genotypes(data[offset:offset + code_bytes], length, bed_parser.code_table)
+    offset += code_bytes
+
+    deltas, offset = decode_varints(data, offset, length - group_count)
+    steps = numpy.zeros(group_count * 64, dtype=numpy.int64)
+    steps[0:length:64] = starts
+    delta_mask = numpy.ones(length, dtype=bool)
+    delta_mask[0::64] = False
+    steps[numpy.flatnonzero(delta_mask)] = deltas
+    samples = numpy.cumsum(steps.reshape(group_count, 64), axis=1).reshape(-1)[0:length]
+    if samples[-1] >= sample_count:
+        raise MalformedInputFile("Invalid sample index found in .pgen record")
+    return samples, codes, offset
+
+
+def decode_main_track(data, record_type, sample_count, ld_base=None):
+    """Decode the hard calls from a variable width record
+
+    :param data: bytes for the record
+    :param record_type: the record's type from the .pgen index
+    :param sample_count: number of samples in the file
+    :param ld_base: decoded codes for the previous record that wasn't LD
+                    compressed (required for LD compressed records only)
+    :return: int8 array of genotype codes (0-3) for every sample
+    """
+    kind = record_type & 7
+    if kind == 0:
+        return decode_genotypes(data[0:(sample_count + 3) // 4], sample_count,
+                                bed_parser.code_table)
+    if kind == 1:
+        common = data[0]
+        bit_bytes = (sample_count + 7) // 8
+        bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8, count=bit_bytes,
+                                                 offset=1), bitorder="little")[0:sample_count]
+        codes = ((common >> 2) + bits * (common & 3)).astype(numpy.int8)
+        offset = 1 + bit_bytes
+    elif kind == 2 or kind == 3:
+        if ld_base is None:
+            raise MalformedInputFile("LD compressed .pgen record found without a base")
+        codes = ld_base.copy()
+        offset = 0
+    elif kind == 4 or kind == 7:
+        codes = numpy.full(sample_count, kind & 3, dtype=numpy.int8)
+        offset = 0
+    else:
+        raise MalformedInputFile("Unrecognized .pgen record type, %d" % (record_type))
+
+    samples, values, offset = decode_difflist(data, offset, sample_count)
+    codes[samples] = values
+    if kind == 3:
+        codes = inverted_codes[codes]
+    return codes
+
+
+def little_endian(values, byte_count):
+    """Combine (n x byte_count) uint8 values into little endian integers"""
+    return values.reshape(-1, byte_count).astype(numpy.int64).dot(
+        256 ** numpy.arange(byte_count, dtype=numpy.int64))
+
+
+class Parser(bed_parser.Parser):
+    """Parse PLINK 2 .pgen/.pvar/.psam filesets
+
+    Marker and sample details are held in the same columnar structures as
+    the .bed parser, so boundary seeking works just as it does for .bed.
+    """
+
+    def __init__(self, psam, pvar, pgen):
+        """
+        :param psam: sample file (.psam or PLINK 1 .fam)
+        :param pvar: variant file (.pvar or PLINK 1 .bim)
+        :param pgen: genotype file (.pgen or PLINK 1 .bed)
+        """
+        super(Parser, self).__init__(psam, pvar, pgen)
+
+        #: Sample details file
+        self.psam_file = psam
+
+        #: Variant details file
+        self.pvar_file = pvar
+
+        #: Genotype file
+        self.pgen_file = pgen
+
+        #: Storage mode found at the top of the .pgen file
+        self.storage_mode = None
+
+        #: File offset of each record (plus the end of the final record)
+        self.record_offsets = None
+
+        #: Record type of each variant (variable width files only)
+        self.record_types = None
+
+        #: Index of the most recent record that wasn't LD compressed for
+        #: each record (variable width files only)
+        self.ld_bases = None
+
+        #: Index and codes of the most recently decoded LD base
+        self.ld_base_index = -1
+        self.ld_base_codes = None
+
+        #: Genotypes for each of the main track codes
+        self.code_genotypes = numpy.array([0, 1, 2, DataParser.missing_storage],
+                                          dtype=numpy.int8)
+
+    def getnew(self):
+        return Parser(self.psam_file, self.pvar_file, self.pgen_file)
+
+    def initialize(self, map3=False, pheno_covar=None):
+        self.load_pvar()
+        self.load_psam(pheno_covar)
+        self.load_genotypes()
+
+    def ReportConfiguration(self):
+        """ Report configuration for logging purposes.
+
+        :return: None
+        """
+        log = logging.getLogger('pgen_parser::ReportConfiguration')
+        log.info(BuildReportLine("PGEN_FILE", self.pgen_file))
+        log.info(BuildReportLine("PVAR_FILE", self.pvar_file))
+        log.info(BuildReportLine("PSAM_FILE", self.psam_file))
+
+    def psam_columns(self, header):
+        """Column names for the .psam file
+
+        :param header: words from the header line (None if there isn't one)
+        :return: list of upper case column names
+
+        Files without a header are treated as .fam files, using the
+        DataParser settings to determine which columns are present.
+        """
+        if header is not None:
+            return [x.lstrip("#").upper() for x in header]
+        columns = []
+        if DataParser.has_fid:
+            columns.append("FID")
+        columns.append("IID")
+        if DataParser.has_parents:
+            columns += ["PAT", "MAT"]
+        if DataParser.has_sex:
+            columns.append("SEX")
+        if DataParser.has_pheno:
+            columns.append("PHENO1")
+        return columns
+
+    def load_psam(self, pheno_covar=None):
+        """Load the sample details, updating the pheno_covar with the \
+            subjects found.
+
+        :param pheno_covar: Phenotype/covariate object
+        :return: None
+
+        The first column that isn't one of the standard .psam columns is
+        used as the phenotype. Family details are kept in .fam order for
+        reporting and export.
+        """
+        logging.info("Loading file: %s" % (self.psam_file))
+        header = None
+        columns = None
+        mask_components = []
+        with open(self.psam_file) as file:
+            for line in file:
+                words = line.strip().split()
+                if len(words) == 0:
+                    continue
+                if columns is None:
+                    if words[0] in ("#FID", "#IID"):
+                        header = words
+                    columns = self.psam_columns(header)
+                    standard = set(["FID", "IID", "SID", "PAT", "MAT", "SEX"])
+                    pheno_columns = [i for i, x in enumerate(columns) if x not in standard]
+                    if header is not None:
+                        continue
+                if len(words) != len(columns):
+                    raise MalformedInputFile("Unexpected number of columns found in %s" %
+                                             (self.psam_file))
+                row = dict(zip(columns, words))
+                iid = row["IID"]
+                fid = row.get("FID", iid)
+                indid = PhenoCovar.build_id([fid, iid])
+                if DataParser.valid_indid(indid):
+                    mask_components.append(0)
+
+                    sex = None
+                    pheno = None
+                    pheno_text = str(PhenoCovar.missing_encoding)
+                    if "SEX" in row:
+                        sex = {"1": 1, "2": 2, "M": 1, "F": 2}.get(row["SEX"].upper(), 0)
+                    if DataParser.has_pheno and len(pheno_columns) > 0:
+                        pheno_text = words[pheno_columns[0]]
+                        try:
+                            pheno = float(pheno_text)
+                        except ValueError:
+                            pheno = PhenoCovar.missing_encoding
+                    if pheno_covar is not None:
+                        pheno_covar.add_subject(indid, sex, pheno)
+                    self.families.append([fid, iid, row.get("PAT", "0"), row.get("MAT", "0"),
+                                          str(sex or 0), pheno_text])
+                else:
+                    mask_components.append(1)
+        self.ind_mask = numpy.array(mask_components)
+        self.ind_count = self.ind_mask.shape[0]
+        if pheno_covar is not None:
+            pheno_covar.freeze_subjects()
+
+    def pvar_columns(self):
+        """Determine the columns present in the .pvar file
+
+        :return: (column count, [CHROM, POS, ID, REF, ALT] column indices)
+
+        Files without a #CHROM header are treated as .bim files, whose
+        first allele is the ALT allele.
+        """
+        header = None
+        first = None
+        with open(self.pvar_file) as file:
+            for line in file:
+                if line[0:6] == "#CHROM":
+                    header = line.strip().split()
+                    break
+                if line[0] != "#":
+                    first = line.strip().split()
+                    break
+        if header is not None:
+            header = [x.lstrip("#").upper() for x in header]
+            try:
+                return len(header), [header.index(x) for x in ("CHROM", "POS", "ID",
+                                                                "REF", "ALT")]
+            except ValueError:
+                raise MalformedInputFile("Missing required column in %s" % (self.pvar_file))
+        if first is not None and len(first) == 5:
+            return 5, [0, 2, 1, 4, 3]
+        return 6, [0, 3, 1, 5, 4]
+
+    def load_pvar(self):
+        """Load marker details into the same columns used by the .bed parser
+
+        :return: None
+        """
+        logging.info("Loading file: %s" % self.pvar_file)
+        column_count, cols = self.pvar_columns()
+
+        chroms = [numpy.zeros(0, dtype=numpy.int16)]
+        positions = [numpy.zeros(0, dtype=numpy.int32)]
+        rsids = []
+        self.alleles = marker_table.AlleleTable()
+
+        for chr, pos, rsid, ref, alt in marker_table.read_columns(self.pvar_file,
+                                                                  column_count,
+                                                                  cols,
+                                                                  comment=b"#"):
+            chroms.append(marker_table.chrom_codes(chr))
+            positions.append(pos.astype(numpy.int32))
+            rsids.append(marker_table.StringTable.from_list(list(rsid)))
+            self.alleles.append(self.alleles.encode(numpy.stack([ref, alt], axis=1)))
+
+        self.chroms = numpy.concatenate(chroms)
+        self.positions = numpy.concatenate(positions)
+        self.rsids = marker_table.StringTable.concatenate(rsids)
+        self.locus_count = self.chroms.shape[0]
+
+    def load_bim(self, map3=False):
+        self.load_pvar()
+
+    def load_fam(self, pheno_covar=None):
+        self.load_psam(pheno_covar)
+
+    def read_header(self):
+        """Read the .pgen header and, for variable width files, the record \
+            index.
+
+        :return: None
+        """
+        self.genotype_file.seek(0)
+        header = self.genotype_file.read(12)
+        if len(header) < 3 or struct.unpack("<H", header[0:2])[0] != bed_parser.magic_number:
+            raise MalformedInputFile("%s isn't a .pgen file" % (self.pgen_file))
+        self.storage_mode = header[2]
+        self.code_genotypes = numpy.array([0, 1, 2, DataParser.missing_storage],
+                                          dtype=numpy.int8)
+        self.bytes_per_read = int((self.ind_count + 3) / 4)
+
+        if self.storage_mode == bed_mode:
+            variant_count, sample_count = self.chroms.shape[0], self.ind_count
+            data_start = 3
+            # Translate the .bed codes into .pgen codes
+            self.code_genotypes = self.code_genotypes[[2, 3, 1, 0]]
+        elif self.storage_mode in (fixed_mode, variable_mode):
+            # Both modes use a 12 byte header. The final byte describes the
+            # variable width index, so it must be 0 for fixed width files
+            if len(header) < 12:
+                raise MalformedInputFile("Truncated header found in %s" % (self.pgen_file))
+            if self.storage_mode == fixed_mode and header[11] != 0:
+                raise MalformedInputFile("%s is fixed width, but its header control byte "
+                                         "is %d rather than 0" % (self.pgen_file, header[11]))
+            variant_count, sample_count = struct.unpack("<II", header[3:11])
+            data_start = 12
+        else:
+            Exit("Unsupported .pgen storage mode, %d, found in %s" %
+                 (self.storage_mode, self.pgen_file))
+
+        if variant_count != self.chroms.shape[0] or sample_count != self.ind_count:
+            raise MalformedInputFile("%s describes %d variants and %d samples, but %d "
+                                     "and %d were found in %s and %s" %
+                                     (self.pgen_file, variant_count, sample_count,
+                                      self.chroms.shape[0], self.ind_count,
+                                      self.pvar_file, self.psam_file))
+        if self.storage_mode == variable_mode:
+            self.read_index(header[11], variant_count)
+        else:
+            self.record_offsets = data_start + numpy.arange(variant_count + 1,
+                                                            dtype=numpy.int64) * \
+                self.bytes_per_read
+
+    def read_index(self, control, variant_count):
+        """Load the record types and lengths for a variable width file
+
+        :param control: header byte describing the index layout
+        :param variant_count: number of variants in the file
+        :return: None
+        """
+        storage = control & 15
+        if storage < 4:
+            type_bits, length_bytes = 4, storage + 1
+        elif storage < 8:
+            type_bits, length_bytes = 8, storage - 3
+        else:
+            raise MalformedInputFile("Unsupported .pgen index layout, %d, found in %s" %
+                                     (storage, self.pgen_file))
+        allele_count_bytes = (control >> 4) & 3
+        nonref_flags = (control >> 6) == 3
+
+        block_count = int((variant_count + variants_per_block - 1) / variants_per_block)
+        block_starts = numpy.frombuffer(self.genotype_file.read(8 * block_count), dtype="<u8")
+        self.record_types = numpy.zeros(variant_count, dtype=numpy.uint8)
+        self.record_offsets = numpy.zeros(variant_count + 1, dtype=numpy.int64)
+        for block in range(block_count):
+            first = block * variants_per_block
+            count = min(variants_per_block, variant_count - first)
+            if type_bits == 4:
+                packed = numpy.frombuffer(self.genotype_file.read(int((count + 1) / 2)),
+                                          dtype=numpy.uint8)
+                types = numpy.stack([packed & 15, packed >> 4], axis=1).reshape(-1)[0:count]
+            else:
+                types = numpy.frombuffer(self.genotype_file.read(count), dtype=numpy.uint8)
+            lengths = little_endian(numpy.frombuffer(self.genotype_file.read(count * length_bytes),
+                                                     dtype=numpy.uint8), length_bytes)
+            self.genotype_file.read(count * allele_count_bytes +
+                                    int(nonref_flags) * int((count + 7) / 8))
+
+            self.record_types[first:first + count] = types
+            self.record_offsets[first] = int(block_starts[block])
+            numpy.cumsum(lengths, out=self.record_offsets[first + 1:first + count + 1])
+            self.record_offsets[first + 1:first + count + 1] += int(block_starts[block])
+
+        # LD compressed records (types 2 and 3) refer back to the latest
+        # record that isn't
+        not_ld = (self.record_types & 6) != 2
+        self.ld_bases = numpy.maximum.accumulate(
+            numpy.where(not_ld, numpy.arange(variant_count), -1))
+
+    def read_record(self, index):
+        """Pull the raw bytes for a record from the .pgen file"""
+        start = int(self.record_offsets[index])
+        self.genotype_file.seek(start)
+        return self.genotype_file.read(int(self.record_offsets[index + 1]) - start)
+
+    def decode_record(self, index):
+        """Decode a variable width record into main track codes, tracking \
+            the LD base as needed
+
+        :param index: index of the record
+        :return: int8 array of genotype codes for all samples
+        """
+        record_type = int(self.record_types[index])
+        ld_base = None
+        if record_type & 6 == 2:
+            base = int(self.ld_bases[index])
+            if base < 0:
+                raise MalformedInputFile("LD compressed .pgen record found without a base")
+            if base != self.ld_base_index:
+                self.decode_record(base)
+            ld_base = self.ld_base_codes
+        codes = decode_main_track(self.read_record(index), record_type,
+                                  self.ind_count, ld_base)
+        if record_type & 6 != 2:
+            self.ld_base_index = index
+            self.ld_base_codes = codes
+        return codes
+
+    def locus_genotypes(self, index):
+        """Genotypes (for all samples) of a single locus"""
+        if self.storage_mode == variable_mode:
+            return self.code_genotypes[self.decode_record(index)]
+        return self.code_genotypes[decode_genotypes(self.read_record(index), self.ind_count,
+                                                    bed_parser.code_table,
+                                                    out=self.decode_buffer)]
+
+    def filter_missing(self):
+        """Determine which individuals exceed the individual missingness \
+            threshold across the loci within the boundary.
+
+        :return: None
+        """
+        locus_count = 0
+        logging.info("Sorting out missing data from genotype data")
+        DataParser.boundary.beyond_upper_bound = False
+
+        self.read_header()
+        self.decode_buffer = numpy.empty(self.bytes_per_read * 4, dtype=numpy.int8)
+        self.ind_index = numpy.flatnonzero(self.ind_mask == 0)
+        self.first_locus, self.last_locus = self.locus_range()
+
+        missing_code = int(numpy.flatnonzero(self.code_genotypes ==
+                                             DataParser.missing_storage)[0])
+        block_size = 1
+        if self.storage_mode != variable_mode:
+            # Fixed width records can be decoded as many at a time as the
+            # buffer size permits, just as they are for .bed files
+            block_size = max(1, int(Parser.decode_buffer_size / (self.bytes_per_read * 4)))
+        missing = numpy.zeros(self.ind_count, dtype=numpy.int32)
+        for start in range(self.first_locus, self.last_locus, block_size):
+            stop = min(start + block_size, self.last_locus)
+            valid = numpy.zeros(stop - start, dtype=bool)
+            for index in range(start, stop):
+                valid[index - start] = DataParser.boundary.TestBoundary(int(self.chroms[index]),
+                                                                        int(self.positions[index]),
+                                                                        self.rsids[index])
+            if not numpy.any(valid):
+                continue
+            locus_count += int(numpy.sum(valid))
+            if self.storage_mode == variable_mode:
+                missing += self.decode_record(start) == missing_code
+            else:
+                self.genotype_file.seek(int(self.record_offsets[start]))
+                packed = numpy.frombuffer(self.genotype_file.read((stop - start) *
+                                                                  self.bytes_per_read),
+                                          dtype=numpy.uint8).reshape(-1, self.bytes_per_read)
+                codes = decode_genotypes(packed[valid], self.ind_count, bed_parser.code_table)
+                missing += numpy.sum(codes == missing_code, axis=0)
+
+        max_missing = DataParser.ind_miss_tol * locus_count
+        dropped_individuals = max_missing < missing
+        if numpy.sum(dropped_individuals) > 0:
+            # This will be ORd, so it needs to be one for not
+            self.alt_not_missing = ~dropped_individuals[self.ind_mask != 1]
+
+        self.total_locus_count = self.locus_count
+        self.locus_count = locus_count
+
+    def load_genotypes(self):
+        """Prepares the file for genotype parsing.
+
+        :return: None
+        """
+        self.genotype_file = open(self.pgen_file, "rb")
+        self.filter_missing()
+
+    def populate_iteration(self, iteration):
+        """Parse genotypes from the file and iteration with relevant marker \
+            details.
+
+        :param iteration: ParseLocus object which is returned per iteration
+        :return: True indicates current locus is valid.
+
+        StopIteration is thrown if the marker reaches the end of the file or
+        the valid genomic region for analysis.
+        """
+        cur_idx = iteration.cur_idx
+
+        if cur_idx >= self.last_locus:
+            raise StopIteration
+
+        iteration.chr = int(self.chroms[cur_idx])
+        iteration.pos = int(self.positions[cur_idx])
+        iteration.rsid = self.rsids[cur_idx]
+        iteration.alleles = self.alleles[cur_idx]
+        if DataParser.boundary.TestBoundary(iteration.chr,
+                                            iteration.pos,
+                                            iteration.rsid):
+            iteration.genotype_data = self.locus_genotypes(cur_idx)[self.ind_index]
+            iteration.missing_genotypes = iteration.genotype_data == DataParser.missing_storage
+            return True
+        return False
+
+    def __iter__(self):
+        """Start iteration back at the first locus within the boundary
+
+        :return: ParsedLocus representing the first locus.
+        """
+        DataParser.boundary.beyond_upper_bound = False
+        return ParsedLocus(self, self.first_locus - 1)
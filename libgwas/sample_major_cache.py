@@ -0,0 +1,141 @@
+import os
+import struct
+import logging
+import numpy
+from . import bed_parser
+from .pheno_covar import PhenoCovar
+from .exceptions import InvalidSelection
+
+__copyright__ = "Eric Torstenson"
+__license__ = "GPL3.0"
+#     This file is part of libGWAS.
+#
+#     libGWAS is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     libGWAS is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with MVtest.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class SampleMajorCache(object):
+    """Sample major companion to a locus major .bed file.
+
+    Pulling every genotype for a handful of samples from locus major data
+    requires reading the entire file. The companion stores the same packed
+    genotypes transposed (i.e. an individual major .bed file), so that each
+    sample's genotypes are contiguous and can be read on their own.
+
+    The companion is built once from a bed_parser.Parser whose .fam and .bim
+    files have been loaded, and is reused as long as it is newer than the
+    .bed file.
+    """
+
+    #: Memory (in bytes) available while building the companion file
+    transpose_budget = 1 << 28
+
+    def __init__(self, filename, sample_ids, locus_count, decode_table):
+        """Open an existing companion file
+
+        :param filename: sample major .bed file
+        :param sample_ids: IDs for every sample in the file (in order)
+        :param locus_count: number of loci for each sample
+        :param decode_table: lookup table from bed_parser.build_decode_table
+        """
+        #: Filename for the sample major data
+        self.filename = filename
+
+        #: ID => row within the file
+        self.sample_index = dict((x, i) for i, x in enumerate(sample_ids))
+
+        #: Number of loci found for each sample
+        self.locus_count = locus_count
+
+        self.decode_table = decode_table
+
+        #: Packed genotypes (samples x bytes per sample)
+        self.packed_genotypes = numpy.memmap(filename, dtype=numpy.uint8, mode="r",
+                                             offset=3,
+                                             shape=(len(sample_ids),
+                                                    int((locus_count + 3) / 4)))
+
+    @staticmethod
+    def default_filename(parser):
+        return "%s.sample_major.bed" % (os.path.splitext(parser.bed_file)[0])
+
+    @staticmethod
+    def load_sample_ids(parser):
+        """Build IDs for every sample in the .fam file (including those \
+            masked out by the parser)"""
+        sample_ids = []
+        with open(parser.fam_file) as file:
+            for line in file:
+                words = line.strip().split()
+                if len(words) > 1:
+                    sample_ids.append(PhenoCovar.build_id(words))
+        return sample_ids
+
+    @classmethod
+    def from_parser(cls, parser, filename=None, rebuild=False):
+        """Open the companion for parser, building it if necessary
+
+        :param parser: bed_parser.Parser whose genotypes have been loaded
+        :param filename: companion filename (defaults to the .bed prefix
+                         with .sample_major.bed as the extension)
+        :param rebuild: when true, the companion is always rebuilt
+        :return: SampleMajorCache
+        """
+        if filename is None:
+            filename = cls.default_filename(parser)
+        sample_ids = cls.load_sample_ids(parser)
+        locus_count = parser.chroms.shape[0]
+        expected_size = 3 + len(sample_ids) * int((locus_count + 3) / 4)
+
+        if rebuild or not os.path.exists(filename) or \
+                os.path.getsize(filename) != expected_size or \
+                os.path.getmtime(filename) < os.path.getmtime(parser.bed_file):
+            cls.build(parser, filename, len(sample_ids), locus_count)
+        return cls(filename, sample_ids, locus_count, parser.decode_table)
+
+    @classmethod
+    def build(cls, parser, filename, sample_count, locus_count):
+        """Write the transposed genotypes from parser to filename"""
+        logging.info("Building sample major companion, %s" % (filename))
+        source = numpy.memmap(parser.genotype_file.name, dtype=numpy.uint8, mode="r",
+                              offset=3, shape=(locus_count, parser.bytes_per_read))
+        with open(filename, "wb") as file:
+            file.write(struct.pack("<HB", bed_parser.magic_number, 0))
+            file.truncate(3 + sample_count * int((locus_count + 3) / 4))
+        if sample_count > 0 and locus_count > 0:
+            dest = numpy.memmap(filename, dtype=numpy.uint8, mode="r+", offset=3,
+                                shape=(sample_count, int((locus_count + 3) / 4)))
+            bed_parser.transpose_packed(source, locus_count, sample_count, dest,
+                                        cls.transpose_budget)
+            dest.flush()
+            del dest
+        del source
+
+    def genotypes(self, sample_ids):
+        """Return all genotypes for the samples listed
+
+        :param sample_ids: list of sample IDs (as built by PhenoCovar)
+        :return: int8 array (len(sample_ids), locus_count)
+
+        Raises InvalidSelection if any of the IDs aren't present.
+        """
+        indices = []
+        for sample_id in sample_ids:
+            if sample_id not in self.sample_index:
+                raise InvalidSelection("Sample, %s, not found in %s" %
+                                       (sample_id, self.filename))
+            indices.append(self.sample_index[sample_id])
+
+        packed = self.packed_genotypes[numpy.array(indices, dtype=numpy.int64)]
+        return bed_parser.decode_genotypes(packed.reshape(len(indices), -1),
+                                           self.locus_count, self.decode_table)
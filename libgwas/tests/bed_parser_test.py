@@ -7,6 +7,7 @@ if "DEBUG" in sys.argv:
     sys.path.insert(0, ".")
     sys.argv.remove("DEBUG")
 from libgwas import bed_parser
+from libgwas import marker_table
 from libgwas.boundary import BoundaryCheck
 from libgwas.snp_boundary_check import SnpBoundaryCheck
 from libgwas.data_parser import DataParser
@@ -18,6 +19,9 @@ from libgwas.exceptions import InvariantVar
 import libgwas 
 
 import unittest
+import os
+import shutil
+import tempfile
 
 from pkg_resources import resource_filename
 
@@ -634,5 +638,294 @@ class TestBedFilesTPed(TestBase):
         self.assertEqual(6, index)
 
 
+class TestBedDecoding(TestBase):
+    def testDecodeTable(self):
+        conversions = {0:2, 3:0, 2:1, 1:-1}
+        table = bed_parser.build_decode_table(conversions)
+        for byte in range(256):
+            expected = [conversions[(byte >> (i*2)) & 3] for i in range(4)]
+            self.assertEqual(expected, list(table[byte]))
+
+    def testDecodeBlock(self):
+        ped_parser = bed_parser.Parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+
+        with open(self.nonmissing_bed, "rb") as f:
+            f.read(3)
+            packed = numpy.frombuffer(f.read(), dtype=numpy.uint8).reshape(7, -1)
+        buffer = numpy.zeros((7, packed.shape[1] * 4), dtype=numpy.int8)
+        genotypes = bed_parser.decode_genotypes(packed, 12, ped_parser.decode_table, out=buffer)
+        self.assertEqual((7, 12), genotypes.shape)
+        self.assertEqual(self.genotypes, genotypes.tolist())
+
+        # Individual loci should agree with the block
+        for index in range(7):
+            self.assertEqual(self.genotypes[index],
+                             list(ped_parser.extract_genotypes(packed[index].tobytes())))
+
+
+class TestBedMemmap(TestBase):
+    def setUp(self):
+        super(TestBedMemmap, self).setUp()
+        self.use_memmap = bed_parser.Parser.use_memmap
+
+    def tearDown(self):
+        super(TestBedMemmap, self).tearDown()
+        bed_parser.Parser.use_memmap = self.use_memmap
+
+    def load_parser(self, fam, bim, bed):
+        ped_parser = bed_parser.Parser(fam, bim, bed)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+        return ped_parser
+
+    def testMemmapMatchesFile(self):
+        ped_parser = self.load_parser(self.missing_fam, self.missing_bim, self.missing_bed)
+        expected = [list(snp.genotype_data) for snp in ped_parser]
+
+        bed_parser.Parser.use_memmap = True
+        ped_parser = self.load_parser(self.missing_fam, self.missing_bim, self.missing_bed)
+        self.assertEqual((7, 3), ped_parser.packed_genotypes.shape)
+        self.assertEqual(expected, [list(snp.genotype_data) for snp in ped_parser])
+
+        # Iterating a second time should produce the same results
+        self.assertEqual(expected, [list(snp.genotype_data) for snp in ped_parser])
+
+    def testRandomAccess(self):
+        bed_parser.Parser.use_memmap = True
+        ped_parser = self.load_parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        genotypes = bed_parser.decode_genotypes(ped_parser.read_loci(2, 5), 12, ped_parser.decode_table)
+        self.assertEqual(self.genotypes[2:5], genotypes.tolist())
+        self.assertEqual(self.genotypes[6], list(ped_parser.extract_genotypes(ped_parser.read_locus(6))))
+
+        # Random access also works when reading through the file object
+        bed_parser.Parser.use_memmap = False
+        ped_parser = self.load_parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        self.assertIsNone(ped_parser.packed_genotypes)
+        genotypes = bed_parser.decode_genotypes(ped_parser.read_loci(2, 5), 12, ped_parser.decode_table)
+        self.assertEqual(self.genotypes[2:5], genotypes.tolist())
+
+
+class TestBedPackedCounts(TestBase):
+    def setUp(self):
+        super(TestBedPackedCounts, self).setUp()
+        self.prefilter = bed_parser.Parser.prefilter
+
+    def tearDown(self):
+        super(TestBedPackedCounts, self).tearDown()
+        bed_parser.Parser.prefilter = self.prefilter
+
+    def testCountsMatchDecoded(self):
+        table = bed_parser.build_decode_table({0:2, 3:0, 2:1, 1:-1})
+        random = numpy.random.RandomState(1337)
+        packed = random.randint(0, 256, size=(25, 9)).astype(numpy.uint8)
+        keep = random.randint(0, 2, size=34) == 1
+
+        counts = bed_parser.count_genotypes(packed, bed_parser.pack_codes(keep))
+        genotypes = bed_parser.decode_genotypes(packed, 34, table)[:, keep]
+        for index in range(25):
+            expected = [numpy.sum(genotypes[index] == x) for x in [0, 1, 2, -1]]
+            self.assertEqual(expected, list(counts[index]))
+
+    def testPackCodes(self):
+        codes = numpy.array([[3, 0, 2, 1, 1], [0, 0, 0, 0, 3]])
+        self.assertEqual([[0b01100011, 0b01], [0, 0b11]], bed_parser.pack_codes(codes).tolist())
+
+    def testPrefilterMissing(self):
+        bed_parser.Parser.prefilter = True
+        DataParser.snp_miss_tol = 0.5
+        ped_parser = bed_parser.Parser(self.missing_fam, self.missing_bim, self.missing_bed)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+
+        rsids = [snp.rsid for snp in ped_parser]
+        self.assertEqual([x[1] for x in self.missing_mapdata[1:]], rsids)
+
+    def testPrefilterMaf(self):
+        bed_parser.Parser.prefilter = True
+        DataParser.min_maf = 0.2
+        ped_parser = bed_parser.Parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+
+        loci = []
+        for snp in ped_parser:
+            self.assertEqual(snp.hetero_count, numpy.sum(snp.genotype_data == 1))
+            self.assertEqual(snp.min_allele_count, numpy.sum(snp.genotype_data))
+            loci.append(snp.rsid)
+        self.assertEqual(["rs0002", "rs0003", "rs0004", "rs0005"], loci)
+
+
+class TestBimLoading(TestBase):
+    def setUp(self):
+        super(TestBimLoading, self).setUp()
+        self.cache_bim = bed_parser.Parser.cache_bim
+        self.chunk_size = marker_table.chunk_size
+
+    def tearDown(self):
+        super(TestBimLoading, self).tearDown()
+        bed_parser.Parser.cache_bim = self.cache_bim
+        marker_table.chunk_size = self.chunk_size
+
+    def testColumns(self):
+        # Force the file to be read across several chunks
+        marker_table.chunk_size = 20
+        ped_parser = bed_parser.Parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        ped_parser.load_bim(map3=False)
+
+        self.assertEqual(7, ped_parser.locus_count)
+        self.assertEqual([int(x[0]) for x in self.nonmissing_mapdata], list(ped_parser.chroms))
+        self.assertEqual([int(x[3]) for x in self.nonmissing_mapdata], list(ped_parser.positions))
+        self.assertEqual([x[1] for x in self.nonmissing_mapdata], list(ped_parser.rsids))
+        self.assertEqual([[x[5], x[4]] for x in self.nonmissing_mapdata], list(ped_parser.alleles))
+        self.assertEqual(3, ped_parser.rsids.index("rs0004"))
+        self.assertEqual([2, 750], list(ped_parser.markers[4]))
+        self.assertIs(ped_parser.markers, ped_parser.markers)
+
+        # Reloading the columns must not leave stale markers behind
+        markers = ped_parser.markers
+        ped_parser.load_bim(map3=False)
+        self.assertIsNot(markers, ped_parser.markers)
+        self.assertEqual([2, 750], list(ped_parser.markers[4]))
+
+    def testNamedChromosomes(self):
+        bim = tempfile.NamedTemporaryFile(mode="w", suffix=".bim", delete=False)
+        bim.write("1\trs1\t0\t100\tA\tG\nX\trs2\t0\t200\tAT\tA\nchrMT\trs3\t0\t50\tC\tT\n")
+        bim.close()
+        try:
+            ped_parser = bed_parser.Parser(self.nonmissing_fam, bim.name, self.nonmissing_bed)
+            ped_parser.load_bim(map3=False)
+            self.assertEqual([1, 23, 25], list(ped_parser.chroms))
+            self.assertEqual(["A", "AT"], ped_parser.alleles[1])
+        finally:
+            os.remove(bim.name)
+
+    def testCache(self):
+        bed_parser.Parser.cache_bim = True
+        tmpdir = tempfile.mkdtemp()
+        bim = os.path.join(tmpdir, "cached.bim")
+        shutil.copy(self.nonmissing_bim, bim)
+        try:
+            ped_parser = bed_parser.Parser(self.nonmissing_fam, bim, self.nonmissing_bed)
+            ped_parser.load_bim(map3=False)
+            self.assertTrue(os.path.exists(ped_parser.bim_cache_file))
+
+            cached = bed_parser.Parser(self.nonmissing_fam, bim, self.nonmissing_bed)
+            self.assertTrue(cached.load_bim_cache(map3=False))
+            self.assertEqual(list(ped_parser.chroms), list(cached.chroms))
+            self.assertEqual(list(ped_parser.positions), list(cached.positions))
+            self.assertEqual(list(ped_parser.rsids), list(cached.rsids))
+            self.assertEqual(list(ped_parser.alleles), list(cached.alleles))
+
+            # A different format shouldn't reuse the cache
+            self.assertFalse(cached.load_bim_cache(map3=True))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestBedSeek(TestBase):
+    def load_parser(self):
+        ped_parser = bed_parser.Parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+        return ped_parser
+
+    def testNoBoundary(self):
+        ped_parser = self.load_parser()
+        self.assertEqual((0, 7), ped_parser.locus_range())
+
+    def testChromosome(self):
+        BoundaryCheck.chrom = 1
+        ped_parser = self.load_parser()
+        self.assertEqual((0, 4), (ped_parser.first_locus, ped_parser.last_locus))
+        self.assertEqual(4, ped_parser.locus_count)
+        self.assertEqual(self.genotypes[0:4], [list(x.genotype_data) for x in ped_parser])
+
+    def testRegion(self):
+        BoundaryCheck.chrom = 2
+        DataParser.boundary = BoundaryCheck(bp=[5000, 25000])
+        ped_parser = self.load_parser()
+        self.assertEqual((5, 7), (ped_parser.first_locus, ped_parser.last_locus))
+        self.assertEqual(2, ped_parser.locus_count)
+        self.assertEqual(["rs0006", "rs0007"], [x.rsid for x in ped_parser])
+        self.assertEqual(self.genotypes[5:7], [list(x.genotype_data) for x in ped_parser])
+
+    def testEmptyRegion(self):
+        BoundaryCheck.chrom = 2
+        DataParser.boundary = BoundaryCheck(bp=[30000, 40000])
+        ped_parser = self.load_parser()
+        self.assertEqual(ped_parser.first_locus, ped_parser.last_locus)
+        self.assertEqual([], [x.rsid for x in ped_parser])
+
+    def testSnpRange(self):
+        DataParser.boundary = SnpBoundaryCheck(snps=["rs0002-rs0003"])
+        BoundaryCheck.chrom = 1
+        ped_parser = self.load_parser()
+        self.assertEqual((1, 3), (ped_parser.first_locus, ped_parser.last_locus))
+        self.assertEqual(["rs0002", "rs0003"], [x.rsid for x in ped_parser])
+
+
+class TestIndividualMajor(TestBase):
+    def setUp(self):
+        super(TestIndividualMajor, self).setUp()
+        self.use_memmap = bed_parser.Parser.use_memmap
+        self.transpose_budget = bed_parser.Parser.transpose_budget
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestIndividualMajor, self).tearDown()
+        bed_parser.Parser.use_memmap = self.use_memmap
+        bed_parser.Parser.transpose_budget = self.transpose_budget
+        shutil.rmtree(self.tmpdir)
+
+    def write_individual_major(self, bed):
+        """Rewrite the locus major bed file as individual major"""
+        with open(bed, "rb") as f:
+            f.read(3)
+            packed = numpy.frombuffer(f.read(), dtype=numpy.uint8).reshape(7, -1)
+        codes = bed_parser.decode_genotypes(packed, 12, bed_parser.code_table)
+        filename = os.path.join(self.tmpdir, "indmajor.bed")
+        with open(filename, "wb") as f:
+            f.write(bytes([0x6c, 0x1b, 0x00]))
+            f.write(bed_parser.pack_codes(codes.T).tobytes())
+        return filename
+
+    def testTranspose(self):
+        random = numpy.random.RandomState(42)
+        codes = random.randint(0, 4, size=(13, 22))
+        dest = numpy.zeros((22, 4), dtype=numpy.uint8)
+        # Tiny budget to force several blocks
+        bed_parser.transpose_packed(bed_parser.pack_codes(codes), 13, 22, dest, 1)
+        self.assertEqual(bed_parser.pack_codes(codes.T).tolist(), dest.tolist())
+
+    def testIndividualMajor(self):
+        bed_parser.Parser.transpose_budget = 64
+        bed = self.write_individual_major(self.missing_bed)
+        for use_memmap in [False, True]:
+            bed_parser.Parser.use_memmap = use_memmap
+            expected = bed_parser.Parser(self.missing_fam, self.missing_bim, self.missing_bed)
+            expected.load_fam()
+            expected.load_bim(map3=False)
+            expected.load_genotypes()
+
+            ped_parser = bed_parser.Parser(self.missing_fam, self.missing_bim, bed)
+            ped_parser.load_fam()
+            ped_parser.load_bim(map3=False)
+            ped_parser.load_genotypes()
+            transposed = ped_parser.transposed_file
+            self.assertTrue(os.path.exists(transposed))
+
+            self.assertEqual([list(x.genotype_data) for x in expected],
+                             [list(x.genotype_data) for x in ped_parser])
+            del ped_parser
+            self.assertFalse(os.path.exists(transposed))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+import sys
+
+if "DEBUG" in sys.argv:
+    sys.path.insert(0, "../../")
+    sys.path.insert(0, "../")
+    sys.path.insert(0, ".")
+    sys.argv.remove("DEBUG")
+
+import gzip
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+import numpy
+from libgwas import bcf_parser
+from libgwas.bcf_parser import Parser
+from libgwas.boundary import BoundaryCheck
+from libgwas.data_parser import DataParser
+from libgwas.pheno_covar import PhenoCovar
+from libgwas.tests import remove_file
+from libgwas.tests import test_vcf_parser
+
+# Dictionary (FILTER/INFO/FORMAT) and contig lines used by the test files
+header_lines = [
+    "##fileformat=VCFv4.2",
+    '##FILTER=<ID=PASS,Description="All filters passed">',
+    '##FILTER=<ID=q10,Description="Quality below 10">',
+    "##contig=<ID=1,length=45001>",
+    "##contig=<ID=2,length=25001>",
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=DS,Number=1,Type=Float,Description="Dosage">',
+    '##FORMAT=<ID=GP,Number=G,Type=Float,Description="Genotype probabilities">',
+    '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">',
+    '##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP membership">',
+]
+strings = {"PASS": 0, "q10": 1, "GT": 2, "DS": 3, "GP": 4, "AF": 5, "DP": 6, "DB": 7}
+
+#: INFO fields written to each record unless told otherwise (key, type, values)
+default_info = [("AF", 5, [0.25]), ("DP", 1, [30]), ("DB", 0, [])]
+contigs = {"1": 0, "2": 1}
+
+
+def typed_string(value):
+    value = value.encode()
+    return struct.pack("<B", (len(value) << 4) | 7) + value
+
+
+def typed_key(value):
+    return struct.pack("<Bb", 0x11, value)
+
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + \
+        struct.pack("<H", len(deflated) + 25) + deflated + \
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def encode_record(chrom, pos, rsid, ref, alt, filter, fields, sample_count, info=None):
+    """Encode a single record. fields are (key, type, values per sample) and
+    info are (key, type, values)"""
+    if info is None:
+        info = default_info
+    alleles = [ref] + alt.split(",")
+    shared = struct.pack("<iiifII", contigs[chrom], pos - 1, len(ref), 0.0,
+                         (len(alleles) << 16) | len(info), (len(fields) << 24) | sample_count)
+    shared = shared[:12] + struct.pack("<I", 0x7F800001) + shared[16:]
+    shared += typed_string(rsid) + b"".join([typed_string(x) for x in alleles])
+    if filter is None:
+        shared += b"\x00"
+    else:
+        shared += struct.pack("<Bb", 0x11, strings[filter])
+    for key, value_type, values in info:
+        shared += typed_key(strings[key])
+        shared += struct.pack("<B", (len(values) << 4) | value_type)
+        if value_type != 0:
+            shared += numpy.asarray(values, dtype=bcf_parser.type_dtypes[value_type]).tobytes()
+    indiv = b""
+    for key, value_type, values in fields:
+        values = numpy.asarray(values)
+        indiv += typed_key(strings[key])
+        indiv += struct.pack("<B", (values.shape[1] << 4) | value_type)
+        indiv += values.astype(bcf_parser.type_dtypes[value_type]).tobytes()
+    return struct.pack("<II", len(shared), len(indiv)) + shared + indiv
+
+
+def write_bcf(filename, samples, records, index=True):
+    """Write records (as encoded by encode_record), one per BGZF block, \
+        along with a CSI index when index is True"""
+    text = "\n".join(header_lines + ["\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                                                "FILTER", "INFO", "FORMAT"] + samples)])
+    text = text.encode() + b"\n\0"
+    bins = [{}, {}]
+    with open(filename, "wb") as file:
+        file.write(bgzf_block(b"BCF\2\2" + struct.pack("<I", len(text)) + text))
+        for record in records:
+            start = file.tell() << 16
+            file.write(bgzf_block(record))
+            chrom, pos, rlen = struct.unpack_from("<iii", record, 8)
+            bin = bcf_parser.reg2bin(pos, pos + rlen, 14, 5)
+            bins[chrom].setdefault(bin, []).append((start, file.tell() << 16))
+        file.write(bgzf_block(b""))
+
+    if index:
+        data = b"CSI\1" + struct.pack("<iiii", 14, 5, 0, len(bins))
+        for reference in bins:
+            data += struct.pack("<i", len(reference))
+            for bin, chunks in sorted(reference.items()):
+                data += struct.pack("<IQi", bin, chunks[0][0], len(chunks))
+                for chunk in chunks:
+                    data += struct.pack("<QQ", chunk[0], chunk[1])
+        with gzip.open(filename + ".csi", "wb") as file:
+            file.write(data)
+
+
+def encode_gt(genotype):
+    """BCF encoding of the unphased call for a genotype (None is missing)"""
+    if genotype is None:
+        return [0, 0]
+    return [[2, 2], [2, 4], [4, 4]][genotype]
+
+
+class TestBcfFiles(test_vcf_parser.TestBase):
+    def setUp(self):
+        super(TestBcfFiles, self).setUp()
+        self.filename = tempfile.mktemp(suffix=".bcf")
+        self.samples = [str(x) for x in range(1, 13)]
+
+        records = []
+        for (chrom, pos, rsid, ref, alt), genotypes in zip(self.nonmissing_mapdata,
+                                                           self.genotypes):
+            dosages = numpy.array(genotypes, dtype=numpy.float32)[:, numpy.newaxis] * 0.9
+            probabilities = numpy.zeros((12, 3), dtype=numpy.float32)
+            probabilities[numpy.arange(12), genotypes] = 1.0
+            records.append(encode_record(chrom, int(pos), rsid, ref, alt, "PASS", [
+                ("GT", 1, [encode_gt(x) for x in genotypes]),
+                ("DS", 5, dosages),
+                ("GP", 5, probabilities)], 12))
+        write_bcf(self.filename, self.samples, records)
+
+    def tearDown(self):
+        for filename in [self.filename, self.filename + ".csi"]:
+            if os.path.exists(filename):
+                remove_file(filename)
+        super(TestBcfFiles, self).tearDown()
+
+    def load(self, data_field='GT', regions=None):
+        pc = PhenoCovar()
+        parser = Parser(self.filename, data_field=data_field, regions=regions)
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        return parser
+
+    def testHeader(self):
+        parser = self.load()
+        self.assertEqual(self.samples, parser.header.samples)
+        self.assertEqual(strings, parser.header.string_index)
+        self.assertEqual({0: "1", 1: "2"}, parser.header.contigs)
+
+    def testGenotypes(self):
+        parser = self.load()
+        self.assertEqual(7, parser.locus_count)
+        loci = []
+        for snp in parser:
+            self.assertEqual(numpy.int8, snp.genotype_data.dtype)
+            loci.append((snp.chr, snp.pos, snp.rsid, list(snp.alleles),
+                         list(snp.genotype_data)))
+        mapdata = self.nonmissing_mapdata
+        self.assertEqual([(int(x[0]), int(x[1]), x[2], [x[3], x[4]]) for x in mapdata],
+                         [x[0:4] for x in loci])
+        self.assertEqual(self.genotypes, [x[4] for x in loci])
+
+    def testDosages(self):
+        parser = self.load('DS')
+        loci = [list(snp.get_genotype_data(numpy.ones(12, dtype=bool)).genotypes)
+                for snp in parser]
+        numpy.testing.assert_allclose(numpy.array(self.genotypes) * 0.9, loci, rtol=1e-6)
+
+    def testProbabilities(self):
+        parser = self.load('GP')
+        loci = []
+        for snp in parser:
+            self.assertEqual((12, 3), snp.genotype_data.shape)
+            loci.append(list(snp.get_genotype_data(numpy.ones(12, dtype=bool)).genotypes))
+        numpy.testing.assert_allclose(self.genotypes, loci)
+
+    def testIndexedRegions(self):
+        regions = [("2", 10000, 30000), ("1", 500, 500), ("1", 20000, 30000),
+                   ("7", 1, 1000)]
+        parser = self.load(regions=regions)
+        self.assertIsNotNone(parser.index)
+        self.assertEqual(4, parser.locus_count)
+        loci = [(snp.rsid, list(snp.genotype_data)) for snp in parser]
+        self.assertEqual([("rs0001", self.genotypes[0]), ("rs0003", self.genotypes[2]),
+                          ("rs0006", self.genotypes[5]), ("rs0007", self.genotypes[6])],
+                         loci)
+
+    def testUnindexedRegions(self):
+        remove_file(self.filename + ".csi")
+        parser = self.load(regions=[("2", 10000, 30000), ("1", 500, 500)])
+        self.assertIsNone(parser.index)
+        self.assertEqual(["rs0001", "rs0006", "rs0007"], [snp.rsid for snp in parser])
+
+    def testBoundary(self):
+        BoundaryCheck.chrom = 1
+        DataParser.boundary = BoundaryCheck(bp=[10000, 25000])
+        parser = self.load()
+        self.assertEqual(["rs0002", "rs0003"], [snp.rsid for snp in parser])
+
+    def testSharedFields(self):
+        parser = self.load()
+        for info in [[], default_info]:
+            record = encode_record("2", 750, "rs9", "A", "C,TT", "q10", [], 12, info)
+            shared = record[8:8 + struct.unpack_from("<I", record, 0)[0]]
+            chrom, pos, qual, rsid, alleles, filter = parser.parse_shared(shared)
+            self.assertEqual((1, 750, "rs9", ["A", "C", "TT"], "q10"),
+                             (chrom, pos, rsid, alleles, filter))
+
+    def testCsiBins(self):
+        self.assertEqual(4681, bcf_parser.reg2bin(0, 1, 14, 5))
+        self.assertEqual(0, bcf_parser.reg2bin(0, 1 << 29, 14, 5))
+        bins = bcf_parser.reg2bins(0, 1, 14, 5)
+        self.assertEqual([0, 1, 9, 73, 585, 4681], bins)
+
+
+class TestBcfDecoding(unittest.TestCase):
+    def testGenotypes(self):
+        end = bcf_parser.int_vector_end[1]
+        values = numpy.array([[2, 2], [2, 5], [5, 5], [0, 0], [4, end], [2, 6], [3, 4]],
+                             dtype=numpy.int8)
+        self.assertEqual([0, 1, 2, -1, 2, -1, 1], list(bcf_parser.decode_gt(values, 1)))
+
+    def testWideGenotypes(self):
+        end = bcf_parser.int_vector_end[2]
+        values = numpy.array([[2, 4], [2, end], [300, 2]], dtype=numpy.int16)
+        self.assertEqual([1, 0, -1], list(bcf_parser.decode_gt(values, 2)))
+
+    def testFloats(self):
+        values = numpy.array([[0.1, 0.9, 0.0], [0.5, 0.5, 0.0], [0.0, 0.0, 1.0]],
+                             dtype=numpy.float32)
+        values.view(numpy.uint32)[1, 2] = bcf_parser.float_missing
+        values.view(numpy.uint32)[2, 0] = bcf_parser.float_vector_end
+        decoded = bcf_parser.decode_floats(values)
+        numpy.testing.assert_allclose([[0.1, 0.9, 0.0], [-1, -1, -1], [-1, -1, -1]], decoded)
+
+
+if __name__ == "__main__":
+    unittest.main()
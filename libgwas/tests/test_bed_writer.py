@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from libgwas.tests import bed_parser_test
+from libgwas import bed_parser
+from libgwas import vcf_parser
+from libgwas.bed_writer import Writer
+from libgwas.data_parser import DataParser
+from libgwas.pheno_covar import PhenoCovar
+from libgwas.pheno_covar import PhenoIdFormat
+from pkg_resources import resource_filename
+
+
+class TestBedWriter(bed_parser_test.TestBase):
+    def setUp(self):
+        super(TestBedWriter, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, "exported")
+        self.hard_call_threshold = Writer.hard_call_threshold
+        self.id_encoding = PhenoCovar.id_encoding
+
+    def tearDown(self):
+        super(TestBedWriter, self).tearDown()
+        Writer.hard_call_threshold = self.hard_call_threshold
+        PhenoCovar.id_encoding = self.id_encoding
+        shutil.rmtree(self.tmpdir)
+
+    def load_bed(self, fam, bim, bed):
+        pc = PhenoCovar()
+        parser = bed_parser.Parser(fam, bim, bed)
+        parser.load_fam(pc)
+        parser.load_bim(map3=False)
+        parser.load_genotypes()
+        return parser, pc
+
+    def testRoundTrip(self):
+        parser, pc = self.load_bed(self.missing_fam, self.missing_bim, self.missing_bed)
+        original = [(x.chr, x.pos, x.rsid, list(x.alleles), list(x.genotype_data))
+                    for x in parser]
+
+        self.assertEqual(7, Writer(self.prefix).write(parser, pc))
+        exported, pc = self.load_bed("%s.fam" % (self.prefix),
+                                     "%s.bim" % (self.prefix),
+                                     "%s.bed" % (self.prefix))
+        self.assertEqual(original, [(x.chr, x.pos, x.rsid, list(x.alleles),
+                                     list(x.genotype_data)) for x in exported])
+        with open(self.missing_fam) as f:
+            expected = [line.split() for line in f]
+        with open("%s.fam" % (self.prefix)) as f:
+            self.assertEqual(expected, [line.split() for line in f])
+
+    def testFilters(self):
+        DataParser.boundary.LoadExclusions(["rs0005"])
+        DataParser.min_maf = 0.3
+        parser, pc = self.load_bed(self.nonmissing_fam, self.nonmissing_bim,
+                                   self.nonmissing_bed)
+        expected = []
+        for locus in parser:
+            try:
+                locus.get_genotype_data(numpy.ones(12, dtype=bool))
+                expected.append(list(locus.genotype_data))
+            except Exception:
+                pass
+
+        self.assertEqual(len(expected), Writer(self.prefix).write(parser, pc))
+        exported, pc = self.load_bed("%s.fam" % (self.prefix),
+                                     "%s.bim" % (self.prefix),
+                                     "%s.bed" % (self.prefix))
+        self.assertEqual(expected, [list(x.genotype_data) for x in exported])
+        self.assertNotIn("rs0005", [x.rsid for x in exported])
+
+    def testFromVcf(self):
+        PhenoCovar.id_encoding = PhenoIdFormat.IID
+        pc = PhenoCovar()
+        parser = vcf_parser.Parser(resource_filename("libgwas", "tests/bedfiles/nomiss.vcf"),
+                                   data_field='GT')
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+
+        self.assertEqual(7, Writer(self.prefix).write(parser, pc))
+        exported, pc = self.load_bed("%s.fam" % (self.prefix),
+                                     "%s.bim" % (self.prefix),
+                                     "%s.bed" % (self.prefix))
+        self.assertEqual(self.genotypes, [list(x.genotype_data) for x in exported])
+        self.assertEqual(12, len(pc.pedigree_data))
+
+    def testHardCalls(self):
+        Writer.hard_call_threshold = 0.1
+        dosages = numpy.array([0.0, 0.05, 0.5, 1.02, 1.95, 2.0, numpy.nan])
+        self.assertEqual([0, 0, -1, 1, 2, 2, -1], list(Writer.hard_calls(dosages)))
+
+        probabilities = numpy.array([[0.95, 0.05, 0.0],
+                                     [0.1, 0.8, 0.1],
+                                     [0.0, 0.0, 1.0],
+                                     [-1, -1, -1]])
+        self.assertEqual([0, -1, 2, -1], list(Writer.hard_calls(probabilities)))
+
+        Writer.hard_call_threshold = 0.5
+        self.assertEqual([0, 1, 2, -1], list(Writer.hard_calls(probabilities)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import sys
+
+if "DEBUG" in sys.argv:
+    sys.path.insert(0, "../../")
+    sys.path.insert(0, "../")
+    sys.path.insert(0, ".")
+    sys.argv.remove("DEBUG")
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+import numpy
+import bgen_reader
+from pkg_resources import resource_filename
+
+from libgwas import bgen_decoder
+from libgwas.exceptions import MalformedInputFile
+from libgwas.exceptions import TooManyAlleles
+from libgwas.tests import remove_file
+
+
+def encode_string(value, length_format="<H"):
+    value = value.encode()
+    return struct.pack(length_format, len(value)) + value
+
+
+def encode_probabilities(values, bits, phased=False, missing=None, ploidy=2, alleles=2):
+    """Layout 2 probability data for values (samples x 2) in [0, 1]"""
+    values = numpy.asarray(values)
+    sample_count = values.shape[0]
+    ploidy_bytes = numpy.full(sample_count, ploidy, dtype=numpy.uint8)
+    if missing is not None:
+        ploidy_bytes[missing] |= 0x80
+    integers = numpy.round(values.reshape(-1) * ((1 << bits) - 1)).astype(numpy.uint64)
+    bit_values = (integers[:, numpy.newaxis] >> numpy.arange(bits, dtype=numpy.uint64)) & 1
+    packed = numpy.packbits(bit_values.astype(numpy.uint8).reshape(-1), bitorder="little")
+    return struct.pack("<IHBB", sample_count, alleles, ploidy, ploidy) + \
+        ploidy_bytes.tobytes() + struct.pack("<BB", int(phased), bits) + packed.tobytes()
+
+
+def write_bgen(filename, variants, samples=None, compressed=True):
+    """Write a layout 2 bgen file. variants are (chrom, pos, rsid, alleles, data)"""
+    flags = (bgen_decoder.layout_2 << 2) | int(compressed)
+    sample_block = b""
+    if samples is not None:
+        flags |= bgen_decoder.sample_ids_flag
+        ids = b"".join([encode_string(x) for x in samples])
+        sample_block = struct.pack("<II", len(ids) + 8, len(samples)) + ids
+    sample_count = struct.unpack_from("<I", variants[0][4])[0]
+    header = struct.pack("<IIII", 20, len(variants), sample_count, 0) + struct.pack("<I", flags)
+    header = header[0:16] + b"bgen" + header[16:]
+    with open(filename, "wb") as file:
+        file.write(struct.pack("<I", len(header) + len(sample_block)))
+        file.write(struct.pack("<I", len(header)) + header[4:])
+        file.write(sample_block)
+        for chrom, pos, rsid, alleles, data in variants:
+            file.write(encode_string(rsid) + encode_string(rsid) + encode_string(chrom))
+            file.write(struct.pack("<IH", pos, len(alleles)))
+            file.write(b"".join([encode_string(x, "<I") for x in alleles]))
+            if compressed:
+                deflated = zlib.compress(data)
+                file.write(struct.pack("<II", len(deflated) + 4, len(data)) + deflated)
+            else:
+                file.write(struct.pack("<I", len(data)) + data)
+
+
+class TestBgenDecoding(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(42)
+        self.sample_count = 25
+        first = random.uniform(size=self.sample_count)
+        self.values = numpy.column_stack([first, (1.0 - first) * random.uniform(
+            size=self.sample_count)])
+
+    def testBitWidths(self):
+        expected = numpy.column_stack([self.values, 1.0 - self.values.sum(axis=1)])
+        for bits in [3, 8, 11, 16, 24, 32]:
+            data = encode_probabilities(self.values, bits)
+            probs, missing = bgen_decoder.decode_probabilities(data)
+            self.assertEqual(numpy.float32, probs.dtype)
+            numpy.testing.assert_allclose(expected, probs,
+                                          atol=max(1e-6, 1.0 / ((1 << bits) - 1)))
+            self.assertFalse(missing.any())
+
+    def testSampleIndex(self):
+        data = encode_probabilities(self.values, 16, missing=[3, 7])
+        keep = numpy.array([0, 3, 4, 20])
+        probs, missing = bgen_decoder.decode_probabilities(data, keep)
+        full, full_missing = bgen_decoder.decode_probabilities(data)
+        numpy.testing.assert_array_equal(full[keep], probs)
+        self.assertEqual([False, True, False, False], list(missing))
+        self.assertTrue(numpy.isnan(probs[1]).all())
+
+        dosages, missing = bgen_decoder.decode_probabilities(data, keep, dosages=True)
+        numpy.testing.assert_allclose(full[keep, 1] + 2 * full[keep, 2], dosages, atol=1e-6)
+
+    def testPhased(self):
+        haplotypes = numpy.array([[1.0, 1.0], [1.0, 0.0], [0.0, 1.0], [0.0, 0.0], [0.5, 0.5]])
+        data = encode_probabilities(haplotypes, 8, phased=True)
+        probs, missing = bgen_decoder.decode_probabilities(data)
+        numpy.testing.assert_allclose([[1, 0, 0], [0, 1, 0], [0, 1, 0], [0, 0, 1],
+                                       [0.25, 0.5, 0.25]], probs, atol=0.01)
+        dosages, missing = bgen_decoder.decode_probabilities(data, dosages=True)
+        numpy.testing.assert_allclose([0, 1, 1, 2, 1], dosages, atol=0.01)
+
+    def testUnsupported(self):
+        with self.assertRaises(TooManyAlleles):
+            bgen_decoder.decode_probabilities(encode_probabilities(self.values, 8, alleles=3))
+        with self.assertRaises(MalformedInputFile):
+            bgen_decoder.decode_probabilities(encode_probabilities(self.values, 8, ploidy=1))
+
+
+class TestBgenFile(unittest.TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp(suffix=".bgen")
+        random = numpy.random.RandomState(7)
+        self.samples = ["s%d" % (x) for x in range(10)]
+        self.variants = []
+        self.expected = []
+        for index in range(5):
+            first = random.uniform(size=10)
+            values = numpy.column_stack([first, (1.0 - first) * random.uniform(size=10)])
+            alleles = ["A", "G" * (index + 1)]
+            self.variants.append(("2", 1000 * (index + 1), "rs%d" % (index), alleles,
+                                  encode_probabilities(values, 8, missing=[index])))
+            self.expected.append(2.0 - 2 * values[:, 0] - values[:, 1])
+            self.expected[-1][index] = numpy.nan
+        # Allele long enough to need a second read when building the index
+        self.variants[2] = self.variants[2][0:3] + (["A", "T" * 5000],) + self.variants[2][4:]
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            remove_file(self.filename)
+
+    def testIndex(self):
+        for compressed in [True, False]:
+            write_bgen(self.filename, self.variants, self.samples, compressed)
+            bgen = bgen_decoder.BgenFile(self.filename)
+            self.assertEqual(self.samples, list(bgen.samples))
+            self.assertEqual(["rs%d" % (x) for x in range(5)], list(bgen.rsids))
+            self.assertEqual(["2"] * 5, list(bgen.chromosomes))
+            self.assertEqual([1000, 2000, 3000, 4000, 5000], list(bgen.positions))
+            self.assertEqual(",".join(["A", "T" * 5000]), bgen.allele_ids[2])
+            dosages, missing = bgen.read_block(1, 4, dosages=True)
+            self.assertEqual((3, 10), dosages.shape)
+            numpy.testing.assert_allclose(self.expected[1:4], dosages, atol=0.01)
+            self.assertEqual([[1], [2], [3]], [list(numpy.flatnonzero(x)) for x in missing])
+            bgen.close()
+
+    def testUnsupportedVariants(self):
+        # Neither variant should take its neighbours down with it
+        first = self.variants[1]
+        self.variants[1] = first[0:3] + (["A", "C", "G"],) + first[4:]
+        values = numpy.full((10, 2), 0.25)
+        self.variants[3] = self.variants[3][0:4] + (encode_probabilities(values, 8, ploidy=1),)
+        write_bgen(self.filename, self.variants, self.samples)
+        bgen = bgen_decoder.BgenFile(self.filename)
+        self.assertEqual([False, True, False, False, False], list(bgen.skipped))
+        for num_threads in [None, 3]:
+            dosages, missing = bgen.read_block(0, 5, numpy.arange(2, 10), True, num_threads)
+            self.assertEqual([False, True, False, True, False], list(bgen.skipped))
+            self.assertEqual((5, 8), dosages.shape)
+            for index in [0, 2, 4]:
+                numpy.testing.assert_allclose(self.expected[index][2:], dosages[index],
+                                              atol=0.01)
+            self.assertTrue(numpy.isnan(dosages[[1, 3]]).all())
+            self.assertTrue(missing[[1, 3]].all())
+        probs, missing = bgen.read_block(1, 2)
+        self.assertEqual((1, 10, 3), probs.shape)
+        self.assertTrue(numpy.isnan(probs).all())
+        bgen.close()
+
+    def testGeneratedSamples(self):
+        write_bgen(self.filename, self.variants)
+        bgen = bgen_decoder.BgenFile(self.filename)
+        self.assertEqual("sample_0", bgen.samples[0])
+        bgen.close()
+
+    def testMatchesBgenReader(self):
+        for filename in ["test.bgen", "miss.bgen"]:
+            filename = resource_filename("libgwas", "tests/bedfiles/%s" % (filename))
+            self.assertTrue(bgen_decoder.supported(filename))
+            bgen = bgen_decoder.BgenFile(filename)
+            reference = bgen_reader.open_bgen(filename, verbose=False)
+            self.assertEqual(list(reference.rsids), list(bgen.rsids))
+            self.assertEqual(list(reference.positions), list(bgen.positions))
+            probs, missing = reference.read(return_missings=True)
+            native, native_missing = bgen.read_block(0, bgen.nvariants, num_threads=2)
+            numpy.testing.assert_allclose(probs.transpose(1, 0, 2), native, atol=1e-6)
+            numpy.testing.assert_array_equal(missing.T, native_missing)
+            bgen.close()
+
+    def testUnsupportedFile(self):
+        with open(self.filename, "wb") as file:
+            file.write(b"not a bgen file at all")
+        self.assertFalse(bgen_decoder.supported(self.filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,8 +10,11 @@ if "DEBUG" in sys.argv:
 
 
 import unittest
+from unittest import mock
 import numpy
 import os
+import tempfile
+import bgen_reader
 import pdb
 
 from libgwas.data_parser import DataParser
@@ -106,8 +109,10 @@ class TestBase(unittest.TestCase):
         ]
         self.rsids = "rs1320,rs13267,rs132134,rs132201,rs132268,rs132335,rs132402,rs132469,rs132536,rs132603,rs132670,rs132737,rs132804,rs132871,rs132938,rs1321005,rs1321072,rs1321139,rs1321206,rs1321273".split(",")
         self.ind_ids = [f"{x}:{x}" for x in 'ID0001,ID20002,ID0003,ID0004,IID0005,0006,ID0007,ID0008,ID0009,ID0010,ID0011,IID0012'.split(',')]
-        # For now, we aren't calculating the info scores and it always returns 1.0
-        self.info = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        # IMPUTE style INFO scores calculated from the probabilities
+        self.info = [0.077354, 0.052258, 0.051941, 0.058758, 0.03907, 0.071184, 0.063892,
+                     0.044845, 0.02579, 0.015975, 0.070559, 0.049885, 0.020073, 0.071032,
+                     0.05499, 0.026619, 0.07493, 0.07213, 0.03565, 0.03609]
 
 
         self.chrom = BoundaryCheck.chrom
@@ -209,6 +214,318 @@ class TestBGenBasics(TestBase):
                     pass
             idx += 1
 
+class TestBGenBlocks(TestBase):
+    def setUp(self):
+        super(TestBGenBlocks, self).setUp()
+        self.block_size = libgwas.bgen_parser.Parser.block_size
+        self.het_threshold = libgwas.bgen_parser.Parser.het_threshold
+        self.default_chromosome = libgwas.bgen_parser.Parser.default_chromosome
+        # Otherwise, every locus in the test data looks fixed
+        libgwas.bgen_parser.Parser.het_threshold = 0.0
+        # The test data has no chromosomes
+        libgwas.bgen_parser.Parser.default_chromosome = 1
+
+    def tearDown(self):
+        libgwas.bgen_parser.Parser.block_size = self.block_size
+        libgwas.bgen_parser.Parser.het_threshold = self.het_threshold
+        libgwas.bgen_parser.Parser.default_chromosome = self.default_chromosome
+        super(TestBGenBlocks, self).tearDown()
+
+    def load(self):
+        pc = PhenoCovar()
+        parser = libgwas.bgen_parser.Parser(self.nomissing)
+        parser.load_family_details(pc)
+        parser.load_genotypes()
+        return parser
+
+    def dosages(self, parser):
+        loci = []
+        for snp in parser:
+            genodata = snp.get_genotype_data(numpy.ones(snp.missing_genotypes.shape[0]) == 1)
+            loci.append((snp.pos, list(genodata.genotypes)))
+        return loci
+
+    def testBlockReads(self):
+        libgwas.bgen_parser.Parser.block_size = 1
+        expected = self.dosages(self.load())
+
+        libgwas.bgen_parser.Parser.block_size = 6
+        parser = self.load()
+        reads = []
+        read = parser.bgen.read
+        def counted_read(index, *args, **kwargs):
+            reads.append(index)
+            return read(index, *args, **kwargs)
+        parser.bgen.read = counted_read
+        self.assertEqual(20, len(expected))
+        self.assertEqual(expected, self.dosages(parser))
+        self.assertEqual([slice(0, 6), slice(6, 12), slice(12, 18), slice(18, 20)], reads)
+
+    def testBufferedVariant(self):
+        libgwas.bgen_parser.Parser.block_size = 4
+        parser = self.load()
+        probs, missing, info = parser.read_variant(5)
+        self.assertEqual(1, len(parser.blocks))
+        self.assertEqual((12, 3), probs.shape)
+        self.assertEqual(numpy.float32, probs.dtype)
+        self.assertEqual(12, missing.shape[0])
+        numpy.testing.assert_allclose(self.additive_encoding[5], probs[:, 1] + 2 * probs[:, 2],
+                                      atol=1e-4)
+        # A second request for the same block is served from the buffer
+        parser.read_variant(7)
+        self.assertEqual(1, len(parser.blocks))
+
+
+class TestBGenMarkers(TestBGenBlocks):
+    def testChromosomeCodes(self):
+        names = numpy.array(["", "01", "chr2", "X", "bogus", "1"])
+        self.assertEqual([-2, 1, 2, 23, -2, 1],
+                         list(libgwas.bgen_parser.chromosome_codes(names, default=-1)))
+        self.assertEqual([7, 1, 2, 23, -2, 1],
+                         list(libgwas.bgen_parser.chromosome_codes(names, default=7)))
+
+    def testVariantRsids(self):
+        ids = numpy.array(["rs1", "1:1000:rs2:A:G", "1:2000:A:G", "--"])
+        self.assertEqual(["rs1", "rs2", "1:2000:A:G", "--"],
+                         libgwas.bgen_parser.variant_rsids(ids))
+
+    def testMarkerArrays(self):
+        parser = self.load()
+        self.assertEqual([1] * 20, list(parser.chroms))
+        self.assertEqual(self.positions, list(parser.positions))
+        self.assertEqual(["A", "C"], parser.alleles[0].tolist())
+        self.assertEqual(["--"] * 20, list(parser.rsids))
+
+    def testBoundarySeek(self):
+        BoundaryCheck.chrom = 1
+        DataParser.boundary = BoundaryCheck(bp=[20000, 30000])
+        libgwas.bgen_parser.Parser.block_size = 4
+        parser = self.load()
+        self.assertEqual((5, 12), (parser.bgen_start_idx, parser.bgen_stop_idx))
+        reads = []
+        read = parser.bgen.read
+        def counted_read(index, *args, **kwargs):
+            reads.append(index)
+            return read(index, *args, **kwargs)
+        parser.bgen.read = counted_read
+        self.assertEqual(self.positions[5:12], [x[0] for x in self.dosages(parser)])
+        # Nothing ahead of the first locus in bounds is decoded
+        self.assertEqual([5, 9], [x.start for x in reads])
+
+
+class TestBGenInfo(TestBGenBlocks):
+    def setUp(self):
+        super(TestBGenInfo, self).setUp()
+        self.info_filename = tempfile.mktemp(suffix=".info")
+
+    def tearDown(self):
+        if os.path.exists(self.info_filename):
+            os.remove(self.info_filename)
+        super(TestBGenInfo, self).tearDown()
+
+    def testInfoScores(self):
+        reference = bgen_reader.open_bgen(self.nomissing, verbose=False)
+        probs = reference.read().transpose(1, 0, 2)
+        numpy.testing.assert_allclose(self.info, libgwas.bgen_parser.info_scores(probs),
+                                      atol=1e-6)
+
+        # Fixed loci are given 1.0 and those without any data 0.0
+        probs = numpy.zeros((3, 4, 3))
+        probs[0, :, 0] = 1.0
+        probs[1, :, 2] = 1.0
+        probs[2] = numpy.nan
+        self.assertEqual([1.0, 1.0, 0.0], list(libgwas.bgen_parser.info_scores(probs)))
+
+    def testInfoThreshold(self):
+        libgwas.bgen_parser.Parser.info_threshold = 0.05
+        expected = [pos for pos, info in zip(self.positions, self.info) if info > 0.05]
+        self.assertEqual(expected, [x[0] for x in self.dosages(self.load())])
+
+    def testInfoFile(self):
+        info = list(self.info)
+        info[3] = "NA"
+        with open(self.info_filename, "w") as file:
+            print("snp_id rs_id position exp_freq_a1 info certainty type", file=file)
+            for rsid, pos, score in zip(self.rsids, self.positions, info):
+                print("--- %s %d 0.5 %s 0.9 0" % (rsid, pos, score), file=file)
+        libgwas.bgen_parser.Parser.info_threshold = 0.05
+        libgwas.bgen_parser.Parser.block_size = 1
+        parser = libgwas.bgen_parser.Parser(self.nomissing, info_filename=self.info_filename)
+        parser.load_family_details(PhenoCovar())
+        parser.load_genotypes()
+        self.assertTrue(numpy.isnan(parser.info[3]))
+
+        reads = []
+        read = parser.bgen.read
+        def counted_read(index, *args, **kwargs):
+            reads.append(index.start)
+            return read(index, *args, **kwargs)
+        parser.bgen.read = counted_read
+        expected = [x for x in range(20) if x != 3 and self.info[x] > 0.05]
+        self.assertEqual([self.positions[x] for x in expected],
+                         [x[0] for x in self.dosages(parser)])
+        # Variants failing the threshold are never decoded
+        self.assertEqual(expected, reads)
+
+    def testMinimacInfo(self):
+        with open(self.info_filename, "w") as file:
+            print("SNP\tREF(0)\tALT(1)\tALT_Frq\tMAF\tAvgCall\tRsq", file=file)
+            print("1:100\tA\tG\t0.1\t0.1\t0.99\t0.85", file=file)
+            print("1:200\tA\tG\t0.1\t0.1\t0.99\t-", file=file)
+        scores = libgwas.bgen_parser.load_info_scores(self.info_filename)
+        self.assertEqual(0.85, scores[0])
+        self.assertTrue(numpy.isnan(scores[1]))
+
+
+class TestBGenMissingness(TestBase):
+    def setUp(self):
+        super(TestBGenMissingness, self).setUp()
+        self.missing = resource_filename("libgwas", "tests/bedfiles/miss.bgen")
+        self.block_size = libgwas.bgen_parser.Parser.block_size
+        self.missing_threads = libgwas.bgen_parser.Parser.missing_threads
+        self.cache_missingness = libgwas.bgen_parser.Parser.cache_missingness
+        reference = bgen_reader.open_bgen(self.missing, verbose=False)
+        self.expected = numpy.sum(reference.read(return_missings=True)[1], axis=1)
+
+    def tearDown(self):
+        libgwas.bgen_parser.Parser.block_size = self.block_size
+        libgwas.bgen_parser.Parser.missing_threads = self.missing_threads
+        libgwas.bgen_parser.Parser.cache_missingness = self.cache_missingness
+        cache_file = self.missing + ".missing.npz"
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        super(TestBGenMissingness, self).tearDown()
+
+    def load(self):
+        parser = libgwas.bgen_parser.Parser(self.missing)
+        parser.load_family_details(PhenoCovar())
+        parser.load_genotypes()
+        return parser
+
+    def testSampleMissingness(self):
+        parser = self.load()
+        libgwas.bgen_parser.Parser.missing_threads = 1
+        missing, locus_count = parser.sample_missingness()
+        self.assertEqual(7, locus_count)
+        self.assertEqual(list(self.expected), list(missing))
+
+        libgwas.bgen_parser.Parser.block_size = 2
+        libgwas.bgen_parser.Parser.missing_threads = 3
+        close = bgen_reader.open_bgen.close
+        with mock.patch.object(bgen_reader.open_bgen, "close", autospec=True,
+                               side_effect=close) as closed:
+            missing, locus_count = parser.sample_missingness()
+        self.assertEqual(list(self.expected), list(missing))
+        # Each thread's reader is closed once the counts are in
+        self.assertEqual([], parser.opened_readers)
+        self.assertTrue(0 < closed.call_count <= 3)
+        self.assertEqual(closed.call_count, len(set(id(x[0][0]) for x in closed.call_args_list)))
+
+        native_decoder = libgwas.bgen_parser.Parser.native_decoder
+        libgwas.bgen_parser.Parser.native_decoder = True
+        try:
+            parser = self.load()
+            self.assertTrue(parser.native)
+            missing, locus_count = parser.sample_missingness()
+            self.assertEqual(list(self.expected), list(missing))
+        finally:
+            libgwas.bgen_parser.Parser.native_decoder = native_decoder
+
+    def testBoundedMissingness(self):
+        BoundaryCheck.chrom = 2
+        DataParser.boundary = BoundaryCheck(bp=[0, 12000])
+        parser = self.load()
+        missing, locus_count = parser.sample_missingness()
+        self.assertEqual(2, locus_count)
+        reference = bgen_reader.open_bgen(self.missing, verbose=False)
+        self.assertEqual(list(numpy.sum(reference.read(slice(4, 6), return_missings=True)[1],
+                                        axis=1)), list(missing))
+
+    def testIndividualMissingness(self):
+        DataParser.ind_miss_tol = 0.5
+        parser = self.load()
+        expected = [True] * 12
+        expected[1] = False
+        self.assertEqual(expected, list(parser.alt_not_missing))
+
+        DataParser.ind_miss_tol = 0.99
+        self.assertIsNone(self.load().alt_not_missing)
+
+    def testMissingnessCache(self):
+        libgwas.bgen_parser.Parser.cache_missingness = True
+        parser = self.load()
+        missing, locus_count = parser.sample_missingness()
+        self.assertTrue(os.path.exists(parser.missing_cache_file))
+
+        def fail(*args):
+            raise AssertionError("The cached counts should have been used")
+        parser.count_missing = fail
+        cached, cached_count = parser.sample_missingness()
+        self.assertEqual(list(missing), list(cached))
+        self.assertEqual(locus_count, cached_count)
+
+        # A different set of variants requires a rescan
+        BoundaryCheck.chrom = 1
+        DataParser.boundary = BoundaryCheck(bp=[0, 20000])
+        parser = self.load()
+        missing, locus_count = parser.sample_missingness()
+        self.assertEqual(2, locus_count)
+
+
+class TestBGenNative(TestBGenBlocks):
+    def setUp(self):
+        super(TestBGenNative, self).setUp()
+        self.native_decoder = libgwas.bgen_parser.Parser.native_decoder
+
+    def tearDown(self):
+        libgwas.bgen_parser.Parser.native_decoder = self.native_decoder
+        super(TestBGenNative, self).tearDown()
+
+    def testNativeDosages(self):
+        expected = self.dosages(self.load())
+        libgwas.bgen_parser.Parser.native_decoder = True
+        libgwas.bgen_parser.Parser.block_size = 7
+        parser = self.load()
+        self.assertTrue(parser.native)
+        observed = self.dosages(parser)
+        self.assertEqual([x[0] for x in expected], [x[0] for x in observed])
+        numpy.testing.assert_allclose([x[1] for x in expected], [x[1] for x in observed],
+                                      atol=1e-6)
+
+    def testUnsupportedVariants(self):
+        from libgwas import bgen_decoder
+        from libgwas.tests.test_bgen_decoder import encode_probabilities, write_bgen
+        libgwas.bgen_parser.Parser.native_decoder = True
+        libgwas.bgen_parser.Parser.block_size = 7
+        expected = self.dosages(self.load())
+
+        # Rewrite the data with a triallelic variant and a haploid one
+        source = bgen_decoder.BgenFile(self.nomissing)
+        probs, missing = source.read_block(0, source.nvariants)
+        variants = []
+        for index in range(source.nvariants):
+            alleles = source.allele_ids[index].split(",")
+            if index == 5:
+                alleles.append("T")
+            data = encode_probabilities(numpy.nan_to_num(probs[index, :, 0:2]), 16,
+                                        missing=missing[index], ploidy=1 + (index != 8),
+                                        alleles=len(alleles))
+            variants.append((source.chromosomes[index], int(source.positions[index]),
+                             source.rsids[index], alleles, data))
+        filename = tempfile.mktemp(suffix=".bgen")
+        write_bgen(filename, variants, list(source.samples))
+        source.close()
+        try:
+            self.nomissing = filename
+            observed = self.dosages(self.load())
+        finally:
+            os.remove(filename)
+        expected = [x for x in expected if x[0] not in (self.positions[5], self.positions[8])]
+        self.assertEqual([x[0] for x in expected], [x[0] for x in observed])
+        numpy.testing.assert_allclose([x[1] for x in expected], [x[1] for x in observed],
+                                      atol=1e-4)
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,96 @@
+import os
+import gzip
+import zlib
+import struct
+import tempfile
+import unittest
+
+from libgwas import bgzf
+from libgwas.exceptions import MalformedInputFile
+from libgwas.tests import remove_file
+from pkg_resources import resource_filename
+
+
+def write_bgzf(filename, data, block_size):
+    """Write data as a series of BGZF blocks holding block_size bytes each"""
+    with open(filename, "wb") as file:
+        for offset in list(range(0, len(data), block_size)) + [len(data)]:
+            chunk = data[offset:offset + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = compressor.compress(chunk) + compressor.flush()
+            file.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00")
+            file.write(struct.pack("<H", len(deflated) + 25))
+            file.write(deflated)
+            file.write(struct.pack("<II", zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+
+
+class TestBgzf(unittest.TestCase):
+    def setUp(self):
+        self.vcf = resource_filename("libgwas", "tests/bedfiles/nomiss.vcf.gz")
+        self.filename = tempfile.mktemp(suffix=".gz")
+        self.data = "".join(["%d\tline %d of many\n" % (x, x) for x in range(20000)]).encode()
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            remove_file(self.filename)
+
+    def testIsBgzf(self):
+        self.assertTrue(bgzf.is_bgzf(self.vcf))
+        with gzip.open(self.filename, "wb") as f:
+            f.write(self.data)
+        self.assertFalse(bgzf.is_bgzf(self.filename))
+
+    def testTabixFile(self):
+        with gzip.open(self.vcf, "rt") as f:
+            expected = f.readlines()
+        for threads in [1, 3]:
+            with bgzf.open_gzip(self.vcf, 'rt', threads) as f:
+                self.assertEqual(expected, f.readlines())
+
+    def testBlockOrder(self):
+        write_bgzf(self.filename, self.data, 1000)
+        for threads in [1, 2, 5]:
+            with bgzf.open_gzip(self.filename, 'rb', threads) as f:
+                self.assertEqual(self.data, f.read())
+            with bgzf.open_gzip(self.filename, 'rt', threads) as f:
+                self.assertEqual("0\tline 0 of many\n", f.readline())
+                lines = [line for line in f]
+                self.assertEqual(19999, len(lines))
+                self.assertEqual("19999\tline 19999 of many\n", lines[-1])
+
+    def testRegularGzip(self):
+        with gzip.open(self.filename, "wb") as f:
+            f.write(self.data)
+        with bgzf.open_gzip(self.filename, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+    def testTruncated(self):
+        write_bgzf(self.filename, self.data, 1000)
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        with open(self.filename, "wb") as f:
+            f.write(data[0:-40])
+        with self.assertRaises(MalformedInputFile):
+            with bgzf.open_gzip(self.filename, 'rb', 2) as f:
+                f.read()
+
+    def testCorrupted(self):
+        write_bgzf(self.filename, self.data, 1000)
+        with open(self.filename, "rb") as f:
+            original = f.read()
+        # Flip a byte inside the deflate data of the first block and then
+        # one inside its CRC
+        block_size = struct.unpack("<H", original[16:18])[0] + 1
+        for position in [30, block_size - 6]:
+            data = bytearray(original)
+            data[position] ^= 0x01
+            with open(self.filename, "wb") as f:
+                f.write(data)
+            for threads in [1, 2]:
+                with self.assertRaises(MalformedInputFile):
+                    with bgzf.open_gzip(self.filename, 'rb', threads) as f:
+                        f.read()
+
+
+if __name__ == "__main__":
+    unittest.main()
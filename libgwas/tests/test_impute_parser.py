@@ -858,6 +858,171 @@ class TestImputedBasics(TestBase):
 
 
 
+class TestParallelArchives(TestBase):
+    def setUp(self):
+        super(TestParallelArchives, self).setUp()
+        self.archive_workers = impute_parser.Parser.archive_workers
+        self.chunk_size = impute_parser.Parser.archive_chunk_size
+        self.queue_depth = impute_parser.Parser.archive_queue_depth
+
+    def tearDown(self):
+        impute_parser.Parser.archive_workers = self.archive_workers
+        impute_parser.Parser.archive_chunk_size = self.chunk_size
+        impute_parser.Parser.archive_queue_depth = self.queue_depth
+        super(TestParallelArchives, self).tearDown()
+
+    def loci(self, archives, chroms):
+        pc = PhenoCovar()
+        parser = impute_parser.Parser(self.fam_file, archives, chroms=chroms)
+        parser.load_family_details(pc)
+        parser.load_genotypes()
+        return [(snp.chr, snp.pos, snp.rsid, snp.major_allele, snp.minor_allele,
+                 snp.genotype_data.tolist()) for snp in parser]
+
+    def testOrderedOutput(self):
+        impute_parser.encoding = impute_parser.Encoding.Raw
+        archives = [self.gen_file, self.gen_file2, self.gen_file]
+        chroms = ["3", "4", "5"]
+        expected = self.loci(archives, chroms)
+        self.assertEqual(30, len(expected))
+
+        impute_parser.Parser.archive_chunk_size = 3
+        impute_parser.Parser.archive_queue_depth = 1
+        for workers in [2, 3]:
+            impute_parser.Parser.archive_workers = workers
+            self.assertEqual(expected, self.loci(archives, chroms))
+
+    def testInfoThreshold(self):
+        impute_parser.Parser.info_threshold = 0.5
+        expected = self.loci([self.gen_file, self.gen_file2], ["3", "4"])
+        self.assertEqual(10, len(expected))
+        impute_parser.Parser.archive_workers = 2
+        self.assertEqual(expected, self.loci([self.gen_file, self.gen_file2], ["3", "4"]))
+
+    def testWorkerErrors(self):
+        from libgwas.exceptions import MalformedInputFile
+        with gzip.open(self.gen_file2, "wt") as file:
+            print("--- rs1 100 A C 1 0 0", file=file)
+        impute_parser.Parser.archive_workers = 2
+        with self.assertRaises(MalformedInputFile):
+            self.loci([self.gen_file, self.gen_file2], ["3", "4"])
+
+    def testBoundaryChromosome(self):
+        impute_parser.encoding = impute_parser.Encoding.Raw
+        archives = [self.gen_file, self.gen_file2, self.gen_file]
+        chroms = ["3", "4", "5"]
+        BoundaryCheck.chrom = 4
+        DataParser.boundary = BoundaryCheck()
+        expected = self.loci(archives, chroms)
+        self.assertEqual(10, len(expected))
+
+        impute_parser.Parser.archive_workers = 3
+        DataParser.boundary = BoundaryCheck()
+        started = []
+        start_next = impute_parser.ArchivePipeline.start_next
+        def counted_start(pipeline):
+            started.append(pipeline.jobs[0][0])
+            start_next(pipeline)
+        impute_parser.ArchivePipeline.start_next = counted_start
+        try:
+            self.assertEqual(expected, self.loci(archives, chroms))
+        finally:
+            impute_parser.ArchivePipeline.start_next = start_next
+        # Only the archive holding chromosome 4 is parsed
+        self.assertEqual([1], started)
+
+    def testKilledWorker(self):
+        import signal
+        from libgwas.exceptions import MalformedInputFile
+        impute_parser.Parser.archive_workers = 2
+        impute_parser.Parser.archive_chunk_size = 1
+        impute_parser.Parser.archive_queue_depth = 1
+        poll_interval = impute_parser.ArchivePipeline.poll_interval
+        impute_parser.ArchivePipeline.poll_interval = 0.1
+        parser = impute_parser.Parser(self.fam_file, [self.gen_file, self.gen_file2],
+                                      chroms=["3", "4"])
+        parser.load_family_details(PhenoCovar())
+        parser.load_genotypes()
+        pipeline = parser.pipeline
+        try:
+            # The worker blocks on its full queue until it is killed
+            process = pipeline.running[0][1]
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            with self.assertRaises(MalformedInputFile):
+                for i in range(20):
+                    next(pipeline)
+            self.assertEqual(0, len(pipeline.running))
+        finally:
+            impute_parser.ArchivePipeline.poll_interval = poll_interval
+            pipeline.close()
+
+
+class TestAdditiveFastPath(unittest.TestCase):
+    def setUp(self):
+        self.encoding = impute_parser.encoding
+        self.fast_path = impute_parser.additive_fast_path
+        impute_parser.encoding = impute_parser.Encoding.Additive
+        random = numpy.random.RandomState(11)
+        probs = random.dirichlet([1.0, 1.0, 1.0], size=200)
+        self.probs = probs.astype(numpy.float32)
+        self.non_missing = random.uniform(size=200) > 0.1
+
+    def tearDown(self):
+        impute_parser.encoding = self.encoding
+        impute_parser.additive_fast_path = self.fast_path
+
+    def extract(self, fast_path, probs):
+        impute_parser.additive_fast_path = fast_path
+        return impute_parser.gen_dosage_extraction(["A", "C"], probs, self.non_missing)
+
+    def testMatchesFullExtraction(self):
+        for probs in [self.probs, self.probs.astype(numpy.float64)]:
+            expected = self.extract(False, probs)
+            observed = self.extract(True, probs)
+            self.assertEqual(numpy.float32, observed.genotypes.dtype)
+            numpy.testing.assert_allclose(expected.genotypes, observed.genotypes, rtol=1e-6)
+            self.assertEqual((expected.a1_count, expected.a2_count, expected.het_count),
+                             (observed.a1_count, observed.a2_count, observed.het_count))
+            self.assertAlmostEqual(expected.maf, observed.maf, places=6)
+            self.assertEqual(expected.minor_allele, observed.minor_allele)
+
+    def testMatchesParsedProbabilities(self):
+        # Values which aren't exact in float32, as read from a .gen line
+        text = " ".join("%.3f %.3f %.3f" % tuple(p) for p in self.probs)
+        probs = impute_parser.parse_gen_probabilities(text, self.probs.shape[0])
+        self.assertEqual(numpy.float32, probs.dtype)
+        expected = self.extract(False, probs)
+        observed = self.extract(True, probs)
+        numpy.testing.assert_allclose(expected.genotypes, observed.genotypes, rtol=1e-6)
+        self.assertEqual((expected.a1_count, expected.a2_count, expected.het_count),
+                         (observed.a1_count, observed.a2_count, observed.het_count))
+        self.assertAlmostEqual(expected.maf, observed.maf, places=6)
+
+    def testOtherEncodings(self):
+        impute_parser.encoding = impute_parser.Encoding.Dominant
+        observed = self.extract(True, self.probs)
+        numpy.testing.assert_allclose(self.probs[self.non_missing, 1:3].sum(axis=1),
+                                      observed.genotypes, rtol=1e-6)
+
+
+class TestGenLineParsing(unittest.TestCase):
+    def testProbabilities(self):
+        text = "1 0 0\t0 1 0  0.25 0.5 0.25\n"
+        probs = impute_parser.parse_gen_probabilities(text, 3)
+        self.assertEqual(numpy.float32, probs.dtype)
+        numpy.testing.assert_allclose([[1, 0, 0], [0, 1, 0], [0.25, 0.5, 0.25]], probs)
+        probs = impute_parser.parse_gen_probabilities(text, 3, numpy.array([0, 2]))
+        numpy.testing.assert_allclose([[1, 0, 0], [0.25, 0.5, 0.25]], probs)
+
+    def testMalformed(self):
+        from libgwas.exceptions import MalformedInputFile
+        with self.assertRaises(MalformedInputFile):
+            impute_parser.parse_gen_probabilities("1 0 0 0 1", 2)
+        with self.assertRaises(MalformedInputFile):
+            impute_parser.parse_gen_probabilities("1 0 0 0 1 0", 3)
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+import sys
+
+if "DEBUG" in sys.argv:
+    sys.path.insert(0, "../../")
+    sys.path.insert(0, "../")
+    sys.path.insert(0, ".")
+    sys.argv.remove("DEBUG")
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy
+from pkg_resources import resource_filename
+
+from libgwas import bed_parser
+from libgwas import pgen_parser
+from libgwas.pgen_parser import Parser
+from libgwas.boundary import BoundaryCheck
+from libgwas.data_parser import DataParser
+from libgwas.exceptions import MalformedInputFile
+from libgwas.pheno_covar import PhenoCovar
+from libgwas.tests import bed_parser_test
+
+
+def encode_varint(value):
+    encoded = b""
+    while value >= 128:
+        encoded += struct.pack("<B", (value & 0x7f) | 0x80)
+        value >>= 7
+    return encoded + struct.pack("<B", value)
+
+
+def encode_difflist(samples, codes, sample_count):
+    """Encode (sample, code) pairs using the .pgen difflist layout"""
+    encoded = encode_varint(len(samples))
+    if len(samples) == 0:
+        return encoded
+    id_bytes = pgen_parser.sample_id_bytes(sample_count)
+    starts = b""
+    sizes = b""
+    deltas = b""
+    for group in range(0, len(samples), 64):
+        members = samples[group:group + 64]
+        starts += int(members[0]).to_bytes(id_bytes, "little")
+        group_deltas = b"".join([encode_varint(int(x)) for x in numpy.diff(members)])
+        if group + 64 < len(samples):
+            sizes += struct.pack("<B", len(group_deltas) - 63)
+        deltas += group_deltas
+    return encoded + starts + sizes + bed_parser.pack_codes(codes).tobytes() + deltas
+
+
+def encode_record(codes, kind, ld_base=None):
+    """Encode the main track codes for a single variant as the requested \
+        record type"""
+    codes = numpy.asarray(codes)
+    sample_count = codes.shape[0]
+    if kind == 0:
+        return bed_parser.pack_codes(codes).tobytes()
+    if kind == 1:
+        counts = numpy.bincount(codes, minlength=4)
+        first, second = sorted(numpy.argsort(-counts, kind="stable")[0:2])
+        bits = numpy.packbits(codes == second, bitorder="little").tobytes()
+        others = numpy.flatnonzero((codes != first) & (codes != second))
+        return struct.pack("<B", first * 4 + second - first) + bits + \
+            encode_difflist(others, codes[others], sample_count)
+    if kind in (2, 3):
+        target = codes
+        if kind == 3:
+            target = pgen_parser.inverted_codes[codes]
+        changed = numpy.flatnonzero(target != ld_base)
+        return encode_difflist(changed, target[changed], sample_count)
+    base = kind & 3
+    changed = numpy.flatnonzero(codes != base)
+    return encode_difflist(changed, codes[changed], sample_count)
+
+
+def write_pgen(filename, variants, kinds=None, type_bits=8):
+    """Write a .pgen file
+
+    :param variants: list of main track codes for each variant
+    :param kinds: record types (None for a fixed width file)
+    :param type_bits: 4 or 8 bit record types
+    """
+    sample_count = len(variants[0])
+    with open(filename, "wb") as file:
+        if kinds is None:
+            file.write(struct.pack("<HBIIB", bed_parser.magic_number, pgen_parser.fixed_mode,
+                                   len(variants), sample_count, 0))
+            for codes in variants:
+                file.write(bed_parser.pack_codes(codes).tobytes())
+            return
+
+        records = []
+        ld_base = None
+        for codes, kind in zip(variants, kinds):
+            records.append(encode_record(codes, kind, ld_base))
+            if kind & 6 != 2:
+                ld_base = numpy.asarray(codes)
+        control = 3
+        if type_bits == 8:
+            control = 7
+        file.write(struct.pack("<HBIIB", bed_parser.magic_number, pgen_parser.variable_mode,
+                               len(variants), sample_count, control))
+        if type_bits == 8:
+            types = numpy.array(kinds, dtype=numpy.uint8).tobytes()
+        else:
+            types = numpy.array(kinds + [0], dtype=numpy.uint8)
+            types = (types[0:len(kinds) + 1:2] | (types[1:len(kinds) + 1:2] << 4))
+            types = types[0:int((len(kinds) + 1) / 2)].tobytes()
+        lengths = b"".join([struct.pack("<I", len(x)) for x in records])
+        data_start = 12 + 8 + len(types) + len(lengths)
+        file.write(struct.pack("<Q", data_start) + types + lengths)
+        file.write(b"".join(records))
+
+
+class TestPgenDecoding(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(1234)
+        self.sample_count = 300
+        self.base = random.choice(4, self.sample_count, p=[0.7, 0.2, 0.05, 0.05])
+        self.codes = self.base.copy()
+        self.codes[random.choice(self.sample_count, 90, replace=False)] = 2
+
+    def testVarints(self):
+        values = [0, 1, 127, 128, 300, 16384, 1 << 28]
+        encoded = b"".join([encode_varint(x) for x in values]) + b"\xff"
+        decoded, offset = pgen_parser.decode_varints(encoded, 0, len(values))
+        self.assertEqual(values, list(decoded))
+        self.assertEqual(len(encoded) - 1, offset)
+        self.assertEqual((300, 2), pgen_parser.read_varint(encode_varint(300), 0))
+
+    def testDifflist(self):
+        samples = numpy.sort(numpy.random.RandomState(4).choice(self.sample_count, 150,
+                                                                  replace=False))
+        codes = self.codes[samples]
+        encoded = encode_difflist(samples, codes, self.sample_count) + b"extra"
+        decoded_samples, decoded_codes, offset = pgen_parser.decode_difflist(
+            encoded, 0, self.sample_count)
+        self.assertEqual(list(samples), list(decoded_samples))
+        self.assertEqual(list(codes), list(decoded_codes))
+        self.assertEqual(len(encoded) - 5, offset)
+
+    def testRecordTypes(self):
+        for kind in [0, 1, 4, 7]:
+            record = encode_record(self.codes, kind)
+            self.assertEqual(list(self.codes),
+                             list(pgen_parser.decode_main_track(record, kind,
+                                                                self.sample_count)))
+        for kind in [2, 3]:
+            record = encode_record(self.codes, kind, self.base)
+            decoded = pgen_parser.decode_main_track(record, kind, self.sample_count,
+                                                    self.base.astype(numpy.int8))
+            self.assertEqual(list(self.codes), list(decoded))
+
+
+class TestPgenFiles(bed_parser_test.TestBase):
+    def setUp(self):
+        super(TestPgenFiles, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.pgen = os.path.join(self.tmpdir, "data.pgen")
+        self.pvar = os.path.join(self.tmpdir, "data.pvar")
+        self.psam = os.path.join(self.tmpdir, "data.psam")
+
+        # The .bim file's first allele is the one being counted, so it is ALT
+        with open(self.pvar, "w") as file:
+            print("##fileformat=PVARv1.0", file=file)
+            print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO", file=file)
+            for chr, rsid, cm, pos, a1, a2 in self.nonmissing_mapdata:
+                print("\t".join([chr, pos, rsid, a2, a1, ".", ".", "."]), file=file)
+        with open(self.psam, "w") as file:
+            print("#FID\tIID\tSEX\tPHENO1", file=file)
+            for index, (sex, pheno) in enumerate(zip(self.sex, self.phenotypes)):
+                print("%d\t%d\t%d\t%s" % (index + 1, index + 1, sex, pheno), file=file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestPgenFiles, self).tearDown()
+
+    def load(self):
+        pc = PhenoCovar()
+        parser = Parser(self.psam, self.pvar, self.pgen)
+        parser.load_pvar()
+        parser.load_psam(pc)
+        parser.load_genotypes()
+        return parser, pc
+
+    def loci(self, parser):
+        loci = []
+        for snp in parser:
+            loci.append((snp.chr, snp.pos, snp.rsid, snp.alleles,
+                         list(snp.genotype_data)))
+        return loci
+
+    def expected(self):
+        return [(int(chr), int(pos), rsid, [a2, a1], genotypes)
+                for (chr, rsid, cm, pos, a1, a2), genotypes in
+                zip(self.nonmissing_mapdata, self.genotypes)]
+
+    def testFixedWidth(self):
+        write_pgen(self.pgen, self.genotypes)
+        parser, pc = self.load()
+        self.assertEqual(7, parser.locus_count)
+        self.assertEqual(self.expected(), self.loci(parser))
+        self.assertEqual(12, len(pc.pedigree_data))
+        numpy.testing.assert_allclose(self.phenotypes, pc.phenotype_data[0])
+
+    def testFixedWidthControlByte(self):
+        write_pgen(self.pgen, self.genotypes)
+        with open(self.pgen, "r+b") as file:
+            file.seek(11)
+            file.write(b"\x07")
+        with self.assertRaises(MalformedInputFile):
+            self.load()
+
+    def testPgenlibFile(self):
+        # Written by pgenlib's PgenWriter from the same genotypes
+        prefix = resource_filename("libgwas", "tests/bedfiles/pgen_nomiss")
+        for ext in ["pgen", "pvar", "psam"]:
+            shutil.copyfile("%s.%s" % (prefix, ext), getattr(self, ext))
+        parser, pc = self.load()
+        self.assertEqual(pgen_parser.variable_mode, parser.storage_mode)
+        self.assertEqual(self.expected(), self.loci(parser))
+
+    def testBedStorage(self):
+        shutil.copyfile(self.nonmissing_bed, self.pgen)
+        parser, pc = self.load()
+        self.assertEqual(pgen_parser.bed_mode, parser.storage_mode)
+        self.assertEqual(self.expected(), self.loci(parser))
+
+    def testVariableWidth(self):
+        kinds = [0, 1, 2, 3, 4, 1, 2]
+        for type_bits in (4, 8):
+            write_pgen(self.pgen, self.genotypes, kinds, type_bits)
+            parser, pc = self.load()
+            self.assertEqual(list(kinds), list(parser.record_types))
+            self.assertEqual(self.expected(), self.loci(parser))
+
+    def testMissing(self):
+        genotypes = [list(x) for x in self.genotypes]
+        genotypes[0][3] = 3
+        genotypes[2][3] = 3
+        genotypes[4][3] = 3
+        genotypes[5][7] = 3
+        write_pgen(self.pgen, genotypes, [0, 1, 7, 2, 1, 4, 3])
+        DataParser.ind_miss_tol = 0.25
+        parser, pc = self.load()
+        missing = [list(numpy.flatnonzero(numpy.array(x[4]) == DataParser.missing_storage))
+                   for x in self.loci(parser)]
+        self.assertEqual([[3], [], [3], [], [3], [7], []], missing)
+        self.assertEqual([True, True, True, False], list(parser.alt_not_missing[0:4]))
+
+    def testBoundary(self):
+        write_pgen(self.pgen, self.genotypes, [0, 1, 2, 3, 4, 1, 2])
+        BoundaryCheck.chrom = 1
+        DataParser.boundary = BoundaryCheck(bp=[20000, 50000])
+        parser, pc = self.load()
+        self.assertEqual(2, parser.locus_count)
+        self.assertEqual(self.expected()[2:4], self.loci(parser))
+
+    def testFamStyleFiles(self):
+        write_pgen(self.pgen, self.genotypes)
+        shutil.copyfile(self.nonmissing_bim, self.pvar)
+        shutil.copyfile(self.nonmissing_fam, self.psam)
+        parser, pc = self.load()
+        self.assertEqual(self.expected(), self.loci(parser))
+        self.assertEqual(["1", "1", "0", "0", "1", "1"], parser.families[0])
+
+    def testAnalysis(self):
+        write_pgen(self.pgen, self.genotypes, [0, 1, 2, 3, 4, 1, 2])
+        parser, pc = self.load()
+        bed = bed_parser.Parser(self.nonmissing_fam, self.nonmissing_bim, self.nonmissing_bed)
+        bed.load_bim()
+        bed.load_fam(PhenoCovar())
+        bed.load_genotypes()
+        non_missing = numpy.ones(12, dtype=bool)
+        expected = [(x.maf, x.het_count, x.a2_count, x.minor_allele)
+                    for x in [snp.get_genotype_data(non_missing) for snp in bed]]
+        observed = [(x.maf, x.het_count, x.a2_count, x.minor_allele)
+                    for x in [snp.get_genotype_data(non_missing) for snp in parser]]
+        self.assertEqual(expected, observed)
+
+    def testSampleCountMismatch(self):
+        from libgwas.exceptions import MalformedInputFile
+        write_pgen(self.pgen, [x[0:10] for x in self.genotypes])
+        with self.assertRaises(MalformedInputFile):
+            self.load()
+
+
+if __name__ == "__main__":
+    unittest.main()
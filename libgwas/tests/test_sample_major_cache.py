@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from libgwas.tests import bed_parser_test
+from libgwas import bed_parser
+from libgwas.sample_major_cache import SampleMajorCache
+from libgwas.exceptions import InvalidSelection
+
+
+class TestSampleMajorCache(bed_parser_test.TestBase):
+    def setUp(self):
+        super(TestSampleMajorCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "companion.bed")
+
+        self.parser = bed_parser.Parser(self.missing_fam, self.missing_bim, self.missing_bed)
+        self.parser.load_fam()
+        self.parser.load_bim(map3=False)
+        self.parser.load_genotypes()
+
+        # Locus major reference: loci x samples
+        with open(self.missing_bed, "rb") as f:
+            f.read(3)
+            packed = numpy.frombuffer(f.read(), dtype=numpy.uint8).reshape(7, -1)
+        self.expected = bed_parser.decode_genotypes(packed, 12, self.parser.decode_table)
+
+    def tearDown(self):
+        super(TestSampleMajorCache, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def testGenotypes(self):
+        cache = SampleMajorCache.from_parser(self.parser, self.filename)
+        self.assertTrue(os.path.exists(self.filename))
+
+        genotypes = cache.genotypes(["2:2", "1:1", "12:12"])
+        self.assertEqual((3, 7), genotypes.shape)
+        self.assertEqual(self.expected[:, 1].tolist(), genotypes[0].tolist())
+        self.assertEqual(self.expected[:, 0].tolist(), genotypes[1].tolist())
+        self.assertEqual(self.expected[:, 11].tolist(), genotypes[2].tolist())
+
+    def testReuse(self):
+        SampleMajorCache.from_parser(self.parser, self.filename)
+        modified = os.path.getmtime(self.filename)
+        cache = SampleMajorCache.from_parser(self.parser, self.filename)
+        self.assertEqual(modified, os.path.getmtime(self.filename))
+        self.assertEqual(self.expected[:, 5].tolist(), cache.genotypes(["6:6"])[0].tolist())
+
+    def testCompanionIsIndividualMajorBed(self):
+        SampleMajorCache.from_parser(self.parser, self.filename)
+        ped_parser = bed_parser.Parser(self.missing_fam, self.missing_bim, self.filename)
+        ped_parser.load_fam()
+        ped_parser.load_bim(map3=False)
+        ped_parser.load_genotypes()
+        self.assertEqual(self.expected.tolist(), [list(x.genotype_data) for x in ped_parser])
+
+    def testInvalidSample(self):
+        cache = SampleMajorCache.from_parser(self.parser, self.filename)
+        with self.assertRaises(InvalidSelection):
+            cache.genotypes(["1:1", "bogus:id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -528,5 +528,415 @@ class TestVcfFiles(TestBase):
                 index += 1
         self.assertEqual(7, index)
         self.assertEqual(7, missing_count)
+
+
+class TestVcfGenotypeDecoding(TestBase):
+    def testUnphased(self):
+        from libgwas.vcf_parser import parse_gt
+        genotypes = parse_gt(b"0/0\t0/1\t1/0\t1/1\t./.", 5, 0)
+        self.assertEqual([0, 1, 1, 2, -1], list(genotypes))
+        self.assertEqual(numpy.int8, genotypes.dtype)
+
+    def testPhasedAndHaploid(self):
+        from libgwas.vcf_parser import parse_gt
+        genotypes = parse_gt(b"0|0\t1|0\t1|1\t.|1\t1\t0\t.", 7, 0)
+        self.assertEqual([0, 1, 2, -1, 2, 0, -1], list(genotypes))
+
+    def testOtherAlleles(self):
+        from libgwas.vcf_parser import parse_gt
+        genotypes = parse_gt(b"0/2\t0/10\t1/1", 3, 0)
+        self.assertEqual([-1, -1, 2], list(genotypes))
+
+    def testKeyPosition(self):
+        from libgwas.vcf_parser import parse_gt
+        samples = b"12:0|1:0.9\t30:1/1:1.9\t.\t7:0/0"
+        self.assertEqual([1, 2, -1, 0], list(parse_gt(samples, 4, 1)))
+        self.assertEqual([1, 2, -1, 0], list(parse_gt(b"0|1:5\t1/1:3\t.:.\t0/0", 4, 0)))
+
+    def testSampleSelection(self):
+        from libgwas.vcf_parser import parse_gt
+        genotypes = parse_gt(b"0/0\t0/1\t1/1\t./.", 4, 0, numpy.array([1, 3]))
+        self.assertEqual([1, -1], list(genotypes))
+
+    def testSampleCount(self):
+        from libgwas.vcf_parser import parse_gt
+        from libgwas.exceptions import MalformedInputFile
+        with self.assertRaises(MalformedInputFile):
+            parse_gt(b"0/0\t0/1", 3, 0)
+
+    def testPhasedFile(self):
+        import tempfile
+        filename = tempfile.mktemp(suffix=".vcf")
+        with open(filename, "w") as f:
+            print("##fileformat=VCFv4.2", file=f)
+            print("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                             "INFO", "FORMAT", "1", "2", "3", "4"]), file=f)
+            print("1\t100\trs1\tA\tG\t50\tPASS\t.\tDS:GT\t0:0|0\t1:1|0\t2:1|1\t2:1|1", file=f)
+            print("1\t200\trs2\tC\tT\t10\tPASS\t.\tGT\t0|0\t0|1\t1|1\t1|1", file=f)
+        try:
+            pc = PhenoCovar()
+            DataParser.ind_exclusions = ["2"]
+            parser = Parser(filename, data_field='GT')
+            parser.init_subjects(pc)
+            parser.load_genotypes()
+            loci = [(snp.rsid, list(snp.genotype_data), list(snp.alleles),
+                     snp.maj_allele_count, snp.min_allele_count, snp.maf) for snp in parser]
+            self.assertEqual(1, len(loci))
+            rsid, genotypes, alleles, maj_count, min_count, maf = loci[0]
+            self.assertEqual("rs1", rsid)
+            self.assertEqual([0, 2, 2], genotypes)
+            self.assertEqual(["A", "G"], alleles)
+            self.assertEqual(4, maj_count)
+            self.assertEqual(2, min_count)
+            self.assertAlmostEqual(1 / 3.0, maf)
+        finally:
+            remove_file(filename)
+
+
+class TestVcfRegions(TestBase):
+    def load(self, filename, regions=None):
+        pc = PhenoCovar()
+        parser = Parser(filename, data_field='GT', regions=regions)
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        return parser
+
+    def testMergeRegions(self):
+        from libgwas.vcf_parser import merge_regions
+        regions = [("2", 700, 800), ("1", 9000, 26000), ("1", 400, 600),
+                   ("2", 801, 900), ("1", 20000, 30000), ("chrUn", 1, 5)]
+        self.assertEqual([("1", 400, 600), ("1", 9000, 30000), ("2", 700, 900),
+                          ("chrUn", 1, 5)], merge_regions(regions))
+
+    def testIndexedRegions(self):
+        regions = [("2", 10000, 30000), ("1", 500, 500), ("1", 20000, 30000),
+                   ("7", 1, 1000)]
+        parser = self.load(self.nonmissinggz, regions)
+        self.assertTrue(parser.indexed)
+        self.assertEqual(4, parser.locus_count)
+        loci = [(snp.rsid, list(snp.genotype_data)) for snp in parser]
+        self.assertEqual([("rs0001", self.genotypes[0]), ("rs0003", self.genotypes[2]),
+                          ("rs0006", self.genotypes[5]), ("rs0007", self.genotypes[6])],
+                         loci)
+
+    def testUnindexedRegions(self):
+        regions = [("2", 10000, 30000), ("1", 500, 500), ("1", 20000, 30000)]
+        parser = self.load(self.nonmissing, regions)
+        self.assertFalse(parser.indexed)
+        self.assertEqual(4, parser.locus_count)
+        self.assertEqual(["rs0001", "rs0003", "rs0006", "rs0007"],
+                         [snp.rsid for snp in parser])
+
+    def testIndexedBoundaryEdges(self):
+        BoundaryCheck.chrom = 1
+        DataParser.boundary = BoundaryCheck(bp=[10000, 25000])
+        parser = self.load(self.nonmissinggz)
+        self.assertTrue(parser.indexed)
+        self.assertEqual(["rs0002", "rs0003"], [snp.rsid for snp in parser])
+
+
+class TestVcfDosages(TestBase):
+    def setUp(self):
+        super(TestVcfDosages, self).setUp()
+        import tempfile
+        from libgwas import impute_parser
+        self.encoding = impute_parser.encoding
+        self.filename = tempfile.mktemp(suffix=".vcf")
+        with open(self.filename, "w") as f:
+            print("##fileformat=VCFv4.2", file=f)
+            print("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                             "INFO", "FORMAT", "1", "2", "3", "4"]), file=f)
+            print("\t".join(["1", "100", "rs1", "A", "G", ".", "PASS", ".", "GT:DS:GP",
+                             "0/0:0.1:0.9,0.1,0", "0/1:1.2:0.1,0.6,0.3",
+                             "1/1:1.9:0,0.1,0.9", "./.:.:.,.,."]), file=f)
+            print("\t".join(["1", "200", "rs2", "C", "T", ".", "PASS", ".", "GT:GP:DS",
+                             "0/1:0.2,0.8,0:0.8", "0/0:1,0,0:0", "0/1:0.5,0.5,0:0.5",
+                             "1/1:0,0.25,0.75:1.75"]), file=f)
+
+    def tearDown(self):
+        from libgwas import impute_parser
+        impute_parser.encoding = self.encoding
+        remove_file(self.filename)
+        super(TestVcfDosages, self).tearDown()
+
+    def load(self, data_field):
+        pc = PhenoCovar()
+        parser = Parser(self.filename, data_field=data_field)
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        return parser
+
+    def testParseValues(self):
+        from libgwas.vcf_parser import parse_values
+        values = parse_values(b"0:0.5\t1:.\t1\t0:1e-1:3", 4, 1, 1)
+        numpy.testing.assert_allclose([[0.5], [-1], [-1], [0.1]], values)
+        values = parse_values(b"0.1,0.8,0.1\t.\t1,0,0", 3, 0, 3, numpy.array([0, 2]))
+        self.assertEqual(numpy.float32, values.dtype)
+        numpy.testing.assert_allclose([[0.1, 0.8, 0.1], [1, 0, 0]], values)
+        # bcftools writes missing Number=G values as one '.' per value
+        values = parse_values(b"0/1:0.1,0.8,0.1\t./.:.,.,.\t0/0:1,0,0\t0/0:.,0.5,.5", 4, 1, 3)
+        numpy.testing.assert_allclose([[0.1, 0.8, 0.1], [-1, -1, -1], [1, 0, 0],
+                                       [-1, -1, -1]], values)
+
+    def testMalformedValues(self):
+        from libgwas.vcf_parser import parse_values
+        from libgwas.exceptions import MalformedInputFile
+        with self.assertRaises(MalformedInputFile):
+            parse_values(b"0.1,0.9\t1,0,0", 2, 0, 3)
+
+    def testDosages(self):
+        parser = self.load('DS')
+        loci = []
+        for snp in parser:
+            self.assertEqual(numpy.float32, snp.genotype_data.dtype)
+            genodata = snp.get_genotype_data(numpy.ones(4, dtype=bool))
+            loci.append((snp.rsid, list(snp.missing_genotypes), list(genodata.genotypes)))
+        self.assertEqual("rs1", loci[0][0])
+        self.assertEqual([False, False, False, True], loci[0][1])
+        numpy.testing.assert_allclose([0.1, 1.2, 1.9], loci[0][2], rtol=1e-6)
+        numpy.testing.assert_allclose([0.8, 0, 0.5, 1.75], loci[1][2], rtol=1e-6)
+
+    def testDosageEncodings(self):
+        from libgwas import impute_parser
+        impute_parser.encoding = impute_parser.Encoding.Dominant
+        parser = self.load('DS')
+        dominant = [list(snp.get_genotype_data(numpy.ones(4, dtype=bool)).genotypes)
+                    for snp in parser]
+        impute_parser.encoding = impute_parser.Encoding.Recessive
+        parser = self.load('DS')
+        recessive = [list(snp.get_genotype_data(numpy.ones(4, dtype=bool)).genotypes)
+                     for snp in parser]
+        numpy.testing.assert_allclose([0.8, 0, 0.5, 1.0], dominant[1], rtol=1e-6)
+        numpy.testing.assert_allclose([0, 0, 0, 0.75], recessive[1], rtol=1e-6)
+
+    def testProbabilities(self):
+        parser = self.load('GP')
+        loci = []
+        for snp in parser:
+            self.assertEqual((4, 3), snp.genotype_data.shape)
+            genodata = snp.get_genotype_data(numpy.ones(4, dtype=bool))
+            loci.append((list(snp.missing_genotypes), list(genodata.genotypes), snp.maf))
+        self.assertEqual([False, False, False, True], loci[0][0])
+        numpy.testing.assert_allclose([0.1, 1.2, 1.9], loci[0][1], rtol=1e-6)
+        numpy.testing.assert_allclose([0.8, 0, 0.5, 1.75], loci[1][1], rtol=1e-6)
+        self.assertAlmostEqual(3.05 / 8, loci[1][2], places=5)
+
+
+class TestVcfInfoFilters(TestBase):
+    def setUp(self):
+        super(TestVcfInfoFilters, self).setUp()
+        import tempfile
+        self.info_maf_filter = Parser.info_maf_filter
+        self.info_threshold = Parser.info_threshold
+        self.filename = tempfile.mktemp(suffix=".vcf")
+        header = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT",
+                  "1", "2", "3", "4"]
+        # Sample data for loci expected to fail is truncated, so parsing it
+        # would raise MalformedInputFile
+        with open(self.filename, "w") as f:
+            print("##fileformat=VCFv4.2", file=f)
+            print("\t".join(header), file=f)
+            print("1\t100\trs1\tA\tG\t.\tPASS\tAF=0.001;R2=0.9\tGT\t0/0", file=f)
+            print("1\t200\trs2\tA\tG\t.\tPASS\tAC=4;AN=8;R2=0.95\tGT\t0/1\t0/0\t1/1\t0/1", file=f)
+            print("1\t300\trs3\tA\tG\t.\tPASS\tAF=0.4;R2=0.1\tGT\t0/1", file=f)
+            print("1\t400\trs4\tA\tG\t.\tPASS\tDB;AF=0.999\tGT\t1/1", file=f)
+            print("1\t500\trs5\tA\tG\t.\tPASS\t.\tGT\t0/1\t0/1\t1/1\t0/0", file=f)
+
+    def tearDown(self):
+        Parser.info_maf_filter = self.info_maf_filter
+        Parser.info_threshold = self.info_threshold
+        remove_file(self.filename)
+        super(TestVcfInfoFilters, self).tearDown()
+
+    def testInfoValues(self):
+        from libgwas.vcf_parser import info_values, info_maf, info_quality
+        values = info_values(b"DB;AC=3,1;AN=10;R2=0.5", set([b"AC", b"AN", b"R2", b"DB"]))
+        self.assertEqual({b"AC": b"3,1", b"AN": b"10", b"R2": b"0.5", b"DB": b""}, values)
+        self.assertAlmostEqual(0.3, info_maf(values))
+        self.assertAlmostEqual(0.5, info_quality(values))
+        self.assertAlmostEqual(0.1, info_maf({b"AF": b"0.9"}))
+        self.assertIsNone(info_maf({b"AF": b"."}))
+        self.assertIsNone(info_quality({}))
+
+    def testPushdown(self):
+        Parser.info_maf_filter = True
+        Parser.info_threshold = 0.3
+        DataParser.min_maf = 0.01
+        pc = PhenoCovar()
+        parser = Parser(self.filename, data_field='GT')
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        self.assertEqual(2, parser.locus_count)
+        self.assertEqual([("rs2", [1, 0, 2, 1]), ("rs5", [1, 1, 2, 0])],
+                         [(snp.rsid, list(snp.genotype_data)) for snp in parser])
+
+
+class TestVcfStreaming(TestBase):
+    def setUp(self):
+        super(TestVcfStreaming, self).setUp()
+        self.stream_window = Parser.stream_window
+
+    def tearDown(self):
+        Parser.stream_window = self.stream_window
+        super(TestVcfStreaming, self).tearDown()
+
+    def load(self, stream):
+        pc = PhenoCovar()
+        parser = Parser(stream, data_field='GT')
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        return parser, pc
+
+    def testTextStream(self):
+        import io
+        with open(self.nonmissing) as f:
+            stream = io.StringIO(f.read())
+        parser, pc = self.load(stream)
+        self.assertEqual(12, len(pc.pedigree_data))
+        self.assertEqual(-1, parser.locus_count)
+        self.assertEqual(self.genotypes, [list(snp.genotype_data) for snp in parser])
+
+    def testCompressedStream(self):
+        import io
+        with open(self.nonmissinggz, "rb") as f:
+            stream = io.BufferedReader(io.BytesIO(f.read()))
+        parser, pc = self.load(stream)
+        self.assertEqual(self.genotypes, [list(snp.genotype_data) for snp in parser])
+
+    def testMissingnessWindow(self):
+        import io
+        DataParser.ind_miss_tol = 0.5
+        Parser.stream_window = 3
+        with open(self.missing, "rb") as f:
+            stream = io.BytesIO(f.read())
+        parser, pc = self.load(stream)
+        self.assertEqual(-1, parser.locus_count)
+        self.assertEqual([True, False] + [True] * 10, list(parser.alt_not_missing))
+
+        genotypes = []
+        for snp in parser:
+            genotypes.append(list(snp.get_genotype_data(numpy.ones(12, dtype=bool)).genotypes))
+        self.assertEqual(7, len(genotypes))
+        self.assertEqual([1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1], genotypes[1])
+
+    def testWindowCoversStream(self):
+        import io
+        DataParser.ind_miss_tol = 0.5
+        Parser.stream_window = 100
+        with open(self.missing, "rb") as f:
+            stream = io.BytesIO(f.read())
+        parser, pc = self.load(stream)
+        self.assertEqual(7, parser.locus_count)
+        self.assertEqual(7, len([snp.rsid for snp in parser]))
+
+class TestVcfMultiallelic(TestBase):
+    def setUp(self):
+        super(TestVcfMultiallelic, self).setUp()
+        import tempfile
+        self.split_multiallelic = Parser.split_multiallelic
+        self.filename = tempfile.mktemp(suffix=".vcf")
+        with open(self.filename, "w") as f:
+            print("##fileformat=VCFv4.2", file=f)
+            print("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                             "INFO", "FORMAT", "1", "2", "3", "4"]), file=f)
+            print("\t".join(["1", "100", "rs1", "A", "G,T", ".", "PASS", ".", "GT:DS:GP",
+                             "0/1:1,0:0,1,0,0,0,0", "1|2:1,1:0,0,0,0,1,0",
+                             "2/2:0,2:0,0,0,0,0,1", "./.:.:."]), file=f)
+            print("\t".join(["1", "200", "rs2", "C", "T", ".", "PASS", ".", "GT:DS:GP",
+                             "0/0:0:1,0,0", "0/1:1:0,1,0", "1/1:2:0,0,1",
+                             "0/1:1:0,1,0"]), file=f)
+
+    def tearDown(self):
+        Parser.split_multiallelic = self.split_multiallelic
+        remove_file(self.filename)
+        super(TestVcfMultiallelic, self).tearDown()
+
+    def load(self, data_field='GT'):
+        pc = PhenoCovar()
+        parser = Parser(self.filename, data_field=data_field)
+        parser.init_subjects(pc)
+        parser.load_genotypes()
+        return parser
+
+    def testAlleleDecoding(self):
+        from libgwas.vcf_parser import parse_gt_alleles
+        first, second = parse_gt_alleles(b"0/1\t1|2\t3\t./.\t0/12", 5, 0)
+        self.assertEqual([0, 1, 3, -1, -1], list(first))
+        self.assertEqual([1, 2, 3, -1, -1], list(second))
+
+    def testGenotypeCopies(self):
+        from libgwas.vcf_parser import genotype_copies
+        # 0/0, 0/1, 1/1, 0/2, 1/2, 2/2
+        copies = genotype_copies(3, 2)
+        self.assertEqual([0, 0, 0, 1, 1, 2], list(numpy.argmax(copies, axis=1)))
+        copies = genotype_copies(3, 1)
+        self.assertEqual([0, 1, 2, 0, 1, 0], list(numpy.argmax(copies, axis=1)))
+
+    def testUnsplit(self):
+        parser = self.load()
+        self.assertEqual(2, parser.locus_count)
+        loci = [(snp.alleles, list(snp.genotype_data)) for snp in parser]
+        self.assertEqual([(["A", "G,T"], [1, -1, -1, -1]), (["C", "T"], [0, 1, 2, 1])], loci)
+
+    def testUnsplitDosages(self):
+        from libgwas.vcf_parser import DosageExtraction, ProbabilityExtraction
+        dosages = DosageExtraction()(b"0.5,0.2\t1,0\t0,1", ["DS"], 3)
+        numpy.testing.assert_allclose([0.5, 1, 0], dosages.genotypes)
+        probabilities = ProbabilityExtraction()(b"0,1,0,0,0,0\t0,0,0,0,1,0\t0,0,0,0,0,1",
+                                                ["GP"], 3)
+        numpy.testing.assert_allclose([[0, 1, 0], [0, 1, 0], [1, 0, 0]],
+                                      probabilities.genotypes)
+
+        for data_field in ['DS', 'GP']:
+            parser = self.load(data_field)
+            self.assertEqual(2, parser.locus_count)
+            loci = []
+            for snp in parser:
+                genodata = snp.get_genotype_data(numpy.ones(4, dtype=bool))
+                loci.append((snp.alleles, list(snp.missing_genotypes),
+                             list(genodata.genotypes)))
+            self.assertEqual([["A", "G,T"], ["C", "T"]], [x[0] for x in loci])
+            self.assertEqual([False, False, False, True], loci[0][1])
+            numpy.testing.assert_allclose([1, 1, 0], loci[0][2])
+            numpy.testing.assert_allclose([0, 1, 2, 1], loci[1][2])
+
+    def testSplitGenotypes(self):
+        Parser.split_multiallelic = True
+        parser = self.load()
+        self.assertEqual(3, parser.locus_count)
+        loci = []
+        for snp in parser:
+            loci.append((snp.rsid, snp.pos, snp.alleles, list(snp.genotype_data),
+                         list(snp.missing_genotypes)))
+        self.assertEqual([("rs1", 100, ["A", "G"], [1, 1, 0, -1], [False, False, False, True]),
+                          ("rs1", 100, ["A", "T"], [0, 1, 2, -1], [False, False, False, True]),
+                          ("rs2", 200, ["C", "T"], [0, 1, 2, 1], [False] * 4)], loci)
+
+    def testSplitAnalysis(self):
+        Parser.split_multiallelic = True
+        parser = self.load()
+        non_missing = numpy.ones(4, dtype=bool)
+        counts = []
+        for snp in parser:
+            genodata = snp.get_genotype_data(non_missing)
+            counts.append((genodata.a2_count, genodata.het_count))
+        self.assertEqual([(2, 2), (3, 1), (4, 2)], counts)
+
+    def testSplitDosages(self):
+        Parser.split_multiallelic = True
+        for data_field in ['DS', 'GP']:
+            parser = self.load(data_field)
+            loci = []
+            for snp in parser:
+                genodata = snp.get_genotype_data(numpy.ones(4, dtype=bool))
+                loci.append((snp.alleles[1], list(snp.missing_genotypes),
+                             list(genodata.genotypes)))
+            self.assertEqual(["G", "T", "T"], [x[0] for x in loci])
+            self.assertEqual([False, False, False, True], loci[0][1])
+            numpy.testing.assert_allclose([1, 1, 0], loci[0][2])
+            numpy.testing.assert_allclose([0, 1, 2], loci[1][2])
+            numpy.testing.assert_allclose([0, 1, 2, 1], loci[2][2])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,7 +2,7 @@ from .data_parser import DataParser
 from .parsed_locus import ParsedLocus
 from .exceptions import TooManyAlleles
 from .exceptions import TooFewAlleles
-import gzip
+from . import bgzf
 import numpy
 from .pheno_covar import PhenoCovar
 import logging
@@ -126,7 +126,7 @@ class Parser(DataParser):
         if self.genotype_file is not None:
             self.genotype_file.close()
         if DataParser.compressed_pedigree:
-            self.genotype_file = gzip.open("%s.gz" % self.tped_file, 'rt')
+            self.genotype_file = bgzf.open_gzip("%s.gz" % self.tped_file, 'rt')
         else:
             self.genotype_file = open(self.tped_file)
 
@@ -2,9 +2,16 @@ from .data_parser import DataParser
 from .pheno_covar import PhenoCovar
 from .boundary import BoundaryCheck
 from .parsed_locus import ParsedLocus
+from .parsed_locus import default_geno_extraction
+from . import impute_parser
 from .exceptions import TooManyAlleles
 from .exceptions import TooFewAlleles
+from .exceptions import MalformedInputFile
+from . import bgzf
+import collections
 import gzip
+import io
+import itertools
 import numpy
 import os
 import tabix
@@ -17,8 +24,6 @@ from . import GenotypeData as GenotypeData
 import sys
 import logging
 
-import faulthandler
-
 from contextlib import contextmanager
 __copyright__ = "Eric Torstenson"
 __license__ = "GPL3.0"
@@ -45,7 +50,7 @@ class BasicFile(object):
         self.compressed = compressed
 
         if self.compressed:
-            self._file = gzip.open(self.filename, 'rt')
+            self._file = bgzf.open_gzip(self.filename, 'rt')
         else:
             self._file = open(self.filename)
 
@@ -56,48 +61,587 @@ class BasicFile(object):
     def __del__(self):
         self._file.close()
 
-def OpenFile(filename, compressed):
+def OpenFile(filename, compressed, binary=False):
+    mode = 'rt'
+    if binary:
+        mode = 'rb'
     if compressed:
-        file = gzip.open(filename, 'rt')
+        file = bgzf.open_gzip(filename, mode)
     else:
-        file = open(filename)
+        file = open(filename, mode)
 
     return file
 
 
+#: Byte values used when decoding sample columns
+_tab = ord("\t")
+_colon = ord(":")
+_zero = ord("0")
+_unphased = ord("/")
+_phased = ord("|")
+_comma = ord(",")
+_dot = ord(".")
+_space = ord(" ")
+
+#: Bytes appended to the sample data so that reads beyond the final call
+#: land on a terminator
+_padding = b"\t\t\t\t"
+
+
+def field_offsets(samples, key_index):
+    """Locate the start of a FORMAT key's value within each sample column
+
+    :param samples: numpy uint8 array of the sample columns (tab delimited)
+    :param key_index: position of the key within the FORMAT column
+    :return: (offsets, present) where present is false for samples whose
+             column ends before the key's value
+    """
+    tabs = numpy.flatnonzero(samples == _tab)
+    starts = numpy.empty(tabs.shape[0] + 1, dtype=numpy.int64)
+    starts[0] = 0
+    starts[1:] = tabs + 1
+    if key_index == 0:
+        return starts, numpy.ones(starts.shape[0], dtype=bool)
+
+    ends = numpy.empty(starts.shape[0], dtype=numpy.int64)
+    ends[0:-1] = tabs
+    ends[-1] = samples.shape[0]
+    colons = numpy.flatnonzero(samples == _colon)
+    colon_idx = numpy.searchsorted(colons, starts) + (key_index - 1)
+    present = colon_idx < colons.shape[0]
+    offsets = numpy.full(starts.shape[0], samples.shape[0], dtype=numpy.int64)
+    offsets[present] = colons[colon_idx[present]] + 1
+    present &= offsets <= ends
+    offsets[~present] = samples.shape[0]
+    return offsets, present
+
+
+def parse_gt_alleles(samples, sample_count, key_index, sample_index=None):
+    """Decode the allele indices of GT calls from the raw sample columns of a \
+        VCF line
+
+    :param samples: bytes containing the sample columns (tab delimited,
+                    without the line ending)
+    :param sample_count: number of sample columns expected
+    :param key_index: position of GT within the FORMAT column
+    :param sample_index: indices of the samples to be decoded (None for all)
+    :return: (first, second) int16 arrays of allele indices, with -1 for
+             missing or malformed calls
+
+    Phased and unphased diploid calls are accepted, as are haploid calls
+    (whose single allele is reported for both). Only single digit allele
+    indices (0-9) are recognized.
+    """
+    samples = numpy.frombuffer(samples + _padding, dtype=numpy.uint8)
+    offsets, present = field_offsets(samples[0:-len(_padding)], key_index)
+    if offsets.shape[0] != sample_count:
+        raise MalformedInputFile("Expected %d samples, but found %d" %
+                                 (sample_count, offsets.shape[0]))
+    if sample_index is not None:
+        offsets = offsets[sample_index]
+        present = present[sample_index]
+
+    first = samples[offsets].astype(numpy.int16) - _zero
+    separator = samples[offsets + 1]
+    second = samples[offsets + 2].astype(numpy.int16) - _zero
+    terminator = samples[offsets + 3]
+
+    diploid = ((separator == _unphased) | (separator == _phased)) & \
+              ((terminator == _tab) | (terminator == _colon))
+    haploid = (separator == _tab) | (separator == _colon)
+    second = numpy.where(haploid, first, second)
+
+    valid = present & (diploid | haploid) & \
+            (first >= 0) & (first <= 9) & (second >= 0) & (second <= 9)
+    first[~valid] = -1
+    second[~valid] = -1
+    return first, second
+
+
+def parse_gt(samples, sample_count, key_index, sample_index=None):
+    """Decode biallelic GT calls from the raw sample columns of a VCF line
+
+    :param samples: bytes containing the sample columns (tab delimited,
+                    without the line ending)
+    :param sample_count: number of sample columns expected
+    :param key_index: position of GT within the FORMAT column
+    :param sample_index: indices of the samples to be decoded (None for all)
+    :return: int8 array of alternate allele counts with missing_storage
+             for missing calls
+
+    Phased and unphased diploid calls are accepted, as are haploid calls
+    (which are counted as homozygous). Calls containing anything other than
+    the alleles 0 and 1 are treated as missing.
+    """
+    first, second = parse_gt_alleles(samples, sample_count, key_index, sample_index)
+    valid = (first >= 0) & (first <= 1) & (second >= 0) & (second <= 1)
+    genotypes = (first + second).astype(numpy.int8)
+    genotypes[~valid] = DataParser.missing_storage
+    return genotypes
+
+
+def allele_dosage(first, second, allele):
+    """Count the copies of a single allele from decoded GT calls
+
+    :param first: allele indices returned by parse_gt_alleles
+    :param second: allele indices returned by parse_gt_alleles
+    :param allele: index of the allele being counted (1 for the first ALT)
+    :return: int8 array of counts with missing_storage for missing calls
+
+    All other alleles are treated as the reference allele.
+    """
+    genotypes = ((first == allele).astype(numpy.int8) + (second == allele))
+    genotypes[first < 0] = DataParser.missing_storage
+    return genotypes
+
+
+def genotype_copies(allele_count, allele):
+    """Map VCF ordered genotypes (as used by GP or PL) onto the number of \
+        copies of a single allele
+
+    :param allele_count: number of alleles, including REF
+    :param allele: index of the allele being counted
+    :return: (genotype count x 3) matrix which sums probabilities for 0, 1
+             and 2 copies of the allele
+
+    Diploid genotype j/k (j <= k) is found at index k*(k+1)/2 + j.
+    """
+    copies = []
+    for k in range(allele_count):
+        for j in range(k + 1):
+            copies.append(int(j == allele) + int(k == allele))
+    return numpy.eye(3, dtype=numpy.float32)[copies]
+
+
+def parse_values(samples, sample_count, key_index, value_count, sample_index=None):
+    """Decode numeric FORMAT values (such as DS or GP) from the raw sample \
+        columns of a VCF line
+
+    :param samples: bytes containing the sample columns (tab delimited,
+                    without the line ending)
+    :param sample_count: number of sample columns expected
+    :param key_index: position of the key within the FORMAT column
+    :param value_count: number of (comma separated) values for each sample,
+                        or None to take the count from the values themselves
+    :param sample_index: indices of the samples to be decoded (None for all)
+    :return: float32 array (samples x value_count) where samples lacking the
+             value (or with '.' for any of them) are filled with
+             missing_storage
+
+    All of the values are converted by a single call to numpy, after
+    blanking everything in the line other than the requested values.
+    """
+    length = len(samples)
+    data = numpy.frombuffer(samples + _padding, dtype=numpy.uint8)
+    offsets, present = field_offsets(data[0:length], key_index)
+    if offsets.shape[0] != sample_count:
+        raise MalformedInputFile("Expected %d samples, but found %d" %
+                                 (sample_count, offsets.shape[0]))
+    if sample_index is not None:
+        offsets = offsets[sample_index]
+        present = present[sample_index]
+
+    # Padding ensures that every value is followed by a terminator
+    terminators = numpy.flatnonzero((data == _tab) | (data == _colon))
+    ends = terminators[numpy.searchsorted(terminators, offsets)]
+
+    # A sample is missing if any of its values is a lone '.', such as '.'
+    # or '.,.,.' (as written by bcftools)
+    separator = (data == _tab) | (data == _colon) | (data == _comma)
+    follows_separator = numpy.concatenate([[True], separator[0:length]])[0:length]
+    lone_dots = numpy.zeros(length + 1, dtype=numpy.int64)
+    numpy.cumsum((data[0:length] == _dot) & follows_separator & separator[1:length + 1],
+                 out=lone_dots[1:])
+    missing = ~present | (ends == offsets) | (lone_dots[ends] > lone_dots[offsets])
+    offsets = offsets[~missing]
+    ends = ends[~missing]
+
+    delta = numpy.zeros(length + len(_padding), dtype=numpy.int8)
+    delta[offsets] = 1
+    delta[ends] = -1
+    text = numpy.where(numpy.cumsum(delta[0:length]) > 0, data[0:length], _space)
+    text[text == _comma] = _space
+
+    if offsets.shape[0] == 0:
+        # numpy returns junk, rather than nothing, for a blank string
+        values = numpy.zeros(0, dtype=numpy.float32)
+    else:
+        try:
+            values = numpy.fromstring(text.tobytes(), dtype=numpy.float32, sep=" ")
+        except ValueError:
+            values = None
+    if value_count is None and values is not None:
+        value_count = values.shape[0] // max(1, offsets.shape[0])
+    if values is None or values.shape[0] != offsets.shape[0] * value_count:
+        raise MalformedInputFile("Unable to parse %s values for each sample" % (value_count))
+
+    result = numpy.full((missing.shape[0], value_count), DataParser.missing_storage,
+                        dtype=numpy.float32)
+    result[~missing] = values.reshape(offsets.shape[0], value_count)
+    return result
+
+
 class GenotypeExtraction(object):
     """Basic class for Parser functor. This assumes a single value as the 
         data found at the key. For more complex values, such as probabilities,
         a different functor should be used."""
     def __init__(self, genokey='GT', missing=None):
-        global genotype_values
         self.genokey = genokey
         if missing is None:
             missing = DataParser.missing_storage
 
         self.missing = int(missing)
 
-        # Let the missing representation map to the missing notation
-        GenotypeData.conversion['./.'] = self.missing
-        GenotypeData.conversion[self.missing] = self.missing
+    def __call__(self, samples, format, sample_count, sample_index=None, alt_count=None):
+        """Extract genotypes for a single locus
+
+        :param samples: raw bytes for the sample columns
+        :param format: list of keys from the FORMAT column
+        :param sample_count: number of sample columns present
+        :param sample_index: indices of the samples to be returned
+        :param alt_count: number of ALT alleles in the record (None to
+                          determine it from the values, where that matters)
+        :return: GenotypeData for the first ALT allele. Calls involving
+                 other ALTs are missing
+        """
+        try:
+            data_index = format.index(self.genokey)
+        except ValueError:
+            Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
+        return self.genotype_data(parse_gt(samples, sample_count, data_index, sample_index))
+
+    def genotype_data(self, genotypes):
+        """Wrap decoded values (from VCF or BCF) as GenotypeData
 
-    def __call__(self, locus, format):
-        """We assume locus has been split and is an array with no return character at end"""
-        global genotype_values
+        :param genotypes: int8 genotypes with missing_storage for missing
+        :return: GenotypeData
+        """
+        if self.missing != DataParser.missing_storage:
+            genotypes[genotypes == DataParser.missing_storage] = self.missing
+        return GenotypeData.from_genotypes(genotypes)
+
+    def decode(self, samples, format, sample_count, sample_index=None, alt_count=1):
+        """Decode a record, which may have several ALT alleles, so that it \
+            can be split into one biallelic locus per ALT by allele()
+
+        :param alt_count: number of ALT alleles in the record
+        :return: decoded values for the record
+        """
         try:
-            if self.genokey not in format:
-                faulthandler.dump_traceback(all_threads=True)
             data_index = format.index(self.genokey)
-        except:
+        except ValueError:
             Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
-        genotypes = GenotypeData()
-        for genotype in locus[9:]:
-            genotype = genotype.split(":")
-            if len(genotype) > data_index:
-                genotypes.append(genotype[data_index])
-            else:
-                genotypes.append(self.missing)
-        return genotypes
+        return parse_gt_alleles(samples, sample_count, data_index, sample_index)
+
+    def allele(self, decoded, allele):
+        """Extract the genotypes for a single ALT allele from decode()
+
+        :param decoded: values returned by decode
+        :param allele: index of the ALT (1 for the first)
+        :return: GenotypeData
+        """
+        return self.genotype_data(allele_dosage(decoded[0], decoded[1], allele))
+
+    #: Genotype extraction used by ParsedLocus for these values
+    locus_extraction = staticmethod(default_geno_extraction)
+
+
+class DosageExtraction(GenotypeExtraction):
+    """Extract dosages (such as DS) as a float32 vector"""
+
+    #: Genotype extraction used by ParsedLocus for these values
+    locus_extraction = staticmethod(impute_parser.dosage_extraction)
+
+    def __init__(self, genokey='DS', missing=None):
+        super(DosageExtraction, self).__init__(genokey, missing)
+
+    def __call__(self, samples, format, sample_count, sample_index=None, alt_count=None):
+        """Dosages of the first ALT allele (a multiallelic record has one \
+            dosage per ALT)"""
+        try:
+            data_index = format.index(self.genokey)
+        except ValueError:
+            Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
+        dosages = parse_values(samples, sample_count, data_index, alt_count, sample_index)
+        if dosages.shape[1] == 0:
+            # Every sample was missing, so there was nothing to count
+            dosages = numpy.full((dosages.shape[0], 1), DataParser.missing_storage,
+                                 dtype=numpy.float32)
+        return self.allele(dosages, 1)
+
+    def genotype_data(self, values):
+        """:param values: float32 (samples x 1) with missing_storage for missing"""
+        dosages = values[:, 0]
+        if self.missing != DataParser.missing_storage:
+            dosages[dosages == DataParser.missing_storage] = self.missing
+        return GenotypeData.from_dosages(dosages)
+
+    def decode(self, samples, format, sample_count, sample_index=None, alt_count=1):
+        try:
+            data_index = format.index(self.genokey)
+        except ValueError:
+            Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
+        # Dosages have one value per ALT
+        return parse_values(samples, sample_count, data_index, alt_count, sample_index)
+
+    def allele(self, decoded, allele):
+        return self.genotype_data(decoded[:, allele - 1:allele].copy())
+
+
+class ProbabilityExtraction(GenotypeExtraction):
+    """Extract genotype probabilities (such as GP) as an (n x 3) matrix,
+    matching the layout of IMPUTE's .gen files"""
+
+    #: Genotype extraction used by ParsedLocus for these values
+    locus_extraction = staticmethod(impute_parser.gen_dosage_extraction)
+
+    def __init__(self, genokey='GP', missing=None):
+        super(ProbabilityExtraction, self).__init__(genokey, missing)
+
+    def __call__(self, samples, format, sample_count, sample_index=None, alt_count=None):
+        """Probabilities of 0, 1 and 2 copies of the first ALT allele, with \
+            any other ALTs counted along with REF"""
+        try:
+            data_index = format.index(self.genokey)
+        except ValueError:
+            Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
+        genotype_count = None
+        if alt_count is not None:
+            genotype_count = int((alt_count + 1) * (alt_count + 2) / 2)
+        probabilities = parse_values(samples, sample_count, data_index, genotype_count,
+                                     sample_index)
+        genotype_count = probabilities.shape[1]
+        if genotype_count == 0:
+            return self.genotype_data(numpy.full((probabilities.shape[0], 3),
+                                                 DataParser.missing_storage,
+                                                 dtype=numpy.float32))
+
+        # There are allele_count * (allele_count + 1) / 2 diploid genotypes
+        allele_count = int(round((numpy.sqrt(8 * genotype_count + 1) - 1) / 2))
+        if allele_count * (allele_count + 1) != 2 * genotype_count:
+            raise MalformedInputFile("%d genotype probabilities don't match any number of "
+                                     "alleles" % (genotype_count))
+        if allele_count == 2:
+            return self.genotype_data(probabilities)
+        return self.allele((allele_count, probabilities), 1)
+
+    def genotype_data(self, probabilities):
+        """:param probabilities: float32 (samples x 3) with rows of
+                              missing_storage for missing samples"""
+        if self.missing != DataParser.missing_storage:
+            probabilities[probabilities[:, 0] == DataParser.missing_storage] = self.missing
+        return GenotypeData.from_dosages(probabilities)
+
+    def decode(self, samples, format, sample_count, sample_index=None, alt_count=1):
+        try:
+            data_index = format.index(self.genokey)
+        except ValueError:
+            Exit(f"Unable to find data key, {self.genokey}, in  format list: {format}")
+        genotype_count = int((alt_count + 1) * (alt_count + 2) / 2)
+        return (alt_count + 1,
+                parse_values(samples, sample_count, data_index, genotype_count, sample_index))
+
+    def allele(self, decoded, allele):
+        allele_count, values = decoded
+        missing = values[:, 0] == DataParser.missing_storage
+        probabilities = values.dot(genotype_copies(allele_count, allele))
+        probabilities[missing] = self.missing
+        return GenotypeData.from_dosages(probabilities)
+
+
+#: Extraction used for each of the data_fields understood by the parser
+data_field_extraction = {
+    'GT': GenotypeExtraction,
+    'DS': DosageExtraction,
+    'GP': ProbabilityExtraction
+}
+
+
+def set_genotypes(iteration, geno):
+    """Populate the iteration with genotypes and their summary counts
+
+    :param iteration: ParsedLocus being populated
+    :param geno: GenotypeData for the locus
+    :return: True if the locus passes the MAF thresholds
+    """
+    iteration.genotype_data = geno.genotypes
+    allele_counts = [geno.ref_counts, geno.alt_counts]
+    iteration.hetero_count = geno.het_counts
+    iteration.missing_allele_count = geno.missing
+    iteration.allele_count2 = allele_counts[1]
+    iteration.missing_genotypes = geno.missing_mask()
+    iteration.effa_freq = geno.maf()
+    iteration.maj_allele_count = max(allele_counts)
+    iteration.min_allele_count = min(allele_counts)
+    iteration._maf = geno.maf()
+
+    return iteration.maf >= DataParser.min_maf and iteration.maf <= DataParser.max_maf
+
+
+def split_line(line):
+    """Split the 9 fixed columns from a raw VCF line, leaving the sample \
+        columns untouched
+
+    :param line: bytes for a single data line
+    :return: list of the 9 fixed columns followed by the raw sample columns
+    """
+    words = line.rstrip().split(b"\t", 9)
+    if len(words) < 10:
+        raise MalformedInputFile("Incomplete VCF line: %s" % (line[0:80]))
+    return words
+
+
+def info_values(info, keys):
+    """Pull the requested keys from a raw INFO column
+
+    :param info: bytes from the INFO column
+    :param keys: set of keys (bytes) of interest
+    :return: dict key => raw value (bytes) for the keys present
+    """
+    values = {}
+    for entry in info.split(b";"):
+        key, sep, value = entry.partition(b"=")
+        if key in keys:
+            values[key] = value
+    return values
+
+
+def first_value(value):
+    """Convert the first of a comma separated list of values to float \
+        (None if it isn't a number)"""
+    try:
+        return float(value.split(b",")[0])
+    except ValueError:
+        return None
+
+
+def info_maf(values):
+    """Estimate the MAF from the AF, AC/AN or MAF entries of an INFO column
+
+    :param values: dict returned by info_values
+    :return: minor allele frequency or None if it can't be determined
+    """
+    frequency = None
+    if b"AF" in values:
+        frequency = first_value(values[b"AF"])
+    elif b"AC" in values and b"AN" in values:
+        ac = first_value(values[b"AC"])
+        an = first_value(values[b"AN"])
+        if ac is not None and an:
+            frequency = ac / an
+    elif b"MAF" in values:
+        frequency = first_value(values[b"MAF"])
+    if frequency is None:
+        return None
+    return min(frequency, 1.0 - frequency)
+
+
+def info_quality(values):
+    """Return the imputation quality (R2, DR2 or INFO) from an INFO column \
+        (None if none are present)"""
+    for key in (b"R2", b"DR2", b"INFO"):
+        if key in values:
+            return first_value(values[key])
+    return None
+
+
+#: INFO keys used by the metadata filters
+info_keys = set([b"AF", b"AC", b"AN", b"MAF", b"R2", b"DR2", b"INFO"])
+
+
+def open_stream(source):
+    """Prepare a file-like object (or "-" for stdin) to be read as raw lines
+
+    :param source: file-like object, in text or binary mode, or "-"
+    :return: iterator over the (bytes) lines of the stream
+
+    Gzipped streams are recognized when the stream supports peek.
+    """
+    if isinstance(source, str):
+        source = sys.stdin
+    if isinstance(source, io.TextIOBase):
+        if hasattr(source, "buffer"):
+            source = source.buffer
+        else:
+            return (line.encode() for line in source)
+    if hasattr(source, "peek") and source.peek(2)[0:2] == b"\x1f\x8b":
+        source = gzip.GzipFile(fileobj=source)
+    return iter(source)
+
+
+def stream_lines(buffered, stream):
+    """Return the lines that have been buffered followed by the rest of the \
+        stream"""
+    for line in buffered:
+        yield line
+    for line in stream:
+        yield line
+
+
+#: Largest position that can be used in a tabix query
+max_position = (1 << 29) - 1
+
+
+def merge_regions(regions):
+    """Sort regions and merge those which overlap or abut one another
+
+    :param regions: list of (chrom, start, end), 1 based and inclusive
+    :return: sorted list of non-overlapping (chrom, start, end)
+
+    Chromosomes are ordered numerically when they are recognized by
+    BoundaryCheck and by name otherwise.
+    """
+    def order(region):
+        code = BoundaryCheck.get_valid_chrom(region[0])
+        if code is None:
+            return (1, 0, region[0], region[1])
+        return (0, code, region[0], region[1])
+
+    merged = []
+    for chrom, start, end in sorted([(str(c), int(s), int(e)) for c, s, e in regions],
+                                    key=order):
+        if len(merged) > 0 and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            merged[-1] = (chrom, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((chrom, start, end))
+    return merged
+
+
+def tabix_lines(tabix_file, regions):
+    """Query each region in turn, presenting the rows as raw lines
+
+    :param tabix_file: opened tabix file
+    :param regions: merged regions (see merge_regions)
+    :return: generator producing raw (bytes) lines
+
+    Only records whose position falls inside the region are returned, so
+    that long variants overlapping neighboring regions aren't repeated.
+    """
+    for chrom, start, end in regions:
+        try:
+            rows = tabix_file.query(chrom, start - 1, end)
+        except tabix.TabixError:
+            logging.info("No variants found for %s:%d-%d" % (chrom, start, end))
+            continue
+        for row in rows:
+            if start <= int(row[1]) <= end:
+                yield "\t".join(row).encode()
+
+
+def region_lines(lines, regions):
+    """Filter raw lines down to those found inside regions (for files \
+        lacking a tabix index)"""
+    bounds = collections.defaultdict(list)
+    for chrom, start, end in regions:
+        bounds[chrom.encode()].append((start, end))
+    for line in lines:
+        chrom, pos, remainder = line.split(b"\t", 2)
+        if chrom in bounds:
+            pos = int(pos)
+            for start, end in bounds[chrom]:
+                if start <= pos <= end:
+                    yield line
+                    break
 
 
 class Parser(DataParser):
@@ -127,38 +671,111 @@ class Parser(DataParser):
     # occur within the pass_filters set
     pass_filters = set([".", "PASS"])
 
+    #: When true, the MAF thresholds are applied to the frequency reported in
+    #: the INFO column (AF, AC/AN or MAF) before any sample data is parsed.
+    #: Those frequencies describe all samples in the file, not just those
+    #: selected for analysis, so this is off by default.
+    info_maf_filter = False
+
+    #: When set, variants whose imputation quality (R2, DR2 or INFO within the
+    #: INFO column) isn't above this are skipped before parsing sample data
+    info_threshold = None
+
     # Default will be GT with -9 for
     ExtractGenotypes = GenotypeExtraction()
 
-    def __init__(self, filename, data_field='GT'):
+    #: When true, records with several ALT alleles are split into one
+    #: biallelic locus per ALT, counting the copies of that ALT (all other
+    #: alleles are treated as REF). Otherwise, only calls made up of REF and
+    #: the first ALT are used
+    split_multiallelic = False
+
+    #: Number of lines buffered from streamed input in order to estimate
+    #: individual missingness. When 0, streamed data isn't checked for
+    #: individual missingness at all
+    stream_window = 0
+
+    def __init__(self, filename, data_field='GT', regions=None):
+        """
+        :param filename: VCF file (may be gzipped), "-" for stdin or a
+                         file-like object to be streamed
+        :param data_field: FORMAT key used for genotypes
+        :param regions: optional list of (chrom, start, end) to be
+                        traversed. Positions are 1 based and inclusive.
+
+        Streamed input is read exactly once: the header when the parser is
+        created and the data lines during iteration (preceded by up to
+        stream_window lines buffered by load_genotypes).
+        """
+        #: Lines from streamed input (None when reading from a file)
+        self.stream = None
+        #: Lines read from the stream ahead of iteration
+        self.buffered_lines = []
+        #: Multiallelic record whose ALTs are still being reported
+        self.split_record = None
+        #: Sample IDs from the header of streamed input
+        self.stream_sample_ids = None
+
+        if filename == "-" or not isinstance(filename, str):
+            self.stream = open_stream(filename)
+            self.stream_sample_ids = self.read_stream_header()
+            filename = getattr(filename, "name", "<stdin>")
+            if filename == "-":
+                filename = "<stdin>"
+
         self.vcf_filename = filename
         self.data_field = data_field
+
+        #: Functor used to extract the data_field from each line
+        self.extract_genotypes = Parser.ExtractGenotypes
+        if data_field != Parser.ExtractGenotypes.genokey:
+            extraction = data_field_extraction.get(data_field, GenotypeExtraction)
+            self.extract_genotypes = extraction(data_field)
         self.ind_mask = None            # mask associated with complete set of subjects
         self.ind_count = -1
 
+        #: Merged regions to be traversed (None for the entire file)
+        self.regions = None
+        if regions is not None:
+            self.regions = merge_regions(regions)
+
         self.indexed = False
         self.compressed = False
-        if filename.split(".")[-1] == "gz":
+        if self.stream is None and filename.split(".")[-1] == "gz":
             self.compressed = True
-            if BoundaryCheck.chrom != -1 and os.path.isfile("%s.tbi" % (filename)):
+            if (self.regions is not None or BoundaryCheck.chrom != -1) and \
+                    os.path.isfile("%s.tbi" % (filename)):
                 self.indexed = True
 
         #: Subjects dropped due to missing individual threshold
         self.alt_not_missing = None
 
         self.vcf_file = None
+        #: Underlying file when vcf_file filters its lines
+        self.raw_file = None
         self.reset()
-    
+
     def __del__(self):
         if self.vcf_file is not None:
             self.vcf_file.close()
+        if self.raw_file is not None:
+            self.raw_file.close()
 
     def initialize(self, map3=None, pheno_covar=None):
         self.init_subjects(pheno_covar)
         self.load_genotypes()
 
     def getnew(self):
-        return Parser(self.vcf_filename, self.data_field)
+        ExitIf("Streamed VCF data can only be traversed once", self.stream is not None)
+        return Parser(self.vcf_filename, self.data_field, self.regions)
+
+    def read_stream_header(self):
+        """Consume the header from streamed input, returning the sample IDs"""
+        for line in self.stream:
+            if line[0:6] == b"#CHROM":
+                return line.decode().strip().split()[9:]
+            ExitIf("Missing #CHROM header in streamed VCF data", line[0:1] != b"#")
+        Exit("Missing #CHROM header in streamed VCF data")
 
     def ReportConfiguration(self):
         log = logging.getLogger('bed_parser::ReportConfiguration')
@@ -169,12 +786,15 @@ class Parser(DataParser):
         sample_ids = []
         format = []
 
-        with OpenFile(self.vcf_filename, self.compressed) as file:
-            for line in file:
-                if line[0:6] == "#CHROM":
-                    line = line.strip().split()
-                    sample_ids = line[9:]
-                    break
+        if self.stream is not None:
+            sample_ids = self.stream_sample_ids
+        else:
+            with OpenFile(self.vcf_filename, self.compressed) as file:
+                for line in file:
+                    if line[0:6] == "#CHROM":
+                        line = line.strip().split()
+                        sample_ids = line[9:]
+                        break
 
         mask_components = []
         for id in sample_ids:
@@ -198,21 +818,48 @@ class Parser(DataParser):
         """skip_all_headers will skip all of the headers, including the sample header row. 
 
         This only relates to non-tabix based files"""
+        self.split_record = None
         if self.vcf_file is not None:
             self.vcf_file.close()
-        if self.indexed and len(DataParser.boundary.bounds) > 0:
+        if self.raw_file is not None:
+            self.raw_file.close()
+            self.raw_file = None
+        regions = self.query_regions()
+        if self.stream is not None:
+            self.vcf_file = stream_lines(self.buffered_lines, self.stream)
+            if self.regions is not None:
+                self.vcf_file = region_lines(self.vcf_file, self.regions)
+        elif self.indexed and regions is not None:
             self.tabix_file = tabix.open(self.vcf_filename)
-
-            self.vcf_file = tabix.query(str(BoundaryCheck.chrom),
-                    DataParser.boundary.bounds[0],
-                    DataParser.boundary.bounds[1])
+            self.vcf_file = tabix_lines(self.tabix_file, regions)
         else:
-            self.vcf_file = OpenFile(self.vcf_filename, self.compressed)
+            self.vcf_file = OpenFile(self.vcf_filename, self.compressed, binary=True)
 
             if skip_all_headers:
                 for line in self.vcf_file:
-                    if line[0:2] == "#C":
+                    if line[0:2] == b"#C":
                         break
+                if self.regions is not None:
+                    self.raw_file = self.vcf_file
+                    self.vcf_file = region_lines(self.raw_file, self.regions)
+
+    def query_regions(self):
+        """Regions to be traversed, either those passed to the parser or \
+            the chromosome (and bounds) selected via BoundaryCheck.
+
+        :return: list of (chrom, start, end) or None for the entire file
+        """
+        if self.regions is not None:
+            return self.regions
+        if BoundaryCheck.chrom != -1:
+            chrom = BoundaryCheck.chrom_name
+            if chrom is None or BoundaryCheck.get_valid_chrom(chrom) != BoundaryCheck.chrom:
+                chrom = str(BoundaryCheck.chrom)
+            bounds = getattr(DataParser.boundary, "bounds", [])
+            if len(bounds) > 0:
+                return [(chrom, bounds[0], bounds[1])]
+            return [(chrom, 1, max_position)]
+        return None
 
     def load_family_details(self, pheno_covar):
         """Load contents from the .fam file, updating the pheno_covar with \
@@ -225,10 +872,11 @@ class Parser(DataParser):
         # 1s indicate an individual is to be masked out
         mask_components = []
 
-        if self.vcf_file is not None:
-            self.vcf_file.close()
-        file = OpenFile(self.vcf_filename, DataParser.compressed_pedigree)
-        sample_ids = None
+        sample_ids = self.stream_sample_ids
+        if self.stream is None:
+            if self.vcf_file is not None:
+                self.vcf_file.close()
+            file = OpenFile(self.vcf_filename, DataParser.compressed_pedigree)
 
         while sample_ids is None:
             line = file.readline().split()
@@ -255,46 +903,119 @@ class Parser(DataParser):
         self.ind_count = self.ind_mask.shape[0]
         pheno_covar.freeze_subjects()
 
-    def load_genotypes(self):
-        self.reset()
-        missing = None
+    def info_filter(self, info):
+        """Apply the INFO based filters to a raw INFO column
+
+        :param info: bytes from the INFO column
+        :return: True if the variant should be kept
+        """
+        if not Parser.info_maf_filter and Parser.info_threshold is None:
+            return True
+        values = info_values(info, info_keys)
+        if Parser.info_threshold is not None:
+            quality = info_quality(values)
+            if quality is not None and not quality > Parser.info_threshold:
+                return False
+        if Parser.info_maf_filter:
+            maf = info_maf(values)
+            if maf is not None and (maf < DataParser.min_maf or maf > DataParser.max_maf):
+                return False
+        return True
+
+    def count_missing(self, lines):
+        """Count missing genotypes for each sample across the lines passing \
+            the boundary and INFO filters
+
+        :param lines: raw VCF lines
+        :return: (locus count, missing count for each unmasked sample)
+        """
         locus_count = 0
-        total_locus_count = 0
+        missing = numpy.zeros(self.sample_index.shape[0], dtype=numpy.int32)
 
-        for locus in self.vcf_file:
-            locus = locus.strip().split()
-            chr, pos, rsid, ref, alt, qual, filter, info, format = locus[0:9]
-                
-            format = format.split(":")
+        for line in lines:
+            chr, pos, rsid, ref, alt, qual, filter, info, format, samples = split_line(line)
             chr = int(chr)
             pos = int(pos)
-            if DataParser.boundary.TestBoundary(chr, pos,rsid):
-                locus_count += 1
-                data = Parser.ExtractGenotypes(locus, format)
-                allelic_data = numpy.array(data.gt())
-
-                if missing is None:
-                    missing = numpy.zeros(allelic_data.shape[0], dtype='int8')
-                missing += ((allelic_data==DataParser.missing_storage))
-            total_locus_count += 1
+            if DataParser.boundary.TestBoundary(chr, pos, rsid.decode()) and \
+                    self.info_filter(info):
+                alt_count = alt.count(b",") + 1
+                if Parser.split_multiallelic and alt_count > 1:
+                    # Every ALT is missing for the same samples
+                    decoded = self.extract_genotypes.decode(samples, format.decode().split(":"),
+                                                            self.ind_count, self.sample_index,
+                                                            alt_count)
+                    locus_count += alt_count
+                    missing += alt_count * self.extract_genotypes.allele(decoded,
+                                                                         1).missing_mask()
+                else:
+                    locus_count += 1
+                    data = self.extract_genotypes(samples, format.decode().split(":"),
+                                                  self.ind_count, self.sample_index, alt_count)
+                    missing += data.missing_mask()
+        return locus_count, missing
+
+    def load_genotypes(self):
+        """Determine which individuals exceed the individual missingness \
+            threshold.
+
+        Streamed data is only checked across the first stream_window lines,
+        which are held until iteration begins."""
+
+        #: Indices of the samples that aren't masked out
+        self.sample_index = numpy.flatnonzero(~self.ind_mask)
+
+        if self.stream is None:
+            self.reset()
+            locus_count, missing = self.count_missing(self.vcf_file)
+        else:
+            self.buffered_lines = list(itertools.islice(self.stream, Parser.stream_window))
+            lines = self.buffered_lines
+            if self.regions is not None:
+                lines = region_lines(lines, self.regions)
+            locus_count, missing = self.count_missing(lines)
         max_missing = DataParser.ind_miss_tol * locus_count
-        
-        if missing is None:
-            missing = numpy.array([1] * locus_count)
-        dropped_individuals = 0+(max_missing<missing)
+        dropped_individuals = max_missing < missing
 
-        if sum(dropped_individuals) > 0:
+        if numpy.sum(dropped_individuals) > 0:
             # This will be ORd, so it needs to be one for not
-            self.alt_not_missing = dropped_individuals != 1
-            self.alt_not_missing = self.alt_not_missing[self.ind_mask != 1]
+            self.alt_not_missing = ~dropped_individuals
 
+        # The number of loci in a stream can't be known until it has been read
+        if self.stream is not None and len(self.buffered_lines) == Parser.stream_window:
+            locus_count = -1
         self.locus_count = locus_count
         self.reset()
+
+    def next_split_allele(self, iteration):
+        """Populate the iteration with the next ALT of the multiallelic \
+            record currently being split
+
+        :param iteration: ParsedLocus being populated
+        :return: True if the locus passes the MAF thresholds
+        """
+        chr, pos, rsid, ref, alts, decoded, allele = self.split_record
+        if allele == len(alts):
+            self.split_record = None
+        else:
+            self.split_record = (chr, pos, rsid, ref, alts, decoded, allele + 1)
+
+        iteration.chr = chr
+        iteration.pos = pos
+        iteration.rsid = rsid
+        iteration.ref = ref
+        iteration.alt = alts[allele - 1]
+        iteration.alleles = [iteration.ref, iteration.alt]
+        return set_genotypes(iteration, self.extract_genotypes.allele(decoded, allele))
+
     def populate_iteration(self, iteration):
         cur_idx = iteration.cur_idx
 
-        locus = next(self.vcf_file).strip().split()
+        # The remaining ALTs of a split record are reported before moving on
+        if self.split_record is not None:
+            return self.next_split_allele(iteration)
 
+        # Only the fixed columns are split. The sample data remains untouched
+        # until the variant has passed all of the filters that don't need it
         iteration.chr, \
             iteration.pos, \
             iteration.rsid, \
@@ -303,33 +1024,34 @@ class Parser(DataParser):
             qual, \
             filter, \
             info, \
-            format = locus[0:9]
+            format, \
+            samples = split_line(next(self.vcf_file))
 
         iteration.chr = int(iteration.chr)
         iteration.pos = int(iteration.pos)
-        alleles = [iteration.ref, iteration.alt]
+        iteration.rsid = iteration.rsid.decode()
+        iteration.ref = iteration.ref.decode()
+        iteration.alt = iteration.alt.decode()
+        filter = filter.decode()
+        # Genotypes count the ALT allele, so it must remain the second allele
+        iteration.alleles = [iteration.ref, iteration.alt]
         if DataParser.boundary.TestBoundary(iteration.chr, iteration.pos, iteration.rsid):
             # Consider qual and filter as well
-            if (qual=='.' or qual > Parser.min_qual) and filter in Parser.pass_filters:
-                geno = Parser.ExtractGenotypes(locus, format.split(":"))
-                iteration.genotype_data = numpy.ma.MaskedArray(geno.genotypes,
-                                    self.ind_mask).compressed()
-                allele_counts = [geno.ref_counts, geno.alt_counts]
-                iteration.hetero_counts = geno.het_counts
-                iteration.missing_allele_count = geno.missing
-                iteration.allele_count2 = allele_counts[1]
-                iteration.missing_genotypes = iteration.genotype_data == DataParser.missing_storage
-                iteration.effa_freq = geno.maf()
-                if allele_counts[0] < allele_counts[1]:
-                    allele_counts = [allele_counts[1], allele_counts[0]]
-                    alleles = [alleles[1], alleles[0]]
-                iteration.major_allele = alleles[0]
-                iteration.minor_allele = alleles[1]
-                iteration.maj_allele_count = allele_counts[0]
-                iteration.min_allele_count = allele_counts[1]
-                iteration._maf = geno.maf()
-
-                return iteration.maf >= DataParser.min_maf and iteration.maf <= DataParser.max_maf
+            if (qual == b'.' or float(qual) > Parser.min_qual) and filter in Parser.pass_filters:
+                if not self.info_filter(info):
+                    return False
+                alts = iteration.alt.split(",")
+                if Parser.split_multiallelic and len(alts) > 1:
+                    decoded = self.extract_genotypes.decode(samples, format.decode().split(":"),
+                                                            self.ind_count, self.sample_index,
+                                                            len(alts))
+                    self.split_record = (iteration.chr, iteration.pos, iteration.rsid,
+                                         iteration.ref, alts, decoded, 1)
+                    return self.next_split_allele(iteration)
+
+                geno = self.extract_genotypes(samples, format.decode().split(":"),
+                                              self.ind_count, self.sample_index, len(alts))
+                return set_genotypes(iteration, geno)
             else:
                 print("%s:%s %s - Filter: %s" % (iteration.chr,
                                                                       iteration.pos,
@@ -342,6 +1064,12 @@ class Parser(DataParser):
     def get_effa_freq(self, genotypes):
         return numpy.sum(numpy.array(genotypes))/float(len(genotypes))
 
+    def __iter__(self):
+        """Reset the file and begin iteration"""
+        locus = super(Parser, self).__iter__()
+        locus._extract_genotypes = self.extract_genotypes.locus_extraction
+        return locus
+
 
 
 